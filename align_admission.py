@@ -0,0 +1,352 @@
+"""
+A host-wide pool of memory for the aligners, shared by all the pipelines running on this host
+   -- each alignment asks for the memory it needs (the footprint of the aligner with its genome index loaded) and is
+      admitted once that fits in the pool, alongside the alignments already running.  The pool is a fraction of the
+      host's memory (from /proc/meminfo).  An alignment that needs more than the whole pool is run on its own.
+   -- requests are admitted in the order they were made (first-in, first-out), across all the pipelines on the host
+   -- the state of the pool is kept in a file in the pool directory, guarded by a file lock.  A process waiting for
+      admission blocks on its own named pipe, which is written to whenever memory is released or a request is admitted,
+      so waiters are woken at once rather than polling
+   -- a genome index may be made resident (loaded once into shared memory, and used by the alignments of several samples
+      and pipelines).  Its memory is counted once, for as long as any process is using it; the last process to stop
+      using it unloads it.  A genome left without users (its last user exited without unloading it, e.g. a pipeline
+      killed with SIGKILL) is adopted by the next STAR pipeline, which unloads it (see adopt_orphans); one that nobody
+      adopts is dropped from the pool after RESIDENT_ORPHAN_SECONDS
+   -- the requests of processes that have exited (e.g. a killed pipeline) are removed from the pool
+   -- the pool directory is shared by all users, so it is sticky (as /tmp is): a user cannot remove or replace the files
+      of another.  The pool's files are opened without following symbolic links, and the state is rewritten in place
+      (under the lock) rather than through a temporary file
+"""
+
+import os
+import json
+import stat
+import time
+import errno
+import fcntl
+import select
+
+from stage_executor import host_memory_gb
+
+LOCK_FILE = "pool.lock"
+STATE_FILE = "pool.json"
+WAKE_DIR = "wake"
+WAKE_SUFFIX = ".fifo"
+
+#the pool directory and its files are shared by the pipelines of all users:
+SHARED_DIR_MODE = 01777
+SHARED_FILE_MODE = 0666
+
+#a resident genome without users is no longer counted after this long (in seconds), if no pipeline adopted it:
+RESIDENT_ORPHAN_SECONDS = 24*60*60
+
+#a waiting process re-checks the pool at least this often (in seconds), in case an owner exited without releasing its memory:
+STALE_CHECK_INTERVAL = 30
+
+
+def process_start_time(pid):
+    """
+    The start time of a process (in clock ticks since boot), which tells it apart from a later process reusing its pid.
+    Returns None if there is no such process
+    """
+    try:
+        with open("/proc/"+str(pid)+"/stat", 'r') as f:
+            #the command name (the second field) is in parentheses and may contain spaces; the start time is the 22nd field:
+            return int(f.read().rsplit(')', 1)[1].split()[19])
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+def open_shared(path):
+    """
+    Opens (creating it if needed) a file of the pool for reading and writing.  A symbolic link (or anything but a regular
+    file) in its place is refused, so a file of the user running the pipeline cannot be written through it
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, SHARED_FILE_MODE)
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        os.close(fd)
+        raise OSError(errno.EINVAL, "Not a regular file: "+str(path))
+    if st.st_uid == os.getuid():
+        os.fchmod(fd, SHARED_FILE_MODE)
+    return fd
+
+
+def shared_dir(path):
+    """
+    Creates a directory of the pool (sticky and writable by all), or checks that an existing one writable by all is sticky
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+            os.chmod(path, SHARED_DIR_MODE)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    #(a directory writable by all but not sticky, e.g. made by an earlier version of the pipeline, is made sticky):
+    st = os.lstat(path)
+    if not st.st_mode & stat.S_IWOTH or st.st_mode & stat.S_ISVTX:
+        return
+    if st.st_uid == os.getuid():
+        os.chmod(path, stat.S_IMODE(st.st_mode) | stat.S_ISVTX)
+    else:
+        raise OSError(errno.EPERM, "The pool directory "+str(path)+" is writable by all users but not sticky.  Ask its owner to "
+                      "run 'chmod 1777' on it, or choose another ALIGN_POOL_DIR")
+
+
+def pool_capacity_gb(memory_fraction):
+    memory_gb = host_memory_gb()
+    if memory_gb is None:
+        return float('inf')
+    return memory_gb*memory_fraction
+
+
+class AdmissionPool:
+    """
+    This process's view of the pool.  Requests are identified by tickets (increasing integers)
+    """
+    def __init__(self, pool_dir, capacity_gb):
+        self.pool_dir = pool_dir
+        self.capacity_gb = capacity_gb
+        self.pid = os.getpid()
+        self.start_time = process_start_time(self.pid)
+        self.tickets = set()
+
+        wake_dir = os.path.join(pool_dir, WAKE_DIR)
+        for d in (pool_dir, wake_dir):
+            shared_dir(d)
+        self.wake_fifo = os.path.join(wake_dir, str(self.pid)+WAKE_SUFFIX)
+        #(left by an earlier process with this pid; one of another user cannot be removed from the sticky directory):
+        if os.path.lexists(self.wake_fifo):
+            os.remove(self.wake_fifo)
+        os.mkfifo(self.wake_fifo)
+        os.chmod(self.wake_fifo, 0622)
+        #opened for writing too, so the pipe never reports end-of-file while waiting:
+        self.wake_fd = os.open(self.wake_fifo, os.O_RDWR | os.O_NONBLOCK)
+
+    def _update(self, change):
+        """
+        Applies change(state) to the state of the pool while holding the lock, and saves it.  Returns what change returns
+        """
+        with os.fdopen(open_shared(os.path.join(self.pool_dir, LOCK_FILE)), 'r') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                #(the state is only read and written under the lock, so it is rewritten in place):
+                with os.fdopen(open_shared(os.path.join(self.pool_dir, STATE_FILE)), 'r+') as f:
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = {'next_ticket': 0, 'queued': [], 'admitted': []}
+                    state.setdefault('resident', {})
+                    self._remove_exited(state)
+                    result = change(state)
+                    f.seek(0)
+                    f.truncate()
+                    json.dump(state, f, indent=1)
+                return result
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _remove_exited(state):
+        for key in ('queued', 'admitted'):
+            state[key] = [r for r in state[key] if process_start_time(r['pid']) == r['start_time']]
+        #a resident genome stays (and is counted) when all its users have exited, since it is still loaded, until it is
+        #adopted (and unloaded), or has been without users for RESIDENT_ORPHAN_SECONDS:
+        now = time.time()
+        for name, genome in state['resident'].items():
+            genome['owners'] = [o for o in genome['owners'] if process_start_time(o['pid']) == o['start_time']]
+            if genome['owners']:
+                genome.pop('orphaned_at', None)
+            elif now-genome.setdefault('orphaned_at', now) > RESIDENT_ORPHAN_SECONDS:
+                del state['resident'][name]
+
+    @staticmethod
+    def _in_use(state):
+        return sum(r['gb'] for r in state['admitted']) + sum(g['gb'] for g in state['resident'].values())
+
+    def _add_owner(self, genome):
+        owner = {'pid': self.pid, 'start_time': self.start_time}
+        if owner not in genome['owners']:
+            genome['owners'].append(owner)
+
+    def _notify(self):
+        """
+        Wakes the other processes waiting on the pool
+        """
+        wake_dir = os.path.join(self.pool_dir, WAKE_DIR)
+        for name in os.listdir(wake_dir):
+            path = os.path.join(wake_dir, name)
+            if path == self.wake_fifo:
+                continue
+            try:
+                st = os.lstat(path)
+                if not stat.S_ISFIFO(st.st_mode):
+                    continue
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK | os.O_NOFOLLOW)
+            except OSError as e:
+                #a waiting process keeps its own pipe open, so a pipe without a reader was left by a process that exited
+                #(only this user's are removed; those of other users are theirs to remove):
+                if e.errno == errno.ENXIO and st.st_uid == os.getuid():
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                if e.errno in (errno.ENXIO, errno.ENOENT, errno.EACCES, errno.ELOOP):
+                    continue
+                raise
+            try:
+                os.write(fd, "x")
+            except OSError as e:
+                #the pipe is full, so that process has already been woken:
+                if e.errno != errno.EAGAIN:
+                    raise
+            finally:
+                os.close(fd)
+
+    def enqueue(self, footprints_gb):
+        """
+        Requests admission for a list of alignments (of the given memory footprints, in GB), in order.  Returns their tickets
+        """
+        def change(state):
+            tickets = []
+            for gb in footprints_gb:
+                ticket = state['next_ticket']
+                state['next_ticket'] += 1
+                state['queued'].append({'ticket': ticket, 'pid': self.pid, 'start_time': self.start_time, 'gb': gb})
+                tickets.append(ticket)
+            return tickets
+        tickets = self._update(change)
+        self.tickets.update(tickets)
+        return tickets
+
+    def request_residency(self, genome, footprint_gb):
+        """
+        Requests that a genome index be resident.  If it already is, this process is added to its users and None is
+        returned.  Otherwise a request for its memory is queued, and its ticket returned (see try_admit)
+        """
+        def change(state):
+            if genome in state['resident']:
+                self._add_owner(state['resident'][genome])
+                return None
+            ticket = state['next_ticket']
+            state['next_ticket'] += 1
+            state['queued'].append({'ticket': ticket, 'pid': self.pid, 'start_time': self.start_time, 'gb': footprint_gb, 'genome': genome})
+            return ticket
+        ticket = self._update(change)
+        if ticket is not None:
+            self.tickets.add(ticket)
+        return ticket
+
+    def adopt_orphans(self):
+        """
+        Makes this process the user of the resident genomes that have no users.  Returns them: the caller should unload
+        them (and then call release_residency), or keep using them
+        """
+        def change(state):
+            orphans = sorted(g for g, resident in state['resident'].items() if not resident['owners'])
+            for genome in orphans:
+                state['resident'][genome].pop('orphaned_at', None)
+                self._add_owner(state['resident'][genome])
+            return orphans
+        return self._update(change)
+
+    def release_residency(self, genome):
+        """
+        Removes this process from the users of a resident genome.  Returns True if no process is using it any more, in
+        which case the caller should unload it (its memory is returned to the pool)
+        """
+        owner = {'pid': self.pid, 'start_time': self.start_time}
+        def change(state):
+            resident = state['resident'].get(genome)
+            if resident is None:
+                return False
+            resident['owners'] = [o for o in resident['owners'] if o != owner]
+            if resident['owners']:
+                return False
+            del state['resident'][genome]
+            return True
+        last_user = self._update(change)
+        self._notify()
+        return last_user
+
+    def try_admit(self, ticket):
+        """
+        Admits the request if it is first in line and its memory is available.  Returns True if it was admitted.
+        An admitted residency request makes its genome resident (and is then released with release_residency)
+        """
+        def change(state):
+            if not state['queued'] or state['queued'][0]['ticket'] != ticket:
+                return False
+            request = state['queued'][0]
+            genome = request.get('genome')
+            #another process may have made the genome resident while this request waited:
+            if genome is not None and genome in state['resident']:
+                state['queued'].pop(0)
+                self._add_owner(state['resident'][genome])
+                return True
+            in_use = self._in_use(state)
+            if in_use > 0 and in_use+request['gb'] > self.capacity_gb:
+                return False
+            state['queued'].pop(0)
+            if genome is not None:
+                state['resident'][genome] = {'gb': request['gb'], 'owners': []}
+                self._add_owner(state['resident'][genome])
+            else:
+                state['admitted'].append(request)
+            return True
+        if self._update(change):
+            #the next request in line may fit too:
+            self._notify()
+            return True
+        return False
+
+    def in_use_gb(self):
+        return self._update(self._in_use)
+
+    def release(self, ticket):
+        """
+        Returns the memory of an admitted request to the pool (or withdraws a queued request)
+        """
+        def change(state):
+            for key in ('queued', 'admitted'):
+                state[key] = [r for r in state[key] if r['ticket'] != ticket]
+        self._update(change)
+        self.tickets.discard(ticket)
+        self._notify()
+
+    def wait(self, timeout=STALE_CHECK_INTERVAL):
+        """
+        Blocks until another process changes the pool, or until the timeout (in seconds)
+        """
+        try:
+            readable, _, _ = select.select([self.wake_fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if readable:
+            try:
+                while os.read(self.wake_fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def close(self):
+        """
+        Withdraws (or releases) all of this process's requests, and removes its pipe
+        """
+        if self.tickets:
+            tickets = set(self.tickets)
+            def change(state):
+                for key in ('queued', 'admitted'):
+                    state[key] = [r for r in state[key] if r['ticket'] not in tickets]
+            self._update(change)
+            self.tickets = set()
+            self._notify()
+        os.close(self.wake_fd)
+        try:
+            os.remove(self.wake_fifo)
+        except OSError:
+            pass
@@ -0,0 +1,121 @@
+"""
+Chooses the threads and memory given to each stage of the alignment scripts (the aligner, the BAM sort, and Picard's
+MarkDuplicates), from the cpus and memory of the host and the number of alignments that will run at once
+   -- the cpus and memory are detected on this host, or read from a resource profile (ALIGN_RESOURCE_PROFILE): a file of
+      KEY=VALUE lines giving CPUS and MEMORY_GB, and optionally fixing any of the values chosen below
+      (ALIGN_THREADS, SORT_THREADS, SORT_MEMORY_MB, DEDUP_HEAP_GB)
+   -- the alignments are admitted through the memory pool (see align_admission.py), so as many run at once as fit in the
+      pool (ALIGN_MEMORY_FRACTION of the memory), each needing ALIGN_MEMORY_GB.  Each alignment gets an equal share of
+      the cpus and of the pool (less the genome, when one copy of it is shared by the alignments).  In watch mode, where
+      the samples arrive in batches, the values are planned for as many alignments as fit in the pool, so that they are the
+      same for every batch
+   -- the chosen values are written to a resource file (ALIGN_RESOURCE_FILE), which the alignment scripts read when they
+      start.  They are not written into the scripts, which are part of the fingerprint of an alignment (see
+      stage_manifest.py), so that a change of host or of the number of samples does not make every alignment out of date
+"""
+
+import os
+import sys
+import multiprocessing
+
+from stage_executor import host_memory_gb
+
+HOST_PROFILE = "host"
+
+#the values a profile may fix, rather than have them chosen from the cpus and memory:
+OVERRIDES = ('ALIGN_THREADS', 'SORT_THREADS', 'SORT_MEMORY_MB', 'DEDUP_HEAP_GB')
+
+#the fractions of an alignment's memory share given to the sort (across all its threads) and to the MarkDuplicates heap.
+#In the streamed mode the sort runs alongside the aligner, so it gets a smaller share than MarkDuplicates, which follows:
+SORT_MEMORY_FRACTION = 0.25
+DEDUP_HEAP_FRACTION = 0.4
+
+#bounds on the chosen values (samtools sort memory is per thread):
+MIN_SORT_MEMORY_MB = 256
+MAX_SORT_MEMORY_MB = 4096
+MIN_HEAP_GB = 2
+MAX_HEAP_GB = 32
+
+
+def read_profile(profile_file):
+    """
+    Reads a resource profile (KEY=VALUE lines; blank lines and lines starting with '#' are ignored) into a dictionary
+    """
+    profile = {}
+    try:
+        with open(profile_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    key, value = line.split('=', 1)
+                    profile[key.strip()] = float(value.strip().strip('"'))
+                except ValueError:
+                    sys.exit("Could not read the line '"+line+"' of the resource profile: "+str(profile_file))
+    except IOError:
+        sys.exit("Could not find the resource profile: "+str(profile_file))
+    return profile
+
+
+def clamp(value, low, high):
+    return max(low, min(value, high))
+
+
+def concurrent_alignments(pool_gb, footprint_gb, num_samples):
+    """
+    The number of alignments that fit in the memory pool at once (at least one, and no more than there are samples, unless
+    num_samples is None: the number of samples is not known, e.g. in watch mode)
+    """
+    if footprint_gb is None or footprint_gb <= 0:
+        return 1
+    if num_samples is None:
+        return max(1, int(pool_gb/footprint_gb))
+    return int(clamp(int(pool_gb/footprint_gb), 1, max(1, num_samples)))
+
+
+def choose_resources(profile_file, memory_fraction, footprint_gb, num_samples, resident_gb=0):
+    """
+    Returns a dictionary of the chosen values (and the profile, cpus, memory and concurrent alignments they follow from)
+    """
+    if profile_file:
+        profile = read_profile(profile_file)
+        profile_name = os.path.basename(profile_file)
+    else:
+        profile = {}
+        profile_name = HOST_PROFILE
+    cpus = int(profile.get('CPUS', multiprocessing.cpu_count()))
+    memory_gb = profile.get('MEMORY_GB', host_memory_gb())
+    if memory_gb is None:
+        sys.exit("Could not determine the memory of this host.  Give MEMORY_GB in a resource profile (ALIGN_RESOURCE_PROFILE).")
+
+    pool_gb = max(0, memory_gb*memory_fraction-resident_gb)
+    concurrent = concurrent_alignments(pool_gb, footprint_gb, num_samples)
+    cpus_per_alignment = max(1, cpus/concurrent)
+    memory_per_alignment_gb = pool_gb/concurrent
+
+    #a fixed number of sort threads shares the sort memory, so the values are chosen in order, each after any fixed ones:
+    resources = dict((key, int(profile[key])) for key in OVERRIDES if key in profile)
+    resources.setdefault('ALIGN_THREADS', cpus_per_alignment)
+    resources.setdefault('SORT_THREADS', max(1, cpus_per_alignment/2))
+    resources.setdefault('SORT_MEMORY_MB', int(clamp(memory_per_alignment_gb*SORT_MEMORY_FRACTION*1024/resources['SORT_THREADS'],
+                                                     MIN_SORT_MEMORY_MB, MAX_SORT_MEMORY_MB)))
+    resources.setdefault('DEDUP_HEAP_GB', int(clamp(memory_per_alignment_gb*DEDUP_HEAP_FRACTION, MIN_HEAP_GB, MAX_HEAP_GB)))
+
+    resources.update({'PROFILE': profile_name, 'CPUS': cpus, 'MEMORY_GB': round(memory_gb, 1), 'CONCURRENT_ALIGNMENTS': concurrent})
+    return resources
+
+
+def describe(resources):
+    return ", ".join(key.lower()+"="+str(resources[key]) for key in ('PROFILE', 'CPUS', 'MEMORY_GB', 'CONCURRENT_ALIGNMENTS')+OVERRIDES)
+
+
+def write_resource_file(resources, resource_file):
+    """
+    Writes the chosen values as shell variables (with RESOURCES, their description), for the alignment scripts to source
+    """
+    with open(resource_file+".tmp", 'w') as f:
+        f.write('RESOURCES="'+describe(resources)+'"\n')
+        for key in OVERRIDES:
+            f.write(key+"="+str(resources[key])+"\n")
+    os.rename(resource_file+".tmp", resource_file)
@@ -0,0 +1,348 @@
+"""
+This script keeps a compiled copy of each GTF annotation, so that the helper scripts do not re-read the (large) text file:
+  -- a GTF is parsed once into array tables, saved as numpy files that are memory-mapped when read:
+        genes.npy   the genes (gene_id, gene_name, contig, start, end, strand and whether any record has a transcript_id),
+                    sorted by gene_id, with gene_names.npy (the names, sorted, and their genes) for lookups by name
+        exons.npy   the exon intervals (contig, start, end, strand and gene), sorted by contig and start, with
+                    contig_offsets.npy (the first exon of each contig)
+        contigs.txt the contigs, in the order they appear in the GTF
+  -- the compiled tables are kept in ANNOTATION_CACHE_DIR under the SHA-1 checksum of the GTF, so a changed GTF is
+     compiled again.  The checksum of a path is recorded with its size and modification time, so it is only recomputed
+     when the file changes
+  -- derived files are written into the same entry when first asked for: the GTF for RNA-SeQC (only the records with a
+     transcript_id, on the contigs of the reference FASTA, which must have a .fai index) and the list of contigs
+An entry is written to a temporary directory and renamed into place, so pipelines compiling the same GTF at once do not
+see a partial entry.
+
+Run as a script (with GTF and ANNOTATION_CACHE_DIR in the environment):
+    annotation_cache.py compile                      (compiles the GTF, if it is not cached)
+    annotation_cache.py contigs                      (prints the path of the contig list)
+    annotation_cache.py rna_seqc_gtf <fasta>         (prints the path of the GTF for RNA-SeQC)
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+from array import array
+import numpy as np
+
+from stage_manifest import checksum
+
+CACHE_VERSION = 1
+CHECKSUM_INDEX = "checksums.json"
+META_FILE = "meta.json"
+CONTIGS_FILE = "contigs.txt"
+GENES_FILE = "genes.npy"
+GENE_NAMES_FILE = "gene_names.npy"
+EXONS_FILE = "exons.npy"
+CONTIG_OFFSETS_FILE = "contig_offsets.npy"
+RNA_SEQC_GTF_PREFIX = "rna_seqc"
+
+#the cache is shared by the pipelines of all the users in its group, any of whom may add entries or derived files to it
+#(temporary files are created private to the user; the setgid bit keeps new entries in the cache's group):
+SHARED_FILE_MODE = 0664
+SHARED_DIR_MODE = 02775
+
+
+def attribute(attributes, key):
+    """
+    The value of a GTF attribute (e.g. gene_id "X";), or None
+    """
+    start = attributes.find(key+' "')
+    #(the key must start the attribute, e.g. gene_id is not found in havana_gene_id):
+    while start > 0 and attributes[start-1] not in ' ;\t':
+        start = attributes.find(key+' "', start+1)
+    if start == -1:
+        return None
+    start += len(key)+2
+    end = attributes.find('"', start)
+    return attributes[start:end] if end != -1 else attributes[start:]
+
+
+def read_checksum_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, CHECKSUM_INDEX), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def gtf_checksum(gtf, cache_dir):
+    """
+    The checksum of the GTF, reused from the checksum index if the file's size and modification time have not changed
+    """
+    path = os.path.abspath(gtf)
+    st = os.stat(path)
+    index = read_checksum_index(cache_dir)
+    known = index.get(path)
+    if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime:
+        return known['sha1']
+    sha1 = checksum(path)
+    #(re-read, so that entries recorded meanwhile by another pipeline are kept):
+    index = read_checksum_index(cache_dir)
+    index[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha1': sha1}
+    handle, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=CHECKSUM_INDEX+".")
+    with os.fdopen(handle, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.chmod(tmp_file, SHARED_FILE_MODE)
+    os.rename(tmp_file, os.path.join(cache_dir, CHECKSUM_INDEX))
+    return sha1
+
+
+def parse_gtf(gtf):
+    """
+    Reads the GTF once.  Returns (contigs, genes, exons) where genes maps gene_id to [gene_name, contig index, start, end,
+    strand, has transcript_id] and exons is a tuple of arrays (contig index, start, end, strand, gene_id)
+    """
+    contigs = []
+    contig_index = {}
+    genes = {}
+    exon_contigs, exon_starts, exon_ends, exon_strands = array('i'), array('l'), array('l'), array('c')
+    exon_genes = []
+    with open(gtf, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t', 8)
+            contig = fields[0]
+            if not contig:
+                continue
+            if contig not in contig_index:
+                contig_index[contig] = len(contigs)
+                contigs.append(contig)
+            c = contig_index[contig]
+            if len(fields) < 9:
+                continue
+            feature, start, end, strand, attributes = fields[2], int(fields[3]), int(fields[4]), fields[6], fields[8]
+            gene_id = attribute(attributes, 'gene_id')
+            if gene_id is None:
+                continue
+            gene = genes.get(gene_id)
+            if gene is None:
+                gene = genes[gene_id] = [attribute(attributes, 'gene_name') or gene_id, c, start, end, strand[:1] or '.', False]
+            else:
+                gene[2] = min(gene[2], start)
+                gene[3] = max(gene[3], end)
+            if not gene[5] and attribute(attributes, 'transcript_id') is not None:
+                gene[5] = True
+            if feature == 'exon':
+                exon_contigs.append(c)
+                exon_starts.append(start)
+                exon_ends.append(end)
+                exon_strands.append(strand[:1] or '.')
+                exon_genes.append(gene_id)
+    return contigs, genes, (exon_contigs, exon_starts, exon_ends, exon_strands, exon_genes)
+
+
+def string_width(values):
+    return max([1]+[len(v) for v in values])
+
+
+def compile_gtf(gtf, entry_dir):
+    """
+    Writes the tables of the GTF to a new entry directory
+    """
+    contigs, genes, exons = parse_gtf(gtf)
+    gene_ids = sorted(genes)
+    gene_names = [genes[g][0] for g in gene_ids]
+    gene_table = np.zeros(len(gene_ids), dtype=[('gene_id', 'S%d' % string_width(gene_ids)), ('gene_name', 'S%d' % string_width(gene_names)),
+                                                 ('contig', np.int32), ('start', np.int64), ('end', np.int64), ('strand', 'S1'),
+                                                 ('has_transcript_id', np.bool_)])
+    for i, gene_id in enumerate(gene_ids):
+        gene_table[i] = (gene_id,)+tuple(genes[gene_id])
+    name_order = np.argsort(gene_table['gene_name'], kind='mergesort')
+    name_table = np.zeros(len(gene_ids), dtype=[('gene_name', gene_table.dtype['gene_name']), ('gene', np.int32)])
+    name_table['gene_name'] = gene_table['gene_name'][name_order]
+    name_table['gene'] = name_order
+
+    gene_position = dict((g, i) for i, g in enumerate(gene_ids))
+    exon_contigs, exon_starts, exon_ends, exon_strands, exon_genes = exons
+    exon_table = np.zeros(len(exon_genes), dtype=[('contig', np.int32), ('start', np.int64), ('end', np.int64), ('strand', 'S1'), ('gene', np.int32)])
+    exon_table['contig'] = np.frombuffer(exon_contigs, dtype=np.int32) if exon_genes else []
+    exon_table['start'] = np.array(exon_starts, dtype=np.int64)
+    exon_table['end'] = np.array(exon_ends, dtype=np.int64)
+    exon_table['strand'] = np.array(list(exon_strands), dtype='S1')
+    exon_table['gene'] = np.array([gene_position[g] for g in exon_genes], dtype=np.int32)
+    exon_table = exon_table[np.lexsort((exon_table['start'], exon_table['contig']))]
+    contig_offsets = np.searchsorted(exon_table['contig'], np.arange(len(contigs)+1))
+
+    np.save(os.path.join(entry_dir, GENES_FILE), gene_table)
+    np.save(os.path.join(entry_dir, GENE_NAMES_FILE), name_table)
+    np.save(os.path.join(entry_dir, EXONS_FILE), exon_table)
+    np.save(os.path.join(entry_dir, CONTIG_OFFSETS_FILE), contig_offsets)
+    with open(os.path.join(entry_dir, CONTIGS_FILE), 'w') as f:
+        f.write("".join(c+"\n" for c in contigs))
+    with open(os.path.join(entry_dir, META_FILE), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'gtf': os.path.abspath(gtf), 'contigs': len(contigs), 'genes': len(gene_ids),
+                   'exons': len(exon_table), 'genes_without_transcript_id': int((~gene_table['has_transcript_id']).sum())},
+                  f, indent=1, sort_keys=True)
+    for name in os.listdir(entry_dir):
+        os.chmod(os.path.join(entry_dir, name), SHARED_FILE_MODE)
+
+
+def cached_entry(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, META_FILE), 'r') as f:
+            return json.load(f).get('version') == CACHE_VERSION
+    except (IOError, ValueError):
+        return False
+
+
+def open_annotation(gtf, cache_dir):
+    """
+    Returns the Annotation of the GTF, compiling it first if it is not in the cache
+    """
+    if not os.path.isfile(gtf):
+        raise IOError("The GTF file was not found: "+str(gtf))
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+            os.chmod(cache_dir, SHARED_DIR_MODE)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    entry_dir = os.path.join(cache_dir, gtf_checksum(gtf, cache_dir))
+    if not cached_entry(entry_dir):
+        sys.stderr.write("Compiling the annotation "+str(gtf)+" into "+str(entry_dir)+"\n")
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".compile.")
+        try:
+            os.chmod(tmp_dir, SHARED_DIR_MODE)
+            compile_gtf(gtf, tmp_dir)
+            if os.path.isdir(entry_dir):
+                #(an entry of an older version of the cache):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                #another pipeline compiled it first:
+                if not cached_entry(entry_dir):
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return Annotation(gtf, entry_dir)
+
+
+def reference_contigs(fasta):
+    """
+    The contigs of a FASTA file, from its .fai index.  Returns None if there is no index
+    """
+    try:
+        with open(fasta+".fai", 'r') as f:
+            return [line.split('\t', 1)[0] for line in f if line.strip()]
+    except IOError:
+        return None
+
+
+class Annotation:
+    """
+    The compiled tables of one GTF.  The tables are memory-mapped when first used
+    """
+    def __init__(self, gtf, entry_dir):
+        self.gtf = gtf
+        self.entry_dir = entry_dir
+        self._tables = {}
+        self._contigs = None
+
+    def table(self, name):
+        if name not in self._tables:
+            self._tables[name] = np.load(os.path.join(self.entry_dir, name), mmap_mode='r')
+        return self._tables[name]
+
+    @property
+    def contigs(self):
+        if self._contigs is None:
+            with open(self.contig_list(), 'r') as f:
+                self._contigs = [line.rstrip('\n') for line in f if line.strip()]
+        return self._contigs
+
+    def contig_list(self):
+        return os.path.join(self.entry_dir, CONTIGS_FILE)
+
+    def gene(self, gene_id):
+        """
+        The record (gene_id, gene_name, contig, start, end, strand, has_transcript_id) of a gene_id, or None
+        """
+        genes = self.table(GENES_FILE)
+        i = np.searchsorted(genes['gene_id'], gene_id)
+        if i < len(genes) and genes['gene_id'][i] == gene_id:
+            return genes[i]
+        return None
+
+    def gene_name(self, gene_id):
+        gene = self.gene(gene_id)
+        return None if gene is None else gene['gene_name']
+
+    def gene_ids(self, gene_name):
+        """
+        The gene_ids with the given gene_name (several genes may share a name)
+        """
+        names = self.table(GENE_NAMES_FILE)
+        start, end = np.searchsorted(names['gene_name'], gene_name, 'left'), np.searchsorted(names['gene_name'], gene_name, 'right')
+        return [self.table(GENES_FILE)['gene_id'][i] for i in names['gene'][start:end]]
+
+    def exons(self, contig, start, end):
+        """
+        The exons (rows of the exon table) that overlap contig:start-end
+        """
+        if contig not in self.contigs:
+            return self.table(EXONS_FILE)[0:0]
+        c = self.contigs.index(contig)
+        offsets = self.table(CONTIG_OFFSETS_FILE)
+        exons = self.table(EXONS_FILE)[offsets[c]:offsets[c+1]]
+        #exons are sorted by start, so only those starting before the end can overlap:
+        candidates = exons[:np.searchsorted(exons['start'], end, 'right')]
+        return candidates[candidates['end'] >= start]
+
+    def rna_seqc_gtf(self, fasta):
+        """
+        The path of the GTF for RNA-SeQC, which is written on first use: the records with a transcript_id (which RNA-SeQC
+        requires), on the contigs of the reference.  Raises IOError if the reference has no .fai index, since RNA-SeQC
+        fails on records from contigs that are not in the reference
+        """
+        contigs = reference_contigs(fasta)
+        if contigs is None:
+            raise IOError("The reference FASTA has no .fai index (samtools faidx): "+str(fasta))
+        key = hashlib.sha1("\n".join(contigs)).hexdigest()[:12]
+        path = os.path.join(self.entry_dir, RNA_SEQC_GTF_PREFIX+"."+key+".gtf")
+        if os.path.isfile(path):
+            return path
+        keep = set(contigs)
+        handle, tmp_file = tempfile.mkstemp(dir=self.entry_dir, prefix=".rna_seqc.")
+        with os.fdopen(handle, 'w') as out, open(self.gtf, 'r') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t', 8)
+                if len(fields) == 9 and fields[0] in keep and attribute(fields[8], 'transcript_id') is not None:
+                    out.write(line)
+        os.chmod(tmp_file, SHARED_FILE_MODE)
+        os.rename(tmp_file, path)
+        return path
+
+
+if __name__ == "__main__":
+
+    try:
+        gtf = os.environ['GTF']
+        cache_dir = os.environ['ANNOTATION_CACHE_DIR']
+    except KeyError as e:
+        sys.exit("Could not use the annotation cache.  Missing variable: "+str(e))
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ('compile', 'contigs', 'rna_seqc_gtf'):
+        sys.exit("Usage: annotation_cache.py compile | contigs | rna_seqc_gtf <fasta>")
+    try:
+        annotation = open_annotation(gtf, cache_dir)
+    except (IOError, OSError) as e:
+        sys.exit("Could not compile the annotation "+str(gtf)+": "+str(e))
+    if sys.argv[1] == 'contigs':
+        print annotation.contig_list()
+    elif sys.argv[1] == 'rna_seqc_gtf':
+        if len(sys.argv) < 3:
+            sys.exit("Usage: annotation_cache.py rna_seqc_gtf <fasta>")
+        try:
+            print annotation.rna_seqc_gtf(sys.argv[2])
+        except (IOError, OSError) as e:
+            sys.exit("Could not derive the GTF for RNA-SeQC: "+str(e))
@@ -0,0 +1,291 @@
+"""
+A store of alignments shared by all the projects run from this pipeline, so that the same FASTQs aligned again under a new
+project (e.g. with new contrasts, or a new grouping of the samples) are linked from the store rather than re-aligned:
+  -- an alignment is keyed by the fingerprints of its FASTQs and the settings that determine the BAM file: the aligner,
+     the assembly and genome index, the checksum of the GTF, whether STAR shares the genome (and so uses the junctions of
+     the index rather than the GTF), the checksum of the alignment templates (which hold the aligner's options),
+     de-duplication, paired reads and the read groups (which hold the sample name).  A FASTQ is fingerprinted by its size and the SHA-1 of its first and last megabyte (the end of a
+     gzip file holds the CRC-32 of all its contents), rather than by reading all of it
+  -- an entry holds the files of the alignment directory (the final BAM file, its index, the flagstat and duplication
+     metrics and the aligner's logs) and the count file of the sample.  prepare_align_script.py links them into the
+     alignment directory of a sample whose key is in the store (and the alignment is then skipped); check_for_bam.py and
+     count_reads.py add them to the store once they have been made
+  -- files are hard-linked where the store and the project are on the same file system, and otherwise copied into the
+     store and symbolically linked from it (a project linked to an entry that is later evicted is re-aligned when resumed).
+     A linked file is unlinked from the project before it is written again, so a re-run never modifies the store's copy
+  -- the least recently used entries are evicted once the files in the store exceed ARTIFACT_STORE_BUDGET_GB (checked by
+     shrink(), which the scripts call once they have added their files, since it looks at every entry)
+  -- the store is changed under a file lock, so several pipelines can use it at once.  Files are copied into the store
+     outside the lock and moved into their entry under it
+
+The key of a sample's alignment is written to its alignment directory (<sample>.artifact_key) by prepare_align_script.py.
+
+Run as a script (with ARTIFACT_STORE_DIR and ARTIFACT_STORE_BUDGET_GB in the environment):
+    artifact_store.py status      (prints the entries, least recently used first, and the size of the store)
+    artifact_store.py evict       (evicts entries until the store is within its budget)
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+STORE_VERSION = 1
+ENTRIES_DIR = "entries"
+TMP_DIR = "tmp"
+LOCK_FILE = "store.lock"
+#(touched whenever an entry is used, for the eviction of the least recently used entries):
+LAST_USED_FILE = "last_used"
+
+#the kinds of files in an entry:
+ALIGNMENT = "alignment"
+COUNTS = "counts"
+
+KEY_SUFFIX = ".artifact_key"
+
+#the bytes read from the start and the end of a FASTQ to fingerprint it:
+FINGERPRINT_BYTES = 1024*1024
+
+#temporary files older than this (in seconds) were left by a pipeline that was killed, and are removed on eviction:
+STALE_TMP_SECONDS = 24*60*60
+
+
+def fastq_fingerprint(path):
+    st = os.stat(path)
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        sha1.update(f.read(FINGERPRINT_BYTES))
+        if st.st_size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, st.st_size-FINGERPRINT_BYTES))
+            sha1.update(f.read())
+    return [st.st_size, sha1.hexdigest()]
+
+
+def alignment_key(fastqs, params):
+    """
+    The key of the alignment of the FASTQs (in the order they are given to the aligner) with the given settings
+    """
+    description = {'version': STORE_VERSION, 'fastqs': [fastq_fingerprint(f) for f in fastqs], 'params': params}
+    return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+
+def key_file(aln_dir, sample_name):
+    return os.path.join(aln_dir, str(sample_name)+KEY_SUFFIX)
+
+
+def read_key(aln_dir, sample_name):
+    try:
+        with open(key_file(aln_dir, sample_name), 'r') as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def write_key(aln_dir, sample_name, key):
+    if not os.path.isdir(aln_dir):
+        os.makedirs(aln_dir)
+    with open(key_file(aln_dir, sample_name), 'w') as f:
+        f.write(key+"\n")
+
+
+def replace_file(tmp_path, path):
+    #(a directory in the way is left alone):
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.remove(tmp_path)
+        return False
+    os.rename(tmp_path, path)
+    return True
+
+
+def link_file(source, target):
+    """
+    Links target to source (a hard link, or a symbolic link if they are on different file systems), replacing target
+    """
+    tmp_path = target+".link.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(source, tmp_path)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        os.symlink(source, tmp_path)
+    return replace_file(tmp_path, target)
+
+
+def files_in(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, n) for n in sorted(names) if os.path.isfile(os.path.join(directory, n))]
+
+
+def open_store(store_dir, budget_gb):
+    """
+    The store, or None if there is none (an empty ARTIFACT_STORE_DIR)
+    """
+    if not store_dir:
+        return None
+    return ArtifactStore(store_dir, budget_gb)
+
+
+class ArtifactStore:
+
+    def __init__(self, store_dir, budget_gb):
+        self.store_dir = store_dir
+        self.budget_bytes = budget_gb*1024**3
+        for d in (ENTRIES_DIR, TMP_DIR):
+            path = os.path.join(store_dir, d)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    if not os.path.isdir(path):
+                        raise
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.store_dir, LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def entry_dir(self, key):
+        return os.path.join(self.store_dir, ENTRIES_DIR, key)
+
+    def touch(self, key):
+        with open(os.path.join(self.entry_dir(key), LAST_USED_FILE), 'a'):
+            os.utime(os.path.join(self.entry_dir(key), LAST_USED_FILE), None)
+
+    def restore(self, key, kind, target_dir, required):
+        """
+        Links the files of this kind in the entry into target_dir, if the entry has the required file (e.g. the BAM).
+        Returns the linked files, or None if the entry is not in the store
+        """
+        with self.locked():
+            files = files_in(os.path.join(self.entry_dir(key), kind))
+            if not any(os.path.basename(f) == required for f in files):
+                return None
+            if not os.path.isdir(target_dir):
+                os.makedirs(target_dir)
+            linked = []
+            for f in files:
+                if link_file(f, os.path.join(target_dir, os.path.basename(f))):
+                    linked.append(os.path.join(target_dir, os.path.basename(f)))
+            self.touch(key)
+        return linked
+
+    def detach(self, key, kind, directory):
+        """
+        Unlinks the files in directory that are the store's files of this kind in the entry (before they are written again)
+        """
+        if key is None:
+            return
+        for f in files_in(os.path.join(self.entry_dir(key), kind)):
+            target = os.path.join(directory, os.path.basename(f))
+            try:
+                if os.path.lexists(target) and (os.path.islink(target) or os.path.samefile(f, target)):
+                    os.remove(target)
+            except OSError:
+                pass
+
+    def publish(self, key, kind, paths):
+        """
+        Adds the files to the entry (those it already holds are kept)
+        """
+        kind_dir = os.path.join(self.entry_dir(key), kind)
+        staged = []
+        try:
+            for path in paths:
+                stored = os.path.join(kind_dir, os.path.basename(path))
+                if os.path.isfile(stored) and os.path.samefile(stored, path):
+                    continue
+                #(a symbolic link is to another entry, or to files outside the project, so what it points to is copied):
+                handle, tmp_path = tempfile.mkstemp(dir=os.path.join(self.store_dir, TMP_DIR), prefix=os.path.basename(path)+".")
+                os.close(handle)
+                os.remove(tmp_path)
+                try:
+                    if os.path.islink(path):
+                        raise OSError(errno.EXDEV, "a symbolic link")
+                    os.link(path, tmp_path)
+                except OSError:
+                    shutil.copy2(path, tmp_path)
+                staged.append((tmp_path, stored))
+            with self.locked():
+                if not os.path.isdir(kind_dir):
+                    os.makedirs(kind_dir)
+                for tmp_path, stored in staged:
+                    os.rename(tmp_path, stored)
+                staged = []
+                self.touch(key)
+        finally:
+            for tmp_path, stored in staged:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+    def entries(self):
+        """
+        The entries as (last used, size in bytes, key), least recently used first
+        """
+        entries = []
+        entries_dir = os.path.join(self.store_dir, ENTRIES_DIR)
+        for key in os.listdir(entries_dir):
+            size = 0
+            for root, dirs, files in os.walk(os.path.join(entries_dir, key)):
+                size += sum(os.lstat(os.path.join(root, f)).st_size for f in files)
+            try:
+                last_used = os.path.getmtime(os.path.join(entries_dir, key, LAST_USED_FILE))
+            except OSError:
+                last_used = 0
+            entries.append((last_used, size, key))
+        return sorted(entries)
+
+    def shrink(self):
+        """
+        Removes the least recently used entries until the store is within its budget
+        """
+        with self.locked():
+            self.evict()
+
+    def evict(self):
+        #(called under the lock):
+        tmp_dir = os.path.join(self.store_dir, TMP_DIR)
+        for f in files_in(tmp_dir):
+            try:
+                if os.path.getmtime(f) < time.time()-STALE_TMP_SECONDS:
+                    os.remove(f)
+            except OSError:
+                pass
+        entries = self.entries()
+        total = sum(size for last_used, size, key in entries)
+        for last_used, size, key in entries:
+            if total <= self.budget_bytes:
+                break
+            shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            total -= size
+            print "Evicted entry "+str(key)+" ("+str(round(size/1024.0**3, 2))+" GB) from the artifact store"
+
+
+if __name__ == "__main__":
+
+    try:
+        store = ArtifactStore(os.environ['ARTIFACT_STORE_DIR'], float(os.environ['ARTIFACT_STORE_BUDGET_GB']))
+    except KeyError:
+        sys.exit("Could not open the artifact store.  Check that ARTIFACT_STORE_DIR and ARTIFACT_STORE_BUDGET_GB are set.")
+    action = sys.argv[1] if len(sys.argv) > 1 else None
+    if action == 'status':
+        entries = store.entries()
+        for last_used, size, key in entries:
+            print key+"\t"+time.strftime("%c", time.localtime(last_used))+"\t"+str(round(size/1024.0**3, 2))+" GB"
+        print str(len(entries))+" entries, "+str(round(sum(e[1] for e in entries)/1024.0**3, 2))+" GB of the "+\
+            str(round(store.budget_bytes/1024.0**3, 2))+" GB budget"
+    elif action == 'evict':
+        store.shrink()
+    else:
+        sys.exit("Usage: artifact_store.py <status|evict>")
@@ -0,0 +1,225 @@
+"""
+Times the pipeline on synthetic projects (see synthetic_project.py) of 10, 100, 1,000 and 10,000 samples, with the external
+tools (STAR, samtools, featureCounts, java and Rscript) replaced by the stubs in stub_tools/, which wait a configurable
+time (--latency, or STUB_<TOOL>_LATENCY in the environment) and write small, valid outputs.  So the times measure the
+pipeline's own work (scanning the project, scheduling, the python steps and the report) rather than the tools'.
+
+For each size:
+  -- the steps that run after the alignment are timed on a project with the outputs of a completed run:
+     prepare_align_script.py, check_for_bam.py, create_design_matrix.py and create_report.py, each run as the driver
+     runs it (with the environment of the configuration file)
+  -- the full driver (rnaseq_pipeline.sh) is timed on a project of FASTQs only, for sizes up to --driver-max
+The wall time, the CPU time (of the step and its child processes) and the exit status of each are written as JSON.
+
+Usage: python pipeline_benchmark.py [--sizes 10,100,1000,10000] [--driver-max 1000] [--latency 0] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import synthetic_project
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_HOME = os.path.dirname(BENCHMARK_DIR)
+STUB_TOOLS_DIR = os.path.join(BENCHMARK_DIR, 'stub_tools')
+CONFIG = os.path.join(PIPELINE_HOME, 'config.txt')
+ASSEMBLY = 'hg19'
+
+#the steps timed on the processed project, in the order the driver runs them:
+STEPS = [
+    ('prepare_align_script', 'prepare_align_script.py'),
+    ('check_for_bam', 'check_for_bam.py'),
+    ('create_design_matrix', 'create_design_matrix.py'),
+    ('create_report', os.path.join('report_files', 'create_report.py'))
+]
+
+
+def write_config(work_dir):
+    """
+    Copies the configuration file, pointing PIPELINE_HOME at this checkout and the artifact store into work_dir
+    """
+    config = os.path.join(work_dir, 'config.txt')
+    with open(CONFIG, 'r') as f, open(config, 'w') as out:
+        for line in f:
+            if line.startswith('PIPELINE_HOME='):
+                line = 'PIPELINE_HOME="'+PIPELINE_HOME+'"\n'
+            elif line.startswith('ARTIFACT_STORE_DIR='):
+                line = 'ARTIFACT_STORE_DIR="'+os.path.join(work_dir, 'artifact_store')+'"\n'
+            out.write(line)
+    return config
+
+
+def stub_environment(work_dir, latency, n_genes, n_reads):
+    env = dict(os.environ)
+    env['PATH'] = STUB_TOOLS_DIR+os.pathsep+env.get('PATH', '')
+    env['PIPELINE_PYTHON'] = sys.executable
+    env['STUB_LATENCY'] = str(latency)
+    env['STUB_GENES'] = str(n_genes)
+    env['STUB_READS'] = str(n_reads)
+    env['STUB_BAM'] = os.path.join(work_dir, 'stub.bam')
+    if not os.path.exists(env['STUB_BAM']):
+        synthetic_project.write_bam(env['STUB_BAM'], 'stub')
+    return env
+
+
+def config_environment(config, env):
+    """
+    The environment after sourcing the configuration file (as the driver does, with 'set -a')
+    """
+    output = subprocess.check_output(['bash', '-c', 'set -a; source "$0" >/dev/null; env -0', config], env=env)
+    return dict(item.split('=', 1) for item in output.split('\0') if '=' in item)
+
+
+def step_environment(config, env, paths):
+    """
+    The environment of the steps after the alignment, as the driver sets it up for a STAR alignment of paired reads
+    """
+    env = config_environment(config, env)
+    project_dir = paths['project_dir']
+    report_dir = os.path.join(project_dir, env['REPORT_DIR'])
+    counts_dir = os.path.join(report_dir, env['COUNTS_DIR'])
+    env.update({
+        'PROJECT_DIR': project_dir,
+        'ASSEMBLY': ASSEMBLY,
+        'GTF': paths['gtf'],
+        'PAIRED_READS': '1',
+        'ALIGNER': env['STAR'],
+        'SAMPLES_FILE': paths['samples_file'],
+        'CONTRAST_FILE': paths['contrast_file'],
+        'TARGET_BAM': env['BAM_EXTENSION'],
+        'DEDUP': '1',
+        'FINAL_BAM_SUFFIX': env['SORTED_DEDUPED_PRIMARY_BAM'],
+        'ALN_DIR_NAME': env['STAR_ALIGN_DIR'],
+        'ALIGN_SCRIPT': env['STAR_ALIGN_SCRIPT'],
+        'GENOME_INDEX': os.path.join(project_dir, 'STAR_INDEX'),
+        'TRANSCRIPTOME_INDEX': '',
+        'ALIGN_MEMORY_GB': '32',
+        'ALIGNER_REF_URL': env['STAR_REF_URL'],
+        'SKIP_ANALYSIS': '0',
+        'SKIP_RNA_QC': '0',
+        'TEST': '0',
+        'ALN': '1',
+        'PYTHON': sys.executable,
+        'VALID_SAMPLE_FILE': os.path.join(project_dir, env['VALID_SAMPLE_FILE']),
+        'DESIGN_MTX_FILE': os.path.join(project_dir, env['DESIGN_MTX_FILE']),
+        'REPORT_DIR': report_dir,
+        'COUNTS_DIR': counts_dir,
+        'RUN_TIMELINE_FILE': os.path.join(report_dir, env['RUN_TIMELINE_FILE']),
+        'FASTQ_STATS_FILE': os.path.join(report_dir, env['FASTQ_STATS_FILE']),
+        'NORMALIZED_COUNTS_FILE': os.path.join(counts_dir, env['NORMALIZED_COUNTS_FILE']),
+        'DESEQ_RESULT_DIR': os.path.join(report_dir, env['DESEQ_RESULT_DIR']),
+        'GSEA_OUTPUT_DIR': os.path.join(report_dir, env['GSEA_OUTPUT_DIR']),
+        'ANNOTATION_CACHE_DIR': os.path.join(os.path.dirname(project_dir), 'annotation_cache')
+    })
+    return env
+
+
+def timed_run(command, env, cwd, log_file):
+    """
+    Runs a command, with its output to log_file.  Returns (wall seconds, CPU seconds of the command, exit status)
+    """
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with open(log_file, 'w') as log:
+        returncode = subprocess.call(command, env=env, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.time()-start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime-before.ru_utime)+(after.ru_stime-before.ru_stime)
+    return round(wall, 3), round(cpu, 3), returncode
+
+
+def result(n_samples, args, step, wall, cpu, returncode, log_file):
+    print "%8d samples  %-22s %10.2f s wall %10.2f s CPU  (exit %d)" % (n_samples, step, wall, cpu, returncode)
+    if returncode != 0 and log_file:
+        with open(log_file, 'r') as f:
+            print "".join(f.readlines()[-10:])
+    return {'samples': n_samples, 'genes': args.genes, 'contrasts': args.contrasts, 'step': step,
+            'wall_seconds': wall, 'cpu_seconds': cpu, 'exit_code': returncode, 'log': log_file}
+
+
+def benchmark_steps(n_samples, args, work_dir, config, env):
+    results = []
+    start = time.time()
+    paths = synthetic_project.generate(work_dir, n_samples, args.genes, args.contrasts, args.reads, True)
+    results.append(result(n_samples, args, 'generate', round(time.time()-start, 3), 0.0, 0, None))
+
+    step_env = step_environment(config, env, paths)
+    #(the steps are run from the project directory, as the driver runs them from wherever it was started):
+    for step, script in STEPS:
+        log_file = os.path.join(work_dir, step+'.log')
+        wall, cpu, returncode = timed_run([sys.executable, os.path.join(PIPELINE_HOME, script)], step_env, paths['project_dir'], log_file)
+        results.append(result(n_samples, args, step, wall, cpu, returncode, log_file))
+    return results
+
+
+def benchmark_driver(n_samples, args, work_dir, config, env):
+    paths = synthetic_project.generate(work_dir, n_samples, args.genes, args.contrasts, args.reads, False)
+    command = ['bash', os.path.join(PIPELINE_HOME, 'rnaseq_pipeline.sh'), '-d', paths['project_dir'], '-g', ASSEMBLY,
+               '-o', os.path.join(work_dir, 'output'), '-s', paths['samples_file'], '-c', paths['contrast_file'],
+               '-config', config, '-paired']
+    log_file = os.path.join(work_dir, 'driver.log')
+    wall, cpu, returncode = timed_run(command, env, work_dir, log_file)
+    return [result(n_samples, args, 'rnaseq_pipeline', wall, cpu, returncode, log_file)]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PIPELINE_HOME, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Times the pipeline on synthetic projects, with stubs of the external tools')
+    parser.add_argument('--sizes', default='10,100,1000,10000', help='comma-separated numbers of samples')
+    parser.add_argument('--driver-max', type=int, default=1000, help='the largest project to run the full driver on')
+    parser.add_argument('--genes', type=int, default=1000)
+    parser.add_argument('--contrasts', type=int, default=2)
+    parser.add_argument('--reads', type=int, default=1000, help='reads per FASTQ file')
+    parser.add_argument('--latency', type=float, default=0, help='seconds that each call of a stub tool waits')
+    parser.add_argument('--work-dir', help='where the synthetic projects are written (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic projects and logs')
+    parser.add_argument('--output', default='pipeline_benchmark.json', help='the JSON file for the results')
+    args = parser.parse_args()
+
+    sizes = [int(x) for x in args.sizes.split(',')]
+    work_root = tempfile.mkdtemp(prefix='pipeline_benchmark.', dir=args.work_dir)
+    config = write_config(work_root)
+    env = stub_environment(work_root, args.latency, args.genes, args.reads)
+
+    results = []
+    try:
+        for n in sizes:
+            steps_dir = os.path.join(work_root, str(n), 'steps')
+            os.makedirs(steps_dir)
+            results.extend(benchmark_steps(n, args, steps_dir, config, env))
+            if n <= args.driver_max:
+                driver_dir = os.path.join(work_root, str(n), 'driver')
+                os.makedirs(driver_dir)
+                results.extend(benchmark_driver(n, args, driver_dir, config, env))
+            if not args.keep:
+                shutil.rmtree(os.path.join(work_root, str(n)))
+    finally:
+        report = {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0],
+            'commit': git_commit(),
+            'stub_latency_seconds': args.latency,
+            'work_dir': work_root if args.keep else None,
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        if not args.keep:
+            shutil.rmtree(work_root, ignore_errors=True)
+    print "Results written to "+args.output
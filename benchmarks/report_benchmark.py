@@ -0,0 +1,151 @@
+"""
+Times the assembly of the HTML report for synthetic projects of 10, 1,000 and 10,000 samples.
+
+Each synthetic sample has a pair of FASTQ files, a BAM file, a count file, an RNA-SeQC report and a FastQC report
+(as would be found by create_report.py), and there is one contrast (with DESeq output, heatmap and GSEA report) per 
+pair of samples.  The report is assembled with the ReportBuilder, and--for projects up to --legacy-max samples--also by 
+inserting each component one at a time into the growing document with the previous insert() (as the report was previously
+assembled), checking that both give the same report.  The size of the shell page of the lazy report mode (LazyReportBuilder), which should not
+grow with the project, is also given.
+
+Usage: python report_benchmark.py [--sizes 10,1000,10000] [--legacy-max 1000]
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_FILES_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), 'report_files')
+sys.path.append(REPORT_FILES_DIR)
+import create_report as cr
+
+TEMPLATE_HTML = os.path.join(REPORT_FILES_DIR, 'html_templates', 'base_template.html')
+TEMPLATE_ELEMENTS_DIR = os.path.join(REPORT_FILES_DIR, 'html_templates')
+TEMPLATE_ELEMENT_TAG = '.element'
+
+
+def synthetic_sections(n_samples):
+    """
+    Returns a list of (kind, tab text, section header, file dictionary, alias_link) in the order the report adds them
+    """
+    samples = ['S%05d' % i for i in range(n_samples)]
+    contrasts = [(samples[i], samples[i+1]) for i in range(0, n_samples-1, 2)]
+    fastq = dict((s, ['../Sample_%s/%s_R1.fastq.gz' % (s, s), '../Sample_%s/%s_R2.fastq.gz' % (s, s)]) for s in samples)
+    bam = dict((s, ['../Sample_%s/star_aln/%s.sort.dedup.primary.bam' % (s, s)]) for s in samples)
+    counts = dict((s, ['count_files/%s.dedup.counts' % s]) for s in samples)
+    norm_counts = {'normalized_counts.csv': ['normalized_counts.csv']}
+    rna_qc = dict((s, ['rna_seQC_reports/%s/report.html' % s]) for s in samples)
+    fastqc = dict((s, ['../Sample_%s/%s_R1_fastqc/fastqc_report.html' % (s, s)]) for s in samples)
+    deseq = dict((b+'_vs_'+a, ['deseq_results/%s_vs_%s.deseq.csv' % (b, a)]) for a, b in contrasts)
+    heatmaps = dict((b+'_vs_'+a, ['deseq_results/%s_vs_%s.heatmap.png' % (b, a)]) for a, b in contrasts)
+    gsea = dict((b+'_vs_'+a, ['gsea_results/%s_vs_%s.Gsea.1/index.html' % (b, a)]) for a, b in contrasts)
+    return [
+        ('links', 'FASTQ Files', 'Sequence files (FASTQ) in compressed format:', fastq, False),
+        ('links', 'BAM Files', 'Binary sequence alignment files (BAM)', bam, True),
+        ('links', 'Raw read-count Files', 'Raw (sample-level) sequence counts', counts, True),
+        ('links', 'Normalized read-count Files', 'Normalized count file', norm_counts, True),
+        ('accordion', 'RNA-Seq QC', 'RNA-Seq experiment quality reports', rna_qc, False),
+        ('accordion', 'FASTQC report', 'Sequencing quality reports', fastqc, False),
+        ('links', 'Differential Expression Analysis', 'Results from differential expression analysis', deseq, True),
+        ('accordion', 'Heatmaps', 'Heatmaps of the most highly expressed genes in each contrast', heatmaps, False),
+        ('accordion', 'GSEA', 'Gene-set enrichment analysis of each between-group contrast', gsea, False)
+    ]
+
+
+def build_report(main_html, template_dict, sections, report=None):
+    report = report or cr.ReportBuilder(main_html, template_dict)
+    for kind, tab_text, header, file_dict, alias_link in sections:
+        if kind == 'links':
+            cr.add_simple_link_content(report, tab_text, header, file_dict, alias_link=alias_link)
+        else:
+            cr.add_accordion_content(report, tab_text, header, file_dict)
+    return cr.unhide_analysis_help(report.serialize())
+
+
+def baseline_insert(main_text, pattern, new_text):
+    """
+    The insert() of create_report.py before the ReportBuilder (copied unchanged, so that the incremental report is
+    assembled independently of the insert_all that create_report.py now uses):
+    Inserts new_text into main_text and returns the modified main_text.  
+    The argument 'pattern' defines the boundaries of the text region into which new_text is inserted.
+    new_text is inserted as the last item in that region.
+    """
+    search_pattern = str(pattern) + ".*" + str(pattern) # greedy regex to grab the region of interest
+    m = re.search(search_pattern, main_text, flags=re.DOTALL) #get the section of text that matches our regex.
+    block_start = m.start()
+    block_end = m.end()
+
+    #this loops through the occurrences of 'pattern' in the extracted text block.  Upon exiting the loop,
+    # the variable pattern_match holds information about the last occurrence-- the end of our region.
+    for pattern_match in re.finditer(pattern, main_text[block_start:block_end], flags=re.DOTALL):
+        pass
+
+    index=block_start+pattern_match.start() #the location (in the original main_text) of that last occurrence of 'pattern'
+    return main_text[:index]+str(new_text)+main_text[index:] #insert the new text at that position and return.
+
+
+class IncrementalReport(cr.ReportBuilder):
+    """
+    Inserts every component, tab and section into the growing document as soon as it is created (with baseline_insert)
+    """
+    def add_navigation_tab(self, tab_text, id):
+        cr.ReportBuilder.add_navigation_tab(self, tab_text, id)
+        self.main_html = baseline_insert(self.main_html, cr.search_pattern(cr.TAB_SECTION), self.tabs.pop())
+
+    def add_section(self, tab_text, section_header, components):
+        id = tab_text.replace(" ", "_")
+        self.add_navigation_tab(tab_text, id)
+        content_template_text = self.template_dict[cr.tab_content]
+        content_template_text = re.sub(cr.ID, id, content_template_text)
+        content_template_text = re.sub(cr.SECTION_HEADER, section_header, content_template_text)
+        for component in components:
+            content_template_text = baseline_insert(content_template_text, cr.search_pattern(cr.REPEATING_COMPONENT), component)
+        self.main_html = baseline_insert(self.main_html, cr.search_pattern(cr.CONTENT_SECTION), content_template_text)
+
+
+def build_report_incrementally(main_html, template_dict, sections):
+    report = IncrementalReport(main_html, template_dict)
+    for kind, tab_text, header, file_dict, alias_link in sections:
+        if kind == 'links':
+            cr.add_simple_link_content(report, tab_text, header, file_dict, alias_link=alias_link)
+        else:
+            cr.add_accordion_content(report, tab_text, header, file_dict)
+    return cr.unhide_analysis_help(report.serialize())
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return result, time.time()-start
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Times the assembly of the HTML report for synthetic projects')
+    parser.add_argument('--sizes', default='10,1000,10000', help='comma-separated numbers of samples')
+    parser.add_argument('--legacy-max', type=int, default=1000, help='largest project to also assemble one insertion at a time')
+    args = parser.parse_args()
+
+    main_html = cr.read_file(TEMPLATE_HTML)
+    template_dict = cr.read_template_elements(TEMPLATE_ELEMENTS_DIR, TEMPLATE_ELEMENT_TAG)
+
+    lazy_dir = tempfile.mkdtemp()
+    print '%10s %14s %18s %12s %10s %18s %10s' % ('samples', 'report (KB)', 'incremental (s)', 'builder (s)', 'identical', 'lazy shell (KB)', 'lazy (s)')
+    for n in [int(x) for x in args.sizes.split(',')]:
+        sections = synthetic_sections(n)
+        html, builder_time = timed(build_report, main_html, template_dict, sections)
+        if n <= args.legacy_max:
+            legacy_html, legacy_time = timed(build_report_incrementally, main_html, template_dict, sections)
+            legacy_time = '%.3f' % legacy_time
+            identical = str(legacy_html == html)
+        else:
+            legacy_time, identical = '-', '-'
+        lazy_report = cr.LazyReportBuilder(main_html, template_dict, lazy_dir, 'report_manifest', 50)
+        shell_html, lazy_time = timed(build_report, main_html, template_dict, sections, lazy_report)
+        print '%10d %14d %18s %12.3f %10s %18d %10.3f' % (n, len(html)/1024, legacy_time, builder_time, identical, len(shell_html)/1024, lazy_time)
+    shutil.rmtree(lazy_dir)
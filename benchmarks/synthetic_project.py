@@ -0,0 +1,191 @@
+"""
+Writes a synthetic project for benchmarking the pipeline (see pipeline_benchmark.py), laid out as the pipeline expects:
+  -- a Sample_<name> directory per sample, with gzipped FASTQs (one lane, paired) and a SampleSheet.csv
+  -- the sample file and the contrast file (the samples are spread evenly over the conditions)
+  -- a GTF of the synthetic genes, on the one contig that the synthetic BAM files use
+With --processed, the outputs of a completed run are written too, for benchmarking the steps after the alignment:
+  -- a sorted, de-duplicated BAM file per sample (a valid header: SO:coordinate, a read group, the contig of the GTF),
+     with its index, flagstat outputs, the MarkDuplicates metrics and STAR's Log.final.out
+  -- a count file per sample (as count_reads.py writes them from featureCounts' tables), over --genes genes
+  -- RNA-SeQC and FastQC reports (an html page, and the metrics files read by qc_metrics.py)
+  -- the DESeq output, heatmap and GSEA report of each contrast
+
+Usage: python synthetic_project.py <output directory> [--samples 10] [--genes 1000] [--contrasts 2] [--reads 1000] [--processed]
+"""
+
+import os
+import sys
+import gzip
+import zlib
+import random
+import struct
+import argparse
+
+SAMPLE_DIR_PREFIX = "Sample_"
+ALIGN_DIR = "star_aln"
+REPORT_DIR = "output_report"
+BAM_SUFFIX = ".sort.dedup.primary.bam"
+COUNTFILE_SUFFIX = ".gene_name.counts.txt"
+CONTIG = "1"
+READ_LENGTH = 50
+
+#the reads are drawn from this many random sequences (generating every read would dominate the time for large projects):
+DISTINCT_READS = 256
+
+#the empty block that ends a BGZF file:
+BGZF_EOF = "1f8b08040000000000ff0600424302001b0003000000000000000000".decode('hex')
+
+
+def sample_names(n_samples):
+    return ['S%05d' % i for i in range(n_samples)]
+
+
+def conditions(n_samples, n_contrasts):
+    return ['cond%d' % i for i in range(max(2, min(n_samples, n_contrasts+1)))]
+
+
+def contrasts(n_samples, n_contrasts):
+    names = conditions(n_samples, n_contrasts)
+    return [(names[0], names[i % (len(names)-1)+1]) for i in range(n_contrasts)]
+
+
+def gene_names(n_genes):
+    return ['GENE%05d' % i for i in range(n_genes)]
+
+
+def bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data)+compressor.flush()
+    header = struct.pack("<4BI2BH", 31, 139, 8, 4, 0, 0, 255, 6)+"BC"+struct.pack("<HH", 2, len(compressed)+25)
+    return header+compressed+struct.pack("<iI", zlib.crc32(data), len(data))
+
+
+def write_bam(path, sample):
+    """
+    Writes a BAM file with a header (and no reads) that passes the checks of check_for_bam.py
+    """
+    text = "@HD\tVN:1.4\tSO:coordinate\n@SQ\tSN:"+CONTIG+"\tLN:1000000\n@RG\tID:"+sample+"\tSM:"+sample+"\tPL:ILLUMINA\n"
+    data = "BAM\1"+struct.pack("<i", len(text))+text+struct.pack("<i", 1)
+    data += struct.pack("<i", len(CONTIG)+1)+CONTIG+"\0"+struct.pack("<i", 1000000)
+    with open(path, 'wb') as f:
+        f.write(bgzf_block(data))
+        f.write(BGZF_EOF)
+
+
+def random_sequences():
+    return ["".join(random.choice("ACGT") for j in range(READ_LENGTH)) for i in range(DISTINCT_READS)]
+
+
+def write_fastq(path, sample, n_reads, mate, sequences):
+    quality = "I"*READ_LENGTH
+    with gzip.open(path, 'wb', 1) as f:
+        f.write("".join("@"+sample+":"+str(i)+" "+str(mate)+":N:0:ACGT\n"+sequences[i % len(sequences)]+"\n+\n"+quality+"\n"
+                        for i in range(n_reads)))
+
+
+def write_file(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def write_raw_sample(project_dir, sample, n_reads, sequences):
+    sample_dir = os.path.join(project_dir, SAMPLE_DIR_PREFIX+sample)
+    os.makedirs(sample_dir)
+    for mate in (1, 2):
+        write_fastq(os.path.join(sample_dir, sample+"_L001_R"+str(mate)+"_001.fastq.gz"), sample, n_reads, mate, sequences)
+    write_file(os.path.join(sample_dir, "SampleSheet.csv"),
+               "FCID,Lane,SampleID,SampleRef,Index,Description\nFCSYN,1,"+sample+",hg19,ACGT,synthetic\n")
+
+
+def write_processed_sample(project_dir, sample, genes, n_reads):
+    align_dir = os.path.join(project_dir, SAMPLE_DIR_PREFIX+sample, ALIGN_DIR)
+    os.makedirs(align_dir)
+    bam = os.path.join(align_dir, sample+BAM_SUFFIX)
+    write_bam(bam, sample)
+    write_file(bam+".bai", "")
+    mapped = int(n_reads*2*random.uniform(0.85, 0.97))
+    write_file(os.path.join(align_dir, "flagstat.raw.sorted.BAM.out"),
+               "%d + 0 in total (QC-passed reads + QC-failed reads)\n%d + 0 mapped (%.2f%% : N/A)\n" % (n_reads*2, mapped, 100.0*mapped/(n_reads*2)))
+    write_file(os.path.join(align_dir, "flagstat.dedupBAM.out"), "%d + 0 in total (QC-passed reads + QC-failed reads)\n" % int(mapped*0.8))
+    write_file(os.path.join(align_dir, sample+".sort.dedup.metrics.out"),
+               "## METRICS CLASS\tpicard.sam.DuplicationMetrics\nLIBRARY\tPERCENT_DUPLICATION\nUnknown\t%.4f\n" % random.uniform(0.1, 0.3))
+    write_file(os.path.join(align_dir, sample+".Log.final.out"),
+               "                   Number of input reads |\t%d\n                 Uniquely mapped reads %% |\t%.2f%%\n"
+               "      %% of reads mapped to multiple loci |\t%.2f%%\n               Mismatch rate per base, %% |\t0.30%%\n"
+               % (n_reads, random.uniform(80, 92), random.uniform(2, 6)))
+
+    report_dir = os.path.join(project_dir, REPORT_DIR)
+    write_file(os.path.join(report_dir, "count_files", sample+COUNTFILE_SUFFIX),
+               "".join(g+"\t"+str(random.randint(0, 5000))+"\n" for g in genes))
+    qc_dir = os.path.join(report_dir, "rna_seQC_reports", sample)
+    os.makedirs(qc_dir)
+    write_file(os.path.join(qc_dir, "report.html"), "<html><body>RNA-SeQC report of "+sample+"</body></html>\n")
+    write_file(os.path.join(qc_dir, "metrics.tsv"), "Sample\tExonic Rate\tIntronic Rate\tIntergenic Rate\trRNA rate\tGenes Detected\n"
+               "%s\t%.3f\t%.3f\t%.3f\t%.4f\t%d\n" % (sample, random.uniform(0.7, 0.9), 0.1, 0.05, 0.002, random.randint(12000, 16000)))
+    fastqc_dir = os.path.join(project_dir, SAMPLE_DIR_PREFIX+sample, sample+"_L001_R1_001_fastqc")
+    os.makedirs(fastqc_dir)
+    write_file(os.path.join(fastqc_dir, "fastqc_report.html"), "<html><body>FastQC report of "+sample+"</body></html>\n")
+    write_file(os.path.join(fastqc_dir, "fastqc_data.txt"), ">>Basic Statistics\tpass\nTotal Sequences\t%d\n%%GC\t%d\n>>END_MODULE\n"
+               % (n_reads, random.randint(45, 52)))
+
+
+def write_processed_contrast(report_dir, condition_a, condition_b):
+    contrast = condition_b+"_vs_"+condition_a
+    write_file(os.path.join(report_dir, "deseq_results", contrast+".deseq.csv"), "id,baseMean,log2FoldChange,pval,padj\n")
+    write_file(os.path.join(report_dir, "deseq_results", contrast+".heatmap.png"), "")
+    gsea_dir = os.path.join(report_dir, "gsea", contrast+".Gsea.1")
+    os.makedirs(gsea_dir)
+    write_file(os.path.join(gsea_dir, "index.html"), "<html><body>GSEA report of "+contrast+"</body></html>\n")
+
+
+def generate(output_dir, n_samples, n_genes, n_contrasts, n_reads, processed, seed=0):
+    """
+    Writes the project to output_dir/project (the sample and contrast files, and the GTF, are placed in output_dir).
+    Returns a dictionary of the paths
+    """
+    random.seed(seed)
+    project_dir = os.path.join(output_dir, "project")
+    os.makedirs(project_dir)
+    samples = sample_names(n_samples)
+    names = conditions(n_samples, n_contrasts)
+    genes = gene_names(n_genes)
+    sequences = random_sequences()
+
+    samples_file = os.path.join(output_dir, "samples.txt")
+    write_file(samples_file, "".join(s+"\t"+names[i % len(names)]+"\n" for i, s in enumerate(samples)))
+    contrast_file = os.path.join(output_dir, "contrasts.txt")
+    write_file(contrast_file, "".join(a+"\t"+b+"\n" for a, b in contrasts(n_samples, n_contrasts)))
+    gtf = os.path.join(output_dir, "genes.gtf")
+    write_file(gtf, "".join(CONTIG+"\tsynthetic\texon\t%d\t%d\t.\t+\t.\tgene_id \"%s\"; gene_name \"%s\"; transcript_id \"%s.1\";\n"
+                            % (i*1000+1, i*1000+500, g, g, g) for i, g in enumerate(genes)))
+
+    if processed:
+        report_dir = os.path.join(project_dir, REPORT_DIR)
+        for d in ("count_files", "rna_seQC_reports", "deseq_results", "gsea"):
+            os.makedirs(os.path.join(report_dir, d))
+    for sample in samples:
+        write_raw_sample(project_dir, sample, n_reads, sequences)
+        if processed:
+            write_processed_sample(project_dir, sample, genes, n_reads)
+    if processed:
+        for condition_a, condition_b in contrasts(n_samples, n_contrasts):
+            write_processed_contrast(report_dir, condition_a, condition_b)
+    return {'project_dir': project_dir, 'samples_file': samples_file, 'contrast_file': contrast_file, 'gtf': gtf}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Writes a synthetic project for benchmarking the pipeline')
+    parser.add_argument('output_dir', help='a directory (which must not exist) for the project')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--genes', type=int, default=1000)
+    parser.add_argument('--contrasts', type=int, default=2)
+    parser.add_argument('--reads', type=int, default=1000, help='reads per FASTQ file')
+    parser.add_argument('--processed', action='store_true', help='also write the outputs of a completed run')
+    args = parser.parse_args()
+
+    if os.path.exists(args.output_dir):
+        sys.exit("The output directory already exists: "+str(args.output_dir))
+    paths = generate(args.output_dir, args.samples, args.genes, args.contrasts, args.reads, args.processed)
+    for key in sorted(paths):
+        print key+"\t"+paths[key]
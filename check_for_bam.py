@@ -1,19 +1,200 @@
 """
-This script is run on aligned data-- 
+This script is run on aligned data--
   Given info about the project, look into the sample-specific directories and locate the bam files
   If the bam files do not exist, update the file containing the 'valid' samples, removing this sample
   In this way, we will not attempt to run a differential analysis on samples where we do not have the necessary data
   Additionally, we will not prepare a QC report for samples that do not have BAM files
+
+  The header of each bam file is also checked (if BAM_HEADER_CHECK is set), reading only the first BGZF blocks of the
+  file, so that a bam file the later steps cannot use is excluded here with a reason, rather than failing in RNA-SeQC:
+    -- the bam file must be sorted by coordinate (SO:coordinate in the @HD line)
+    -- it must have read groups (@RG lines), if RNA-SeQC will be run
+    -- its reference sequences must include contigs of the GTF (e.g. 'chr1' and '1' do not match)
+  Finally, any bam file without an index, or with an index older than the bam file, is indexed-- several at a time
+  (In a test run, where the bam files are empty placeholders, only their existence is checked)
+  The files of the alignments that pass (the bam file, its index and the alignment metrics) are then added to the artifact
+  store, if there is one, for other projects aligning the same FASTQs (see artifact_store.py)
 """
 
 import sys
 import os
+import zlib
+import struct
+import subprocess
+import multiprocessing
+
+from project_index import open_project_index
+from annotation_cache import open_annotation
+from artifact_store import open_store, files_in, read_key, key_file, ALIGNMENT
+
+BAM_MAGIC = "BAM\1"
+
+#the fixed part of a BGZF block header: the gzip header with the 'extra' flag set, then the length of the extra field
+BGZF_HEADER = struct.Struct("<4BI2BH")
+GZIP_ID = (31, 139, 8, 4)
+
+
+class BgzfReader:
+  """
+  Reads the decompressed data of a BGZF (blocked gzip) file, one block at a time, so only the blocks holding the bytes
+  asked for are decompressed
+  """
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.buffer = ""
+
+  def next_block(self):
+    header = self.fileobj.read(BGZF_HEADER.size)
+    if not header:
+      return None
+    if len(header) < BGZF_HEADER.size:
+      raise ValueError("truncated BGZF block header")
+    fields = BGZF_HEADER.unpack(header)
+    if fields[:4] != GZIP_ID:
+      raise ValueError("not a BGZF (blocked gzip) file")
+    extra = self.fileobj.read(fields[-1])
+    #the BGZF subfield ('BC') gives the size of the whole block, less one:
+    block_size = None
+    i = 0
+    while i+4 <= len(extra):
+      subfield_length = struct.unpack("<H", extra[i+2:i+4])[0]
+      if extra[i:i+2] == "BC" and subfield_length == 2:
+        block_size = struct.unpack("<H", extra[i+4:i+6])[0]+1
+      i += 4+subfield_length
+    if block_size is None:
+      raise ValueError("not a BGZF (blocked gzip) file")
+    rest = self.fileobj.read(block_size-BGZF_HEADER.size-len(extra))
+    if len(rest) < block_size-BGZF_HEADER.size-len(extra):
+      raise ValueError("truncated BGZF block")
+    crc, size = struct.unpack("<iI", rest[-8:])
+    try:
+      data = zlib.decompress(rest[:-8], -15)
+    except zlib.error as e:
+      raise ValueError("corrupt BGZF block ("+str(e)+")")
+    if len(data) != size or zlib.crc32(data) != crc:
+      raise ValueError("corrupt BGZF block (checksum mismatch)")
+    return data
+
+  def read(self, n):
+    while len(self.buffer) < n:
+      block = self.next_block()
+      if block is None:
+        raise ValueError("the file ends within the header")
+      self.buffer += block
+    data, self.buffer = self.buffer[:n], self.buffer[n:]
+    return data
+
+
+def read_bam_header(bam_file):
+  """
+  Returns the header text and the reference (contig) names of a bam file.  Raises ValueError if it cannot be read
+  """
+  with open(bam_file, 'rb') as f:
+    reader = BgzfReader(f)
+    if reader.read(4) != BAM_MAGIC:
+      raise ValueError("not a BAM file")
+    text_length = struct.unpack("<i", reader.read(4))[0]
+    text = reader.read(text_length).rstrip("\0")
+    num_references = struct.unpack("<i", reader.read(4))[0]
+    references = []
+    for i in range(num_references):
+      name_length = struct.unpack("<i", reader.read(4))[0]
+      references.append(reader.read(name_length).rstrip("\0"))
+      reader.read(4) #(the length of the reference)
+  return text, references
+
+
+def header_tags(text, record_type):
+  """
+  Returns the tags (as dictionaries) of each header line of the given type (e.g. '@RG')
+  """
+  lines = []
+  for line in text.splitlines():
+    fields = line.split('\t')
+    if fields[0] == record_type:
+      lines.append(dict(f.split(':', 1) for f in fields[1:] if ':' in f))
+  return lines
+
+
+def check_bam_header(bam_file, require_read_groups, contigs):
+  """
+  Returns the reason the bam file cannot be used, or None
+  """
+  try:
+    text, references = read_bam_header(bam_file)
+  except (IOError, ValueError, struct.error) as e:
+    return "Could not read the header of the BAM file "+str(bam_file)+": "+str(e)
+
+  hd = header_tags(text, '@HD')
+  sort_order = hd[0].get('SO', 'unknown') if hd else 'unknown'
+  if sort_order != 'coordinate':
+    return "The BAM file "+str(bam_file)+" is not sorted by coordinate (SO:"+sort_order+")"
+  if require_read_groups and not header_tags(text, '@RG'):
+    return "The BAM file "+str(bam_file)+" has no read groups (@RG), which RNA-SeQC requires"
+  if contigs and not contigs.intersection(references):
+    return "None of the contigs of the BAM file "+str(bam_file)+" ("+", ".join(references[:3])+"...) are in the GTF for this assembly"
+  return None
+
+
+def index_is_current(bam_file, index_file):
+  #(the modification times of the files that the links point to):
+  try:
+    return os.path.getmtime(index_file) >= os.path.getmtime(bam_file)
+  except OSError:
+    return False
 
 
-def main(valid_sample_file, project_dir, sample_dir_prefix, align_dir_name, bam_suffix):
+def index_bam(bam_file):
+  """
+  Indexes a bam file (as it is run by a process pool).  Returns (bam file, error message or None)
+  """
+  process = subprocess.Popen(['samtools', 'index', bam_file], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = process.communicate()[0]
+  if process.returncode != 0:
+    return bam_file, "Could not index the BAM file "+str(bam_file)+": "+output.strip()
+  return bam_file, None
+
+
+def index_bams(bam_files, index_extension, workers):
+  """
+  Indexes the bam files (several at a time), replacing any stale index (or a link to one).  Returns {bam file: reason}
+  for those that could not be indexed
+  """
+  if not bam_files:
+    return {}
+  for bam_file in bam_files:
+    if os.path.lexists(bam_file+index_extension):
+      os.remove(bam_file+index_extension)
+  workers = max(1, min(workers, len(bam_files)))
+  print "Indexing "+str(len(bam_files))+" BAM files, "+str(workers)+" at a time"
+  pool = multiprocessing.Pool(workers)
+  try:
+    results = pool.map(index_bam, bam_files, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  return dict((bam_file, error) for bam_file, error in results if error)
+
+
+def publish_alignments(store, bam_files):
+  """
+  Adds the files of the alignment directories (of the samples whose key prepare_align_script.py recorded) to the artifact store
+  """
+  for sample in sorted(bam_files):
+    align_dir = os.path.dirname(bam_files[sample])
+    key = read_key(align_dir, sample)
+    if key is not None:
+      store.publish(key, ALIGNMENT, [f for f in files_in(align_dir) if f != key_file(align_dir, sample)])
+  store.shrink()
+
+
+def main(valid_sample_file, project_dir, sample_dir_prefix, align_dir_name, bam_suffix, project_index_file, header_check, require_read_groups, gtf, annotation_cache_dir, index_extension, index_workers, artifact_store, test):
+
+  project_index = open_project_index(project_dir, project_index_file)
 
   #read the file that has the valid samples-- check that the bam files actually exist:
   valid_samples = []
+  bam_files = {}
   try:
     with open(valid_sample_file, 'r') as vsf:
       for line in vsf:
@@ -23,18 +204,51 @@ def main(valid_sample_file, project_dir, sample_dir_prefix, align_dir_name, bam_
         align_dir = os.path.join(sample_dir, align_dir_name)
 
         #check that this sample has a bam file:
-        if os.path.exists(os.path.join(align_dir, str(sample)+str(bam_suffix))):
+        bam_file = os.path.join(align_dir, str(sample)+str(bam_suffix))
+        if project_index.exists(bam_file):
           valid_samples.append(sample_condition_tuple)
+          bam_files[sample] = bam_file
         else:
           print "BAM or count file was not found for sample "+str(sample)+".  Perhaps the alignment failed?"
+  except IOError:
+    sys.exit("I/O exception when reading the valid samples file: "+str(valid_sample_file))
 
-    #rewrite the valid sample file to reflect the valid data:
+  #check the headers (looking up the contigs of the GTF, in the annotation cache, only if there are bam files to compare them with):
+  failed = {}
+  if header_check and bam_files and not test:
+    contigs = None
+    if gtf:
+      try:
+        contigs = set(open_annotation(gtf, annotation_cache_dir).contigs)
+      except (IOError, OSError):
+        print "(Warning) Could not read the GTF file "+str(gtf)+", so the contigs of the BAM files are not checked."
+    for sample, bam_file in bam_files.items():
+      reason = check_bam_header(bam_file, require_read_groups, contigs)
+      if reason:
+        failed[sample] = reason
+
+  #index the bam files that need it:
+  to_index = [] if test else [bam_files[s] for s in sorted(bam_files) if s not in failed and not index_is_current(bam_files[s], bam_files[s]+index_extension)]
+  index_errors = index_bams(to_index, index_extension, index_workers)
+  for sample, bam_file in bam_files.items():
+    if bam_file in index_errors:
+      failed[sample] = index_errors[bam_file]
+
+  for sample in sorted(failed):
+    print "(Warning) Excluding sample "+str(sample)+".  "+failed[sample]
+
+  if artifact_store is not None and not test:
+    publish_alignments(artifact_store, dict((s, bam_files[s]) for s in bam_files if s not in failed))
+
+  #rewrite the valid sample file to reflect the valid data:
+  try:
     with open(valid_sample_file, 'w') as vsf:
       for sample, condition in valid_samples:
-        vsf.write(str(sample)+"\t"+str(condition)+"\n")
+        if sample not in failed:
+          vsf.write(str(sample)+"\t"+str(condition)+"\n")
   except IOError:
-    sys.exit("I/O exception when reading the valid samples file: "+str(valid_sample_file))
-       
+    sys.exit("I/O exception when writing the valid samples file: "+str(valid_sample_file))
+
 if __name__=="__main__":
 
   try:
@@ -43,9 +257,19 @@ if __name__=="__main__":
     sample_dir_prefix = os.environ['SAMPLE_DIR_PREFIX']
     align_dir_name = os.environ['ALN_DIR_NAME']
     bam_suffix = str(os.environ['FINAL_BAM_SUFFIX'])
-    
-    main(valid_sample_file, project_dir, sample_dir_prefix, align_dir_name, bam_suffix)
+    project_index_file = os.environ['PROJECT_INDEX_FILE']
+    header_check = int(os.environ['BAM_HEADER_CHECK']) == 1
+    #(read groups are only needed by RNA-SeQC):
+    require_read_groups = int(os.environ['SKIP_RNA_QC']) == 0
+    gtf = os.environ['GTF']
+    annotation_cache_dir = os.environ['ANNOTATION_CACHE_DIR']
+    index_extension = os.environ['BAM_IDX_EXTENSION']
+    requested_workers = int(os.environ['BAM_INDEX_WORKERS'])
+    index_workers = requested_workers if requested_workers > 0 else multiprocessing.cpu_count()
+    artifact_store = open_store(os.environ['ARTIFACT_STORE_DIR'], float(os.environ['ARTIFACT_STORE_BUDGET_GB']))
+    test = int(os.environ['TEST']) == 1
+
+    main(valid_sample_file, project_dir, sample_dir_prefix, align_dir_name, bam_suffix, project_index_file, header_check, require_read_groups, gtf, annotation_cache_dir, index_extension, index_workers, artifact_store, test)
 
   except KeyError:
     sys.exit("There was an error in the script while checking for BAM files.")
-
@@ -0,0 +1,176 @@
+"""
+This script builds the count matrix store for the project from the read-count files of the samples in the design matrix
+   -- for each sample, the two-column (gene, count) count file listed in the design matrix is read (a single-sample
+      featureCounts table is read too)
+   -- the files are read line-by-line and joined into a single gene x sample matrix of integer counts.
+      As before, only genes that are counted in every sample are kept (an inner join).  Genes are sorted by name.
+   -- the store is a directory holding the matrix as a numpy array (memory-mapped when read), the genes and the samples
+   -- a CSV of the full matrix is exported from the store, for the R scripts and the report
+"""
+
+import os
+import sys
+import shutil
+import numpy as np
+
+from count_reads import FEATURECOUNTS_HEADER, FEATURECOUNTS_COUNT_COL
+
+COUNTS_FILE = "counts.npy"
+GENES_FILE = "genes.txt"
+SAMPLES_FILE = "samples.txt"
+
+COUNT_DTYPE = np.uint32
+
+#the matrix is copied/written this many genes at a time:
+ROW_CHUNK = 4096
+
+
+def read_counts(count_file):
+    """
+    Yields (gene, count) for each line of a single-sample featureCounts table (whose count is its final column) or of a
+    two-column count file
+    """
+    with open(count_file, 'r') as f:
+        for line in f:
+            if line.startswith('#') or line.startswith(FEATURECOUNTS_HEADER):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > FEATURECOUNTS_COUNT_COL:
+                yield fields[0].strip('"'), int(fields[FEATURECOUNTS_COUNT_COL])
+            elif len(fields) > 1:
+                yield fields[0].strip('"'), int(fields[1])
+
+
+def read_design_matrix(design_mtx_file):
+    """
+    Returns a list of (sample, count file, condition) tuples from the design matrix (which has a header line)
+    """
+    try:
+        with open(design_mtx_file, 'r') as dm:
+            rows = [tuple(line.strip().split('\t')) for line in dm.readlines()[1:] if line.strip()]
+        return [(sample, count_file, condition) for sample, count_file, condition in rows]
+    except IOError:
+        sys.exit("Could not open the design matrix: "+str(design_mtx_file))
+
+
+def build_count_matrix(store_dir, samples):
+    """
+    Builds the store from a list of (sample, condition, count file) tuples.  The genes are taken from the first
+    count file; each file is read once, straight into its column of an on-disk matrix.
+    """
+    tmp_dir = store_dir+".tmp"
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    genes = []
+    gene_index = {}
+    for gene, count in read_counts(samples[0][2]):
+        if gene not in gene_index:
+            gene_index[gene] = len(genes)
+            genes.append(gene)
+
+    unsorted_file = os.path.join(tmp_dir, "unsorted_"+COUNTS_FILE)
+    unsorted = np.lib.format.open_memmap(unsorted_file, mode='w+', dtype=COUNT_DTYPE, shape=(len(genes), len(samples)))
+    in_all_samples = np.ones(len(genes), dtype=bool)
+    for j, (sample, condition, count_file) in enumerate(samples):
+        column = np.zeros(len(genes), dtype=np.int64)
+        counted = np.zeros(len(genes), dtype=bool)
+        for gene, count in read_counts(count_file):
+            i = gene_index.get(gene)
+            if i is not None:
+                column[i] = count
+                counted[i] = True
+        if column.size and (column.min() < 0 or column.max() > np.iinfo(COUNT_DTYPE).max):
+            sys.exit("Read counts for sample "+str(sample)+" (in "+str(count_file)+") are out of range.")
+        unsorted[:, j] = column
+        in_all_samples &= counted
+
+    #keep the genes common to all samples, in sorted order:
+    rows = sorted(np.flatnonzero(in_all_samples), key=lambda i: genes[i])
+    counts = np.lib.format.open_memmap(os.path.join(tmp_dir, COUNTS_FILE), mode='w+', dtype=COUNT_DTYPE, shape=(len(rows), len(samples)))
+    for start in range(0, len(rows), ROW_CHUNK):
+        counts[start:start+ROW_CHUNK] = unsorted[rows[start:start+ROW_CHUNK]]
+    counts.flush()
+    del counts, unsorted
+    os.remove(unsorted_file)
+
+    with open(os.path.join(tmp_dir, GENES_FILE), 'w') as f:
+        f.write("".join(genes[i]+"\n" for i in rows))
+    with open(os.path.join(tmp_dir, SAMPLES_FILE), 'w') as f:
+        f.write("".join(str(sample)+"\t"+str(condition)+"\n" for sample, condition, count_file in samples))
+
+    #replace any previous store:
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    return CountMatrix(store_dir)
+
+
+class CountMatrix:
+    """
+    A count matrix store, opened for reading.  'counts' is a (memory-mapped) genes x samples array
+    """
+    def __init__(self, store_dir):
+        try:
+            with open(os.path.join(store_dir, GENES_FILE), 'r') as f:
+                self.genes = [line.rstrip('\n') for line in f]
+            with open(os.path.join(store_dir, SAMPLES_FILE), 'r') as f:
+                rows = [line.rstrip('\n').split('\t') for line in f]
+            self.samples = [r[0] for r in rows]
+            self.conditions = [r[1] for r in rows]
+            self.counts = np.load(os.path.join(store_dir, COUNTS_FILE), mmap_mode='r')
+        except IOError:
+            sys.exit("Could not open the count matrix at "+str(store_dir))
+        self.gene_index = dict((g, i) for i, g in enumerate(self.genes))
+        self.sample_index = dict((s, j) for j, s in enumerate(self.samples))
+
+    def column(self, sample):
+        return self.counts[:, self.sample_index[sample]]
+
+    def select(self, samples):
+        """
+        Returns the (in-memory) genes x samples matrix for the given samples, in the order given
+        """
+        return np.asarray(self.counts[:, [self.sample_index[s] for s in samples]])
+
+    def export_csv(self, csv_file, samples=None):
+        """
+        Writes the matrix (or the columns of the given samples) as a CSV with the genes as row names, in the format of R's write.csv
+        """
+        samples = samples or self.samples
+        columns = [self.sample_index[s] for s in samples]
+        with open(csv_file, 'w') as f:
+            f.write('""'+"".join(',"'+str(s)+'"' for s in samples)+"\n")
+            for start in range(0, len(self.genes), ROW_CHUNK):
+                block = self.counts[start:start+ROW_CHUNK][:, columns].tolist()
+                f.write("".join('"'+g+'",'+",".join(map(str, row))+"\n" for g, row in zip(self.genes[start:start+ROW_CHUNK], block)))
+
+
+def main(design_mtx_file, store_dir, raw_count_matrix_file):
+    design = read_design_matrix(design_mtx_file)
+    if not design:
+        sys.exit("There are no samples in the design matrix ("+str(design_mtx_file)+"), so there are no counts to combine.")
+
+    samples = []
+    for sample, count_file, condition in design:
+        if not os.path.isfile(count_file):
+            sys.exit("Could not find the read counts for sample "+str(sample)+" at "+str(count_file))
+        samples.append((sample, condition, count_file))
+
+    count_matrix = build_count_matrix(store_dir, samples)
+    print "Combined the counts of "+str(len(count_matrix.samples))+" samples over "+str(len(count_matrix.genes))+" genes."
+    count_matrix.export_csv(raw_count_matrix_file)
+
+
+if __name__ == "__main__":
+
+    try:
+        design_mtx_file = os.environ['DESIGN_MTX_FILE']
+        store_dir = os.environ['COUNT_MATRIX_DIR']
+        raw_count_matrix_file = os.environ['RAW_COUNT_MATRIX_FILE']
+
+        main(design_mtx_file, store_dir, raw_count_matrix_file)
+
+    except KeyError:
+        sys.exit("Failed at building the count matrix.  Check the environment variables.")
@@ -0,0 +1,130 @@
+"""
+This script counts the reads in the BAM files of the valid samples with featureCounts
+   -- rather than one featureCounts call per sample (each of which parses the GTF again), the BAM files are passed to
+      featureCounts in batches of FEATURECOUNTS_BATCH_SIZE, counted with multiple threads (FEATURECOUNTS_THREADS;
+      zero means all the cpus on this host)
+   -- featureCounts writes one table per batch, with a column of counts for each BAM file.  The table is read line-by-line
+      and split into the two-column (gene, count) count file of each sample: $COUNTS_DIR/<sample>$COUNTFILE_SUFFIX
+   -- the count file of a sample whose alignment is in the artifact store (see artifact_store.py) is linked from the store
+      if it is there, rather than counted again; the count files that are made are added to the store
+"""
+
+import os
+import sys
+import subprocess
+import multiprocessing
+
+from stage_executor import read_valid_samples
+from artifact_store import open_store, read_key, COUNTS
+
+#featureCounts tables start with a comment line and a header line (starting with 'Geneid').
+#The gene is in the first column and the counts of the BAM files (in the order given) start at the seventh:
+FEATURECOUNTS_HEADER = "Geneid"
+FEATURECOUNTS_COUNT_COL = 6
+
+#featureCounts will not use more threads than this:
+MAX_THREADS = 64
+
+BATCH_TABLE = "featureCounts.batch%d.txt"
+
+
+def resolve_threads(requested_threads):
+    threads = requested_threads if requested_threads > 0 else multiprocessing.cpu_count()
+    return max(1, min(threads, MAX_THREADS))
+
+
+def make_batches(items, batch_size):
+    #(a batch size of zero means 'all the items in one batch'):
+    if not items:
+        return []
+    batch_size = batch_size if batch_size > 0 else len(items)
+    return [items[i:i+batch_size] for i in range(0, len(items), batch_size)]
+
+
+def split_counts(table, count_files):
+    """
+    Splits a featureCounts table (with one count column per file in count_files, in order) into two-column count files
+    """
+    outputs = [open(f, 'w') for f in count_files]
+    try:
+        with open(table, 'r') as t:
+            for line in t:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != FEATURECOUNTS_COUNT_COL+len(outputs):
+                    sys.exit("Unexpected featureCounts output in "+str(table)+" (expected "+str(len(outputs))+" count columns): "+line)
+                if fields[0] == FEATURECOUNTS_HEADER:
+                    continue
+                gene = fields[0]
+                for out, count in zip(outputs, fields[FEATURECOUNTS_COUNT_COL:]):
+                    out.write(gene+"\t"+count+"\n")
+    finally:
+        for out in outputs:
+            out.close()
+
+
+def count_batch(batch_number, batch, gtf, threads, counts_dir):
+    """
+    Runs featureCounts on a batch of (sample, bam file, count file) and writes the count files
+    """
+    table = os.path.join(counts_dir, BATCH_TABLE % batch_number)
+    command = ["featureCounts", "-T", str(threads), "-a", gtf, "-o", table, "-t", "exon", "-g", "gene_name"]+[bam for sample, bam, count_file in batch]
+    print "Counting reads for "+", ".join(sample for sample, bam, count_file in batch)+" with "+str(threads)+" threads"
+    sys.stdout.flush()
+    if subprocess.call(command) != 0:
+        sys.exit("featureCounts failed on the batch of samples: "+", ".join(sample for sample, bam, count_file in batch))
+    split_counts(table, [count_file for sample, bam, count_file in batch])
+    for f in (table, table+".summary"):
+        if os.path.isfile(f):
+            os.remove(f)
+
+
+def main(valid_sample_file, project_dir, sample_dir_prefix, aln_dir_name, final_bam_suffix, gtf, counts_dir, countfile_suffix, batch_size, threads, artifact_store):
+    to_count = []
+    keys = {}
+    for sample, condition in read_valid_samples(valid_sample_file):
+        aln_dir = os.path.join(project_dir, sample_dir_prefix+sample, aln_dir_name)
+        bam = os.path.join(aln_dir, sample+final_bam_suffix)
+        count_file = os.path.join(counts_dir, sample+countfile_suffix)
+        if not os.path.isfile(bam):
+            print "(Warning) Could not find the BAM file for sample "+str(sample)+" at "+str(bam)+".  Its reads will not be counted."
+            continue
+        keys[sample] = read_key(aln_dir, sample) if artifact_store is not None else None
+        if keys[sample] is not None and artifact_store.restore(keys[sample], COUNTS, counts_dir, os.path.basename(count_file)) is not None:
+            print "The read counts of sample "+str(sample)+" are in the artifact store.  Linked "+str(count_file)
+            continue
+        #(an earlier count file may be linked from the artifact store, whose copy must not be written over):
+        if os.path.lexists(count_file):
+            os.remove(count_file)
+        to_count.append((sample, bam, count_file))
+
+    threads = resolve_threads(threads)
+    for batch_number, batch in enumerate(make_batches(to_count, batch_size)):
+        count_batch(batch_number, batch, gtf, threads, counts_dir)
+        for sample, bam, count_file in batch:
+            if keys[sample] is not None:
+                artifact_store.publish(keys[sample], COUNTS, [count_file])
+    if artifact_store is not None and to_count:
+        artifact_store.shrink()
+
+
+if __name__ == "__main__":
+
+    try:
+        valid_sample_file = os.environ['VALID_SAMPLE_FILE']
+        project_dir = os.environ['PROJECT_DIR']
+        sample_dir_prefix = os.environ['SAMPLE_DIR_PREFIX']
+        aln_dir_name = os.environ['ALN_DIR_NAME']
+        final_bam_suffix = os.environ['FINAL_BAM_SUFFIX']
+        gtf = os.environ['GTF']
+        counts_dir = os.environ['COUNTS_DIR']
+        countfile_suffix = os.environ['COUNTFILE_SUFFIX']
+        batch_size = int(os.environ['FEATURECOUNTS_BATCH_SIZE'])
+        threads = int(os.environ['FEATURECOUNTS_THREADS'])
+        artifact_store = open_store(os.environ['ARTIFACT_STORE_DIR'], float(os.environ['ARTIFACT_STORE_BUDGET_GB']))
+
+        main(valid_sample_file, project_dir, sample_dir_prefix, aln_dir_name, final_bam_suffix, gtf, counts_dir, countfile_suffix, batch_size, threads, artifact_store)
+
+    except KeyError:
+        sys.exit("Failed at counting reads.  Check the environment variables.")
@@ -6,13 +6,15 @@ This script prepares a design matrix for use with the differential analysis
 
 import sys
 import os
-import glob
 
+from project_index import open_project_index
 
-def main(valid_sample_file, design_mtx_file, project_dir, countfile_dir, countfile_suffix):
+
+def main(valid_sample_file, design_mtx_file, project_dir, countfile_dir, countfile_suffix, project_index_file):
 
   #read the file that has the valid samples-- check that the count files actually exist:
   countfile_dir = os.path.join(project_dir, countfile_dir)
+  project_index = open_project_index(project_dir, project_index_file)
   valid_samples = []
   with open(design_mtx_file, 'w') as design_file:
     design_file.write("sample\tfile\tcondition\n")
@@ -25,8 +27,8 @@ def main(valid_sample_file, design_mtx_file, project_dir, countfile_dir, countfi
           condition = sample_condition_tuple[1]
 
           #check that this sample has a count file:
-          cf = glob.glob(os.path.join(countfile_dir, str(sample))+"*"+str(countfile_suffix))[0]
-          if os.path.isfile(cf):
+          cf = os.path.join(countfile_dir, str(sample)+str(countfile_suffix))
+          if project_index.isfile(cf):
             design_file.write(str(sample)+"\t"+str(cf)+"\t"+str(condition)+"\n")
     except IOError:
       sys.exit("Could not open the sample file: "+str(valid_sample_file))        
@@ -39,8 +41,9 @@ if __name__=="__main__":
     project_dir = os.environ['PROJECT_DIR']
     countfile_dir = os.environ['COUNTS_DIR']
     countfile_suffix = os.environ['COUNTFILE_SUFFIX']
+    project_index_file = os.environ['PROJECT_INDEX_FILE']
     
-    main(valid_sample_file, design_mtx_file, project_dir, countfile_dir, countfile_suffix)
+    main(valid_sample_file, design_mtx_file, project_dir, countfile_dir, countfile_suffix, project_index_file)
 
   except KeyError:
     sys.exit("Failed at creating design matrix for differential expression analysis.")
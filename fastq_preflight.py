@@ -0,0 +1,191 @@
+"""
+Checks the FASTQ files of the samples before any alignment is started, so that a corrupt or mismatched file fails at once
+(with a reason) rather than hours later in the aligner:
+   -- every FASTQ is decompressed in full (with pigz, if available), which verifies the gzip checksums and catches
+      truncated files
+   -- the reads are counted; the two FASTQs of each lane of a paired sample must have the same number of reads, with the
+      same read names in the same order
+   -- the reads, bases and read lengths of each lane are recorded
+The lanes are checked in parallel (FASTQ_PREFLIGHT_WORKERS at a time).  The results are saved in FASTQ_STATS_FILE (read by
+the QC metrics of the report), where they are also reused on a re-run for FASTQs that have not changed.
+"""
+
+import os
+import json
+import subprocess
+import multiprocessing
+
+from shard_fastq import records, read_name
+
+STATS_VERSION = 1
+
+
+def decompress_command(fastq):
+    for tool in ('pigz', 'gzip'):
+        if any(os.access(os.path.join(d, tool), os.X_OK) for d in os.environ.get('PATH', '').split(os.pathsep)):
+            return [tool, '-dc', fastq]
+    return ['gzip', '-dc', fastq]
+
+
+def signature(path):
+    st = os.stat(path)
+    return [path, st.st_size, int(st.st_mtime)]
+
+
+def lane_key(fastq_a, fastq_b):
+    return str(fastq_a)+"|"+str(fastq_b or "")
+
+
+class ReadStats:
+    """
+    The reads, bases and read lengths of one FASTQ
+    """
+    def __init__(self):
+        self.reads = 0
+        self.bases = 0
+        self.min_length = None
+        self.max_length = 0
+
+    def add(self, record):
+        length = len(record[1].rstrip('\r\n'))
+        self.reads += 1
+        self.bases += length
+        self.max_length = max(self.max_length, length)
+        if self.min_length is None or length < self.min_length:
+            self.min_length = length
+
+    def as_dict(self):
+        return {'reads': self.reads, 'bases': self.bases, 'min_length': self.min_length or 0, 'max_length': self.max_length}
+
+
+def check_lane(args):
+    """
+    Reads a lane in full (args is (fastq_a, fastq_b or None), as it is run by a process pool).
+    Returns (lane key, statistics dictionary, error message or None)
+    """
+    fastq_a, fastq_b = args
+    readers = [subprocess.Popen(decompress_command(f), stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=-1)
+               for f in (fastq_a, fastq_b) if f]
+    stats = [ReadStats() for r in readers]
+    error = None
+    try:
+        streams = [records(r.stdout) for r in readers]
+        if fastq_b:
+            n = 0
+            while True:
+                record_a = next(streams[0], None)
+                record_b = next(streams[1], None)
+                if record_a is None or record_b is None:
+                    if record_a is not None or record_b is not None:
+                        error = "The read 1 and read 2 FASTQs have different numbers of reads (after "+str(n)+" reads)"
+                    break
+                n += 1
+                if read_name(record_a[0]) != read_name(record_b[0]):
+                    error = "The read names differ at read "+str(n)+": "+record_a[0].strip()+" and "+record_b[0].strip()
+                    break
+                stats[0].add(record_a)
+                stats[1].add(record_b)
+        else:
+            for record in streams[0]:
+                stats[0].add(record)
+    except ValueError as e:
+        error = str(e)
+    finally:
+        for r in readers:
+            r.stdout.close()
+        messages = [(f, r.wait(), r.stderr.read().strip()) for f, r in zip((fastq_a, fastq_b), readers)]
+    #a reader that was stopped early (by an error found above) fails too, so its exit only matters if there was no other error:
+    if error is None:
+        for f, returncode, message in messages:
+            if returncode != 0:
+                error = "Could not decompress "+str(f)+" (corrupt or truncated gzip file): "+message
+                break
+    if error is None and stats[0].reads == 0:
+        error = "No reads in "+str(fastq_a)
+
+    result = {'fastq_a': fastq_a, 'fastq_b': fastq_b, 'read_1': stats[0].as_dict(), 'read_2': stats[1].as_dict() if fastq_b else None}
+    return lane_key(fastq_a, fastq_b), result, (str(fastq_a)+": "+error if error else None)
+
+
+def load_stats(stats_file):
+    try:
+        with open(stats_file, 'r') as f:
+            stats = json.load(f)
+        if stats.get('version') == STATS_VERSION:
+            return stats
+    except (IOError, ValueError):
+        pass
+    return {'version': STATS_VERSION, 'lanes': {}, 'samples': {}}
+
+
+def summarize(lane_results):
+    """
+    The totals for a sample, over its lanes
+    """
+    reads = sum(r['read_1']['reads'] for r in lane_results)
+    lengths = [r[read] for r in lane_results for read in ('read_1', 'read_2') if r[read]]
+    bases = sum(l['bases'] for l in lengths)
+    return {
+        'lanes': len(lane_results),
+        'reads': reads,
+        'bases': bases,
+        'min_length': min(l['min_length'] for l in lengths) if lengths else 0,
+        'max_length': max(l['max_length'] for l in lengths) if lengths else 0,
+        'mean_length': round(float(bases)/sum(l['reads'] for l in lengths), 1) if reads else 0
+    }
+
+
+def preflight(samples, stats_file, workers):
+    """
+    Checks the lanes of the samples, given as {sample name: [(fastq_a, fastq_b or None)...]}.  Lanes whose FASTQs have not
+    changed since they were last checked (and passed) are not read again.
+    Returns {sample name: reason} for the samples that failed, and saves the statistics to stats_file
+    """
+    stats = load_stats(stats_file)
+    to_check = []
+    for sample_name, lanes in samples.items():
+        for fastq_a, fastq_b in lanes:
+            cached = stats['lanes'].get(lane_key(fastq_a, fastq_b))
+            if cached is None or cached['signatures'] != [signature(f) for f in (fastq_a, fastq_b) if f]:
+                to_check.append((fastq_a, fastq_b))
+
+    if to_check:
+        workers = max(1, min(workers, len(to_check)))
+        print "Checking "+str(len(to_check))+" FASTQ lanes, "+str(workers)+" at a time"
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(check_lane, to_check, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+
+    errors = {}
+    for key, result, error in results:
+        if error is None:
+            result['signatures'] = [signature(f) for f in (result['fastq_a'], result['fastq_b']) if f]
+            stats['lanes'][key] = result
+        else:
+            stats['lanes'].pop(key, None)
+            errors[key] = error
+
+    failed = {}
+    for sample_name, lanes in samples.items():
+        keys = [lane_key(fastq_a, fastq_b) for fastq_a, fastq_b in lanes]
+        sample_errors = [errors[k] for k in keys if k in errors]
+        if sample_errors:
+            failed[sample_name] = "; ".join(sample_errors)
+            stats['samples'][sample_name] = {'error': failed[sample_name]}
+        else:
+            stats['samples'][sample_name] = summarize([stats['lanes'][k] for k in keys])
+
+    tmp_file = stats_file+".tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(stats, f, indent=1, sort_keys=True)
+    os.rename(tmp_file, stats_file)
+    return failed
+
+
+def resolve_workers(requested_workers):
+    return requested_workers if requested_workers > 0 else multiprocessing.cpu_count()
@@ -0,0 +1,412 @@
+"""
+This script runs the gene-set enrichment analysis (GSEA) of every contrast in the contrast file, in place of one run of
+the GSEA java tool per contrast (see run_gsea.sh), with the same parameters:
+   -- the expression (.gct) and phenotype (.cls) files written by normalize_counts.py, and the gene sets (.gmt or .gmx),
+      are read once for all the contrasts
+   -- for each contrast (A_versus_B) the genes are ranked by Signal2Noise, (mean_A-mean_B)/(sd_A+sd_B), where each
+      standard deviation is at least 0.2*|mean| (0.2 for a mean of zero), as the java tool computes it
+   -- each gene set (restricted to the genes in the data, and kept if it then has GSEA_SET_MIN to GSEA_SET_MAX genes) is
+      held as the sorted array of its genes' positions in the ranked list, and its weighted enrichment score (ES) is the
+      maximum deviation from zero of the running sum (as -scoring_scheme weighted)
+   -- the null distribution is from gene-set permutations (as -permute gene_set): each permutation of the ranked list
+      gives a random set of the same size for every gene set.  The permutations are computed as matrices, a batch at a
+      time, and the batches of all the contrasts are split across GSEA_WORKERS processes
+   -- the normalized ES (NES, as -norm meandiv), nominal p-value, FDR q-value and FWER p-value are computed as by the java tool
+The enrichment scores are determined by the ranking alone, so they match the java tool's; the p- and q-values are from
+a different random number generator, so they agree with the java tool's only within the error of the permutations.  The
+permutations are seeded by GSEA_RANDOM_SEED (and the contrast and batch), so a run is reproducible with any number of workers.
+
+For each contrast, a directory <A><CONTRAST_FLAG><B>.Gsea.<timestamp> (named as the java tool names it) is written to
+GSEA_OUTPUT_DIR with an index.html summary, the results for each phenotype (gsea_report_for_<phenotype>.tsv) and the
+ranked gene list.
+"""
+
+import os
+import sys
+import cgi
+import time
+import multiprocessing
+import numpy as np
+
+from normalize_counts import format_number
+from stage_executor import read_contrasts
+
+#the permutations are computed this many at a time (each a matrix of this many rows by the number of genes):
+PERMUTATION_BATCH = 100
+
+#the minimum standard deviation, relative to the mean, used by Signal2Noise:
+MIN_SD_FRACTION = 0.2
+
+#the number of gene sets of each phenotype shown in the summary (as -plot_top_x):
+TOP_SETS = 20
+FDR_THRESHOLD = 0.25
+
+RANKED_LIST_FILE = "ranked_gene_list.tsv"
+REPORT_FILE_PREFIX = "gsea_report_for_"
+
+
+def read_gct(gct_file):
+    """
+    Returns the genes, the samples and the (genes x samples) expression matrix of a .gct file
+    """
+    with open(gct_file, 'r') as f:
+        f.readline()
+        f.readline()
+        samples = f.readline().rstrip('\r\n').split('\t')[2:]
+        genes = []
+        rows = []
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) == len(samples)+2:
+                genes.append(fields[0])
+                rows.append(fields[2:])
+    return genes, samples, np.array(rows, dtype=np.float64).reshape(len(genes), len(samples))
+
+
+def read_cls(cls_file):
+    """
+    Returns the phenotype of each sample (in the order of the .gct file) from a categorical .cls file
+    """
+    with open(cls_file, 'r') as f:
+        lines = [line.rstrip('\r\n') for line in f if line.strip()]
+    if len(lines) < 3:
+        raise ValueError("The phenotype file "+str(cls_file)+" does not have the three lines of a categorical .cls file")
+    return lines[2].split()
+
+
+def read_gene_sets(gene_sets_file):
+    """
+    Returns a list of (name, description, [genes]) from a .gmt file (a set per line) or a .gmx file (a set per column)
+    """
+    with open(gene_sets_file, 'r') as f:
+        rows = [line.rstrip('\r\n').split('\t') for line in f if line.strip()]
+    if gene_sets_file.lower().endswith('.gmx'):
+        columns = map(None, *rows) if len(rows) > 1 else []
+        rows = [[x for x in column if x] for column in columns]
+    return [(row[0], row[1], [g for g in row[2:] if g]) for row in rows if len(row) >= 2 and row[0]]
+
+
+def signal_to_noise(values_a, values_b):
+    """
+    The Signal2Noise of each gene (row) between the samples (columns) of phenotypes A and B
+    """
+    def mean_and_sd(values):
+        mean = values.mean(axis=1)
+        sd = values.std(axis=1, ddof=1) if values.shape[1] > 1 else np.zeros(len(mean))
+        minimum = MIN_SD_FRACTION*np.where(mean == 0, 1.0, np.abs(mean))
+        return mean, np.maximum(sd, minimum)
+    mean_a, sd_a = mean_and_sd(values_a)
+    mean_b, sd_b = mean_and_sd(values_b)
+    return (mean_a-mean_b)/(sd_a+sd_b)
+
+
+def rank_genes(metric):
+    """
+    The order of the genes by decreasing metric (ties keep the order of the data, so the ranking is reproducible)
+    """
+    return np.argsort(-metric, kind='mergesort')
+
+
+def gene_set_positions(gene_sets, ranked_genes, set_min, set_max):
+    """
+    Returns (name, description, positions) for each gene set of set_min to set_max genes in the ranked list, where positions
+    is the sorted array of the positions of its genes in the ranked list
+    """
+    position = dict((gene, i) for i, gene in enumerate(ranked_genes))
+    kept = []
+    for name, description, genes in gene_sets:
+        positions = np.array(sorted(set(position[g] for g in genes if g in position)), dtype=np.int64)
+        if set_min <= len(positions) <= set_max:
+            kept.append((name, description, positions))
+    return kept
+
+
+def enrichment_scores(positions, weights, n_genes):
+    """
+    The weighted enrichment scores of gene sets of the same size, given as the rows of a matrix of sorted positions in the
+    ranked list (weights are the absolute metric of the ranked genes).  The running sum steps up by the weight of each
+    gene in the set, and down by 1/(genes not in the set) for every other gene; the score is its largest deviation from zero.
+    Returns the scores, and the index (in each row) of the gene in the set at which the deviation is largest
+    """
+    k = positions.shape[1]
+    hit_weights = weights[positions]
+    cumulative = np.cumsum(hit_weights, axis=1)
+    total = cumulative[:, -1:]
+    total = np.where(total > 0, total, 1.0)
+    misses = (positions-np.arange(k))/float(max(1, n_genes-k))
+    #the running sum just after each gene of the set (its maxima), and just before it (its minima):
+    after = cumulative/total-misses
+    before = (cumulative-hit_weights)/total-misses
+    rows = np.arange(positions.shape[0])
+    top = after.argmax(axis=1)
+    bottom = before.argmin(axis=1)
+    positive = after[rows, top] > -before[rows, bottom]
+    scores = np.where(positive, after[rows, top], before[rows, bottom])
+    return scores, np.where(positive, top, bottom)
+
+
+def null_batch(args):
+    """
+    The enrichment scores of random gene sets for one batch of permutations of one contrast (as it is run by a process pool).
+    args is (seed, contrast index, batch index, permutations in the batch, ranked weights, [gene set sizes]).
+    Returns (contrast index, batch index, a gene sets x permutations matrix of scores)
+    """
+    seed, contrast_index, batch_index, n_permutations, weights, sizes = args
+    random_state = np.random.RandomState([seed, contrast_index, batch_index])
+    n_genes = len(weights)
+    permutations = np.argsort(random_state.rand(n_permutations, n_genes), axis=1)
+    scores = np.empty((len(sizes), n_permutations))
+    for i, k in enumerate(sizes):
+        #any k consecutive columns of random permutations are random sets of k genes:
+        offset = random_state.randint(0, n_genes-k+1)
+        scores[i] = enrichment_scores(np.sort(permutations[:, offset:offset+k], axis=1), weights, n_genes)[0]
+    return contrast_index, batch_index, scores
+
+
+def signed_means(null):
+    """
+    The mean of the positive, and of the negative, null scores of each gene set (nan if there are none)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        positive = np.where(null >= 0, null, 0).sum(axis=1)/(null >= 0).sum(axis=1)
+        negative = np.where(null < 0, null, 0).sum(axis=1)/(null < 0).sum(axis=1)
+    return positive, -negative
+
+
+def statistics(observed, null):
+    """
+    The NES, nominal p-value, FDR q-value and FWER p-value of each gene set, given the observed scores and the
+    (gene sets x permutations) null scores
+    """
+    positive_mean, negative_mean = signed_means(null)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nes = np.where(observed >= 0, observed/positive_mean, observed/negative_mean)
+        null_nes = np.where(null >= 0, null/positive_mean[:, np.newaxis], null/negative_mean[:, np.newaxis])
+        #the nominal p-value is against the null scores of the same sign:
+        nominal_p = np.where(observed >= 0,
+                             ((null >= observed[:, np.newaxis]) & (null >= 0)).sum(axis=1)/(null >= 0).sum(axis=1).astype(float),
+                             ((null <= observed[:, np.newaxis]) & (null < 0)).sum(axis=1)/(null < 0).sum(axis=1).astype(float))
+
+    #the FDR compares the fraction of all the null NES at least as extreme with the fraction of the observed NES:
+    null_values = null_nes[np.isfinite(null_nes)]
+    null_positive = np.sort(null_values[null_values >= 0])
+    null_negative = np.sort(null_values[null_values < 0])
+    observed_positive = np.sort(nes[np.isfinite(nes) & (nes >= 0)])
+    observed_negative = np.sort(nes[np.isfinite(nes) & (nes < 0)])
+    #the most extreme NES of each permutation, over all the gene sets (for the FWER):
+    finite = np.where(np.isfinite(null_nes), null_nes, 0)
+    max_positive = np.sort(finite.max(axis=0))
+    min_negative = np.sort(finite.min(axis=0))
+
+    fdr = np.ones(len(nes))
+    fwer = np.ones(len(nes))
+    for i, x in enumerate(nes):
+        if not np.isfinite(x):
+            fdr[i] = fwer[i] = np.nan
+        elif x >= 0:
+            null_fraction = (len(null_positive)-np.searchsorted(null_positive, x))/float(max(1, len(null_positive)))
+            observed_fraction = (len(observed_positive)-np.searchsorted(observed_positive, x))/float(len(observed_positive))
+            fdr[i] = min(1.0, null_fraction/observed_fraction)
+            fwer[i] = (len(max_positive)-np.searchsorted(max_positive, x))/float(len(max_positive))
+        else:
+            null_fraction = np.searchsorted(null_negative, x, side='right')/float(max(1, len(null_negative)))
+            observed_fraction = np.searchsorted(observed_negative, x, side='right')/float(len(observed_negative))
+            fdr[i] = min(1.0, null_fraction/observed_fraction)
+            fwer[i] = np.searchsorted(min_negative, x, side='right')/float(len(min_negative))
+    return nes, nominal_p, fdr, fwer
+
+
+class ContrastAnalysis:
+    """
+    The ranking, gene sets and observed enrichment of one contrast (phenotype A versus phenotype B)
+    """
+    def __init__(self, index, phenotype_a, phenotype_b, label, genes, expression, phenotypes, gene_sets, set_min, set_max):
+        self.index = index
+        self.phenotype_a = phenotype_a
+        self.phenotype_b = phenotype_b
+        self.label = label
+        in_a = np.array([p == phenotype_a for p in phenotypes])
+        in_b = np.array([p == phenotype_b for p in phenotypes])
+        if not in_a.any() or not in_b.any():
+            raise ValueError("The phenotype file has no samples of "+(phenotype_a if not in_a.any() else phenotype_b))
+        metric = signal_to_noise(expression[:, in_a], expression[:, in_b])
+        order = rank_genes(metric)
+        self.ranked_genes = [genes[i] for i in order]
+        self.ranked_metric = metric[order]
+        self.weights = np.abs(self.ranked_metric)
+        self.sets = gene_set_positions(gene_sets, self.ranked_genes, set_min, set_max)
+        self.observed = np.empty(len(self.sets))
+        self.peaks = np.empty(len(self.sets), dtype=np.int64)
+        for i, (name, description, positions) in enumerate(self.sets):
+            scores, peaks = enrichment_scores(positions[np.newaxis, :], self.weights, len(self.ranked_genes))
+            self.observed[i] = scores[0]
+            self.peaks[i] = peaks[0]
+
+    def leading_edge(self, i):
+        """
+        The rank at the peak of the running sum, and the genes of the set up to it (from the end nearest the peak)
+        """
+        positions = self.sets[i][2]
+        peak = self.peaks[i]
+        if self.observed[i] >= 0:
+            return int(positions[peak]), [self.ranked_genes[p] for p in positions[:peak+1]]
+        return int(positions[peak])-1, [self.ranked_genes[p] for p in positions[peak:]]
+
+
+def run_permutations(analyses, n_permutations, seed, workers):
+    """
+    Computes the null scores of every contrast, splitting the batches of permutations across the workers.
+    Returns a (gene sets x permutations) matrix for each contrast
+    """
+    tasks = []
+    for analysis in analyses:
+        sizes = [len(positions) for name, description, positions in analysis.sets]
+        for batch_index, start in enumerate(range(0, n_permutations, PERMUTATION_BATCH)):
+            tasks.append((seed, analysis.index, batch_index, min(PERMUTATION_BATCH, n_permutations-start), analysis.weights, sizes))
+    workers = max(1, min(workers, len(tasks)))
+    print "Running "+str(n_permutations)+" permutations for each of "+str(len(analyses))+" contrasts, in "+str(len(tasks))+ \
+          " batches, "+str(workers)+" at a time"
+    sys.stdout.flush()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(null_batch, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(null_batch, tasks)
+
+    batches = {}
+    for contrast_index, batch_index, scores in results:
+        batches.setdefault(contrast_index, []).append((batch_index, scores))
+    null = {}
+    for analysis in analyses:
+        parts = [scores for batch_index, scores in sorted(batches.get(analysis.index, []), key=lambda x: x[0])]
+        null[analysis.index] = np.hstack(parts) if parts else np.empty((len(analysis.sets), 0))
+    return null
+
+
+def format_statistic(x):
+    return "NA" if not np.isfinite(x) else format_number(float(x))
+
+
+def result_rows(analysis, nes, nominal_p, fdr, fwer, positive):
+    """
+    The results of the gene sets enriched in phenotype A (positive) or in phenotype B, most significant first
+    """
+    rows = []
+    for i, (name, description, positions) in enumerate(analysis.sets):
+        if (analysis.observed[i] >= 0) == positive:
+            rank, leading_genes = analysis.leading_edge(i)
+            rows.append({'name': name, 'description': description, 'size': len(positions), 'es': analysis.observed[i],
+                         'nes': nes[i], 'nominal_p': nominal_p[i], 'fdr': fdr[i], 'fwer': fwer[i], 'rank': rank,
+                         'leading_edge': leading_genes})
+    #sorted by |NES| (sets without a NES last), then by name:
+    rows.sort(key=lambda r: (-abs(r['nes']) if np.isfinite(r['nes']) else 0, r['name']))
+    return rows
+
+
+def write_results(results_file, rows):
+    with open(results_file, 'w') as f:
+        f.write("NAME\tDESCRIPTION\tSIZE\tES\tNES\tNOM p-val\tFDR q-val\tFWER p-val\tRANK AT MAX\tLEADING EDGE SIZE\tLEADING EDGE GENES\n")
+        for r in rows:
+            f.write("\t".join([r['name'], r['description'], str(r['size'])]+
+                              [format_statistic(r[k]) for k in ('es', 'nes', 'nominal_p', 'fdr', 'fwer')]+
+                              [str(r['rank']), str(len(r['leading_edge'])), ",".join(r['leading_edge'])])+"\n")
+
+
+def write_ranked_list(ranked_list_file, analysis):
+    with open(ranked_list_file, 'w') as f:
+        f.write("NAME\tSCORE\n")
+        for gene, score in zip(analysis.ranked_genes, analysis.ranked_metric.tolist()):
+            f.write(gene+"\t"+format_number(score)+"\n")
+
+
+def html_table(rows, results_link):
+    headers = ["Gene set", "Size", "ES", "NES", "NOM p-val", "FDR q-val", "FWER p-val", "Rank at max"]
+    html = "<table>\n<tr>"+"".join("<th>"+h+"</th>" for h in headers)+"</tr>\n"
+    for r in rows[:TOP_SETS]:
+        html += "<tr><td>"+cgi.escape(r['name'])+"</td><td>"+str(r['size'])+"</td>"+ \
+                "".join("<td>"+format_statistic(r[k])+"</td>" for k in ('es', 'nes', 'nominal_p', 'fdr', 'fwer'))+ \
+                "<td>"+str(r['rank'])+"</td></tr>\n"
+    html += "</table>\n"
+    return html+"<p>All "+str(len(rows))+" gene sets: <a href=\""+results_link+"\">"+results_link+"</a></p>\n"
+
+
+def write_summary(html_file, analysis, phenotype_rows, n_permutations, seed, n_gene_sets):
+    sections = []
+    for phenotype, rows, results_link in phenotype_rows:
+        significant = sum(1 for r in rows if np.isfinite(r['fdr']) and r['fdr'] < FDR_THRESHOLD)
+        sections.append("<h2>Enrichment in phenotype "+cgi.escape(phenotype)+"</h2>\n<p>"+str(len(rows))+" gene sets are upregulated in "
+                        +cgi.escape(phenotype)+", of which "+str(significant)+" are significant at FDR &lt; "+str(FDR_THRESHOLD)+
+                        ".  The top "+str(min(TOP_SETS, len(rows)))+":</p>\n"+html_table(rows, results_link))
+    with open(html_file, 'w') as f:
+        f.write("<html>\n<head><title>GSEA: "+cgi.escape(analysis.label)+"</title>\n"
+                "<style>body{font-family:sans-serif} table{border-collapse:collapse} td,th{border:1px solid #ccc;padding:2px 6px}</style>\n"
+                "</head>\n<body>\n<h1>GSEA report: "+cgi.escape(analysis.phenotype_a)+" versus "+cgi.escape(analysis.phenotype_b)+"</h1>\n"
+                "<p>"+str(len(analysis.ranked_genes))+" genes, ranked by Signal2Noise (<a href=\""+RANKED_LIST_FILE+"\">ranked list</a>).  "
+                +str(len(analysis.sets))+" of "+str(n_gene_sets)+" gene sets passed the size filter.  "
+                "Weighted enrichment scores, with "+str(n_permutations)+" gene-set permutations (random seed "+str(seed)+").</p>\n"
+                +"".join(sections)+"</body>\n</html>\n")
+
+
+def write_report(output_dir, html_name, analysis, null, n_permutations, seed, n_gene_sets):
+    """
+    Writes the directory of one contrast, named (as the java tool names it) by the label and a timestamp
+    """
+    report_dir = os.path.join(output_dir, analysis.label+".Gsea."+str(int(time.time()*1000)))
+    os.makedirs(report_dir)
+    nes, nominal_p, fdr, fwer = statistics(analysis.observed, null)
+    phenotype_rows = []
+    for phenotype, positive in ((analysis.phenotype_a, True), (analysis.phenotype_b, False)):
+        rows = result_rows(analysis, nes, nominal_p, fdr, fwer, positive)
+        results_file = REPORT_FILE_PREFIX+phenotype+".tsv"
+        write_results(os.path.join(report_dir, results_file), rows)
+        phenotype_rows.append((phenotype, rows, results_file))
+    write_ranked_list(os.path.join(report_dir, RANKED_LIST_FILE), analysis)
+    write_summary(os.path.join(report_dir, html_name), analysis, phenotype_rows, n_permutations, seed, n_gene_sets)
+    return report_dir
+
+
+def main(gct_file, cls_file, gene_sets_file, contrasts, contrast_flag, output_dir, html_name, n_permutations, seed, set_min, set_max, workers):
+    genes, samples, expression = read_gct(gct_file)
+    phenotypes = read_cls(cls_file)
+    if len(phenotypes) != len(samples):
+        sys.exit("The phenotype file "+str(cls_file)+" has "+str(len(phenotypes))+" samples, but the expression file has "+str(len(samples)))
+    gene_sets = read_gene_sets(gene_sets_file)
+    print "Read "+str(len(genes))+" genes of "+str(len(samples))+" samples, and "+str(len(gene_sets))+" gene sets"
+
+    analyses = []
+    for index, (condition_a, condition_b) in enumerate(contrasts):
+        try:
+            analysis = ContrastAnalysis(index, condition_a, condition_b, condition_a+contrast_flag+condition_b, genes, expression,
+                                        phenotypes, gene_sets, set_min, set_max)
+        except ValueError as e:
+            sys.exit("Could not run GSEA on the contrast of "+str(condition_a)+" and "+str(condition_b)+": "+str(e))
+        if not analysis.sets:
+            sys.exit("None of the gene sets of "+str(gene_sets_file)+" have "+str(set_min)+" to "+str(set_max)+" genes in the data.")
+        analyses.append(analysis)
+
+    null = run_permutations(analyses, n_permutations, seed, workers)
+    for analysis in analyses:
+        report_dir = write_report(output_dir, html_name, analysis, null[analysis.index], n_permutations, seed, len(gene_sets))
+        print "GSEA of "+analysis.label+": "+str(len(analysis.sets))+" gene sets, results in "+report_dir
+
+
+if __name__ == "__main__":
+
+    try:
+        gene_sets_file = os.environ['GSEA_GENE_SETS_FILE']
+        if not os.path.isfile(gene_sets_file):
+            sys.exit("The gene sets file (GSEA_GENE_SETS_FILE) was not found: "+str(gene_sets_file))
+        requested_workers = int(os.environ['GSEA_WORKERS'])
+        workers = requested_workers if requested_workers > 0 else multiprocessing.cpu_count()
+
+        main(os.environ['GSEA_GCT_FILE'], os.environ['GSEA_CLS_FILE'], gene_sets_file, read_contrasts(os.environ['CONTRAST_FILE']),
+             os.environ['CONTRAST_FLAG'], os.environ['GSEA_OUTPUT_DIR'], os.environ['GSEA_DEFAULT_HTML'],
+             int(os.environ['NUM_GSEA_PERMUTATIONS']), int(os.environ['GSEA_RANDOM_SEED']), int(os.environ['GSEA_SET_MIN']),
+             int(os.environ['GSEA_SET_MAX']), workers)
+
+    except KeyError as e:
+        sys.exit("Could not run the GSEA analysis.  Missing variable: "+str(e))
@@ -0,0 +1,129 @@
+"""
+This script produces the normalized counts for the samples in the design matrix, from the count matrix store
+   -- size factors are estimated by the median-of-ratios method, as DESeq's estimateSizeFactors:
+      each sample's size factor is the median (over the genes counted in every sample) of the ratio of its count to the
+      gene's geometric mean across the samples
+   -- the normalized counts (counts divided by the size factors) are written as a CSV file, in the format of R's write.csv
+   -- if output paths are given for them, the GSEA expression (.gct) and phenotype (.cls) files are written too, with the
+      samples sorted by condition and then by name
+
+Usage: normalize_counts.py [<gct file> <cls file>]
+"""
+
+import os
+import sys
+import numpy as np
+
+from count_matrix import CountMatrix, read_design_matrix
+
+
+def size_factors(counts):
+    """
+    Median-of-ratios size factors for a genes x samples matrix of counts
+    """
+    with np.errstate(divide='ignore'):
+        log_counts = np.log(counts)
+    log_geo_means = log_counts.mean(axis=1)
+    #genes with a zero count in any sample have a geometric mean of zero, and are not used:
+    used = np.isfinite(log_geo_means)
+    if not used.any():
+        sys.exit("Every gene has a zero count in at least one sample, so the size factors cannot be estimated.")
+    return np.exp(np.median(log_counts[used] - log_geo_means[used][:, np.newaxis], axis=0))
+
+
+def normalize(counts, factors):
+    return counts / factors[np.newaxis, :]
+
+
+def format_number(x):
+    """
+    Formats a number as R's write.csv/write.table does: up to 15 significant digits, in fixed or scientific notation
+    (whichever is narrower; fixed if they are equally wide)
+    """
+    if x != x:
+        return "NA"
+    if x in (float('inf'), float('-inf')):
+        return "Inf" if x > 0 else "-Inf"
+    if x == 0:
+        return "0"
+    mantissa, exponent = ('%.14e' % x).split('e')
+    e = int(exponent)
+    nsig = len(mantissa.lstrip('-').replace('.', '').rstrip('0'))
+    if e >= 0:
+        fixed_width = nsig+1 if nsig > e+1 else e+1
+    else:
+        fixed_width = nsig-e+1
+    sci_width = nsig + (1 if nsig > 1 else 0) + (4 if abs(e) < 100 else 5)
+    if fixed_width <= sci_width:
+        return '%.*f' % (max(0, nsig-e-1), x)
+    return '%.*e' % (nsig-1, x)
+
+
+def write_normalized_counts(normalized_counts_file, genes, samples, normalized):
+    with open(normalized_counts_file, 'w') as f:
+        f.write('""'+"".join(',"'+str(s)+'"' for s in samples)+"\n")
+        for gene, row in zip(genes, normalized.tolist()):
+            f.write('"'+gene+'",'+",".join(map(format_number, row))+"\n")
+
+
+def gsea_order(samples, conditions):
+    """
+    The order (indexes) of the samples for the GSEA files: sorted by condition, then by sample name
+    """
+    return sorted(range(len(samples)), key=lambda j: (conditions[j], samples[j]))
+
+
+def write_gct(gct_file, genes, samples, normalized, order):
+    with open(gct_file, 'w') as f:
+        f.write("#1.2\n")
+        f.write(str(len(genes))+"\t"+str(len(order))+"\n")
+        f.write("gene\tDescription\t"+"\t".join(samples[j] for j in order)+"\n")
+        for gene, row in zip(genes, normalized[:, order].tolist()):
+            f.write(gene+"\tNA\t"+"\t".join(map(format_number, row))+"\n")
+
+
+def write_cls(cls_file, samples, conditions, order):
+    classes = []
+    for j in order:
+        if conditions[j] not in classes:
+            classes.append(conditions[j])
+    with open(cls_file, 'w') as f:
+        f.write(str(len(set(samples)))+"\t"+str(len(classes))+"\t1\n")
+        f.write("#\t"+"\t".join(classes)+"\n")
+        f.write("\t".join(conditions[j] for j in order)+"\n")
+
+
+def main(design_mtx_file, store_dir, normalized_counts_file, gct_file=None, cls_file=None):
+    design = read_design_matrix(design_mtx_file)
+    samples = [sample for sample, count_file, condition in design]
+    conditions = [condition for sample, count_file, condition in design]
+
+    count_matrix = CountMatrix(store_dir)
+    counts = count_matrix.select(samples).astype(np.float64)
+    factors = size_factors(counts)
+    print "Size factors: "+", ".join(str(s)+"="+format_number(f) for s, f in zip(samples, factors))
+    normalized = normalize(counts, factors)
+
+    write_normalized_counts(normalized_counts_file, count_matrix.genes, samples, normalized)
+    if gct_file and cls_file:
+        order = gsea_order(samples, conditions)
+        write_gct(gct_file, count_matrix.genes, samples, normalized, order)
+        write_cls(cls_file, samples, conditions, order)
+
+
+if __name__ == "__main__":
+
+    try:
+        design_mtx_file = os.environ['DESIGN_MTX_FILE']
+        store_dir = os.environ['COUNT_MATRIX_DIR']
+        normalized_counts_file = os.environ['NORMALIZED_COUNTS_FILE']
+
+        if len(sys.argv) == 3:
+            main(design_mtx_file, store_dir, normalized_counts_file, sys.argv[1], sys.argv[2])
+        elif len(sys.argv) == 1:
+            main(design_mtx_file, store_dir, normalized_counts_file)
+        else:
+            sys.exit("Usage: normalize_counts.py [<gct file> <cls file>]")
+
+    except KeyError:
+        sys.exit("Failed at normalizing the counts.  Check the environment variables.")
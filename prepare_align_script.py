@@ -1,18 +1,41 @@
 """
 This script performs some basic checking (e.g. if FASTQ files exist)
-and writes the appropriate parameters into the template alignment script
+and writes the appropriate parameters into the template alignment script.
+A sample sequenced on several lanes has a FASTQ (or pair of FASTQs) per lane.  All the lanes are aligned: either passed to
+the aligner as comma-separated lists, each lane with its own read group (STAR only), or concatenated into one FASTQ per
+read (gzip files can be joined as they are, without decompressing them).
+Very large samples (STAR only) are split into shards that are aligned separately (see shard_fastq.py); the script of such
+a sample merges the alignments of its shards instead
+A sample whose alignment (of the same FASTQs, with the same settings) is in the artifact store, from another project, is
+linked from the store and not aligned again (see artifact_store.py)
 """
 
 import os
 import sys
 import re
-import glob
+import copy
+import shutil
+import hashlib
 import traceback
+import multiprocessing
+
+from stage_manifest import load_manifest
+from project_index import open_project_index
+from align_resources import choose_resources, describe, write_resource_file
+import shard_fastq
+from fastq_preflight import preflight, resolve_workers
+from artifact_store import open_store, alignment_key, read_key, write_key, ALIGNMENT
+from annotation_cache import gtf_checksum
 
 #convenience definitions:
 SNAPR = os.environ['SNAPR']
 STAR = os.environ['STAR']
 
+#the lane in Illumina FASTQ names, e.g. XXX_L002_R1_001.fastq.gz:
+LANE_PATTERN = re.compile(r"_L(\d{3})_")
+
+COPY_BUFFER_SIZE = 16*1024*1024
+
 class ProjectVariables:
     """
     Object to hold project-specific data together
@@ -30,7 +53,17 @@ class ProjectVariables:
                  bam_suffix,
                  aligner,
                  dedup,
-                 picard_location):
+                 picard_location,
+                 shared_genome=0,
+                 postprocess="stream",
+                 resources=None,
+                 resource_file="",
+                 shard_gb=0,
+                 shard_dir="",
+                 merge_template="",
+                 lane_mode="comma",
+                 lane_dir="",
+                 template_checksum=""):
         self.project_dir = project_dir
         self.output_dir = output_dir
         self.paired_end_reads = paired_end_reads
@@ -44,6 +77,16 @@ class ProjectVariables:
         self.aligner = aligner
         self.dedup = dedup
         self.picard_location = picard_location
+        self.shared_genome = shared_genome
+        self.postprocess = postprocess
+        self.resources = resources
+        self.resource_file = resource_file
+        self.shard_gb = shard_gb
+        self.shard_dir = shard_dir
+        self.merge_template = merge_template
+        self.lane_mode = lane_mode
+        self.lane_dir = lane_dir
+        self.template_checksum = template_checksum
 
 
 class Sample:
@@ -56,7 +99,11 @@ class Sample:
         self.sample_dir = ""
         self.fastq_a = ""
         self.fastq_b = ""
-        self.sequencing_info_dict = None
+        self.sequencing_info = None
+        self.lanes = []
+        self.read_groups = []
+        self.num_shards = 1
+        self.shard_templates = []
 
 
 def read_samples(samples_file):
@@ -102,31 +149,79 @@ def valid_sample(sample, project_data):
         return False
     return True
 
-def find(pattern):
+def find_all(pattern, project_index):
     """
-    Using glob, find the first occurrence of the pattern.  IF not found, return None
+    Using the project index, find all the occurrences of the pattern (in sorted order)
     """
-    try:
-        return glob.glob(pattern)[0]
-    except IndexError:
+    return project_index.glob(pattern)
+
+
+def lane_label(fastq):
+    """
+    The lane of a FASTQ file, from the Illumina naming (e.g. XXX_L002_R1_001.fastq.gz is lane 2), or None
+    """
+    match = LANE_PATTERN.search(os.path.basename(fastq))
+    return str(int(match.group(1))) if match else None
+
+
+def pair_key(fastq, read_tag):
+    #the name with the (last occurrence of the) read tag removed, which is the same for the two FASTQs of a lane:
+    return "".join(os.path.basename(fastq).rsplit(read_tag, 1))
+
+
+def pair_lanes(sample_name, fastqs_a, fastqs_b, read_1_tag, read_2_tag):
+    """
+    Matches the read 1 and read 2 FASTQs of each lane.  Returns a list of (lane, read 1 FASTQ, read 2 FASTQ) or None
+    (with a warning) if they do not pair up
+    """
+    keys_b = dict((pair_key(f, read_2_tag), f) for f in fastqs_b)
+    lanes = []
+    for f in fastqs_a:
+        mate = keys_b.pop(pair_key(f, read_1_tag), None)
+        if mate is None:
+            print "(Warning) Could not find the read 2 FASTQ for "+str(f)+".  Skipping sample "+str(sample_name)
+            return None
+        lanes.append((lane_label(f), f, mate))
+    if keys_b:
+        print "(Warning) Could not find the read 1 FASTQ for "+", ".join(sorted(keys_b.values()))+".  Skipping sample "+str(sample_name)
         return None
+    return lanes
 
 
 def parse_seq_info(samplesheet):
+    """
+    Reads all the rows of the sample sheet (one per lane), as a list of dictionaries keyed by the header
+    """
     try:
         with open(samplesheet, 'r') as f:
             keys = f.readline().strip().split(',')
-            values = f.readline().strip().split(',')
-            return dict(zip(keys, values))
+            return [dict(zip(keys, line.strip().split(','))) for line in f if line.strip()]
     except IOError:
         print "(Warning) Could not locate the sample sheet at: "+str(samplesheet)
         return None
 
 
-def prepare_sample(sample, project_data):
+def read_group(sample, lane, lane_id=None):
+    """
+    The read group (as given to STAR's --outSAMattrRGline) for a lane of a sample, from the row of the sample sheet for that
+    lane (or its first row, if no row gives the lane).  lane_id, if given, replaces the lane in the read group ID
+    """
+    rows = sample.sequencing_info or []
+    row = next((r for r in rows if r.get("Lane", "").strip() == lane), rows[0] if rows else {})
+    #if the samplesheet format changes, these could be missing.  Quietly leave as default:
+    fcid = row.get("FCID", "default")
+    index = row.get("Index", "default")
+    if lane_id is None:
+        lane_id = lane if lane is not None else row.get("Lane", "default")
+    fields = [("ID", str(fcid)+".Lane"+str(lane_id)), ("LB", sample.sample_name), ("PL", "illumina"), ("PU", index),
+              ("SM", sample.sample_name), ("CN", "CCCB")]
+    return " ".join(key+":"+str(value) for key, value in fields)
+
+
+def prepare_sample(sample, project_data, project_index):
     """
     Receives a Sample object-- prepares things like the paths, etc. based on the project metadata
-    and the sample-specific data
+    and the sample-specific data.  Files are located through the (already scanned) project index
     """
     sample.sample_dir = os.path.join(project_data.project_dir,
                                        str(project_data.sample_dir_prefix)+sample.sample_name)
@@ -143,16 +238,66 @@ def prepare_sample(sample, project_data):
         read_2_fastq_tag = "R2"
         fastq_suffix = "fastq.gz"
         
-    sample.fastq_a = find(search_pattern+"*"+str(read_1_fastq_tag)+"*"+str(fastq_suffix))
-    sample.fastq_b = find(search_pattern+"*"+str(read_2_fastq_tag)+"*"+str(fastq_suffix))
+    fastqs_a = find_all(search_pattern+"*"+str(read_1_fastq_tag)+"*"+str(fastq_suffix), project_index)
+    fastqs_b = find_all(search_pattern+"*"+str(read_2_fastq_tag)+"*"+str(fastq_suffix), project_index)
+
+    #every lane is aligned (and, if paired, each lane needs both reads):
+    if project_data.paired_end_reads == 1:
+        sample.lanes = pair_lanes(sample.sample_name, fastqs_a, fastqs_b, read_1_fastq_tag, read_2_fastq_tag) or []
+    else:
+        sample.lanes = [(lane_label(f), f, None) for f in fastqs_a]
 
     #extract sample metadata (for read group info) from the samplesheet:
     
-    sample.sequencing_info_dict = parse_seq_info(os.path.join(sample.sample_dir, sample.samplesheet))
+    sample.sequencing_info = parse_seq_info(os.path.join(sample.sample_dir, sample.samplesheet))
+
+    if not sample.lanes:
+        return sample
+    if len(sample.lanes) > 1:
+        print "Found "+str(len(sample.lanes))+" lanes for sample "+str(sample.sample_name)+": "+", ".join(str(lane) for lane, a, b in sample.lanes)
+
+    #the FASTQs given to the aligner: a comma-separated list of the lanes (with a read group per lane), or one file per read:
+    if project_data.lane_mode == "comma" or len(sample.lanes) == 1:
+        sample.fastq_a = ",".join(a for lane, a, b in sample.lanes)
+        sample.fastq_b = ",".join(b for lane, a, b in sample.lanes if b)
+        sample.read_groups = [read_group(sample, lane) for lane, a, b in sample.lanes]
+    else:
+        sample.fastq_a, sample.fastq_b = concatenated_fastqs(sample, project_data, fastq_suffix)
+        #the reads of all the lanes are then in one read group:
+        sample.read_groups = [read_group(sample, sample.lanes[0][0], "+".join(str(lane) for lane, a, b in sample.lanes))]
 
     return sample
 
 
+def concatenated_fastqs(sample, project_data, fastq_suffix):
+    """
+    The files (read 1 and read 2, or read 1 and "") that the lanes of a sample are concatenated into
+    """
+    base = os.path.join(sample.sample_dir, project_data.lane_dir, str(sample.sample_name))
+    return base+"_R1."+fastq_suffix, (base+"_R2."+fastq_suffix if project_data.paired_end_reads == 1 else "")
+
+
+def concatenate_lanes(args):
+    """
+    Joins the (gzipped) FASTQs of the lanes of a sample.  A gzip file may hold several compressed members, which are read
+    as one stream, so the files are joined as they are.  args is (sample name, [(output, [lane FASTQs])...]), as it is run
+    by a process pool.  Returns (sample name, error message or None)
+    """
+    sample_name, outputs = args
+    try:
+        for output, inputs in outputs:
+            if not os.path.isdir(os.path.dirname(output)):
+                os.makedirs(os.path.dirname(output))
+            with open(output+".tmp", 'wb') as out:
+                for f in inputs:
+                    with open(f, 'rb') as lane:
+                        shutil.copyfileobj(lane, out, COPY_BUFFER_SIZE)
+            os.rename(output+".tmp", output)
+        return sample_name, None
+    except (IOError, OSError) as e:
+        return sample_name, str(e)
+
+
 def inject_script(sample, project_data):
     """
     Inject the relevant parameters into the template scripts
@@ -168,6 +313,9 @@ def inject_script(sample, project_data):
     sample.script_template = re.sub("%OUTPUTDIRECTORY%",
                                     str(os.path.join(sample.sample_dir, project_data.output_dir)), str(sample.script_template))
 
+    #threads and memory for the stages of the alignment (read from the resource file when the alignment starts):
+    sample.script_template = re.sub("%RESOURCE_FILE%", str(project_data.resource_file), str(sample.script_template))
+
     #paired or single-end protocol specifics:
     if project_data.paired_end_reads == 1: # if paired
         sample.script_template = re.sub("%PAIRED%", str(1), str(sample.script_template))
@@ -187,33 +335,203 @@ def inject_script(sample, project_data):
     if aligner.lower() == SNAPR.lower():
       sample.script_template = re.sub("%TRANSCRIPTOME_INDEX%", str(project_data.transcriptome_index), str(sample.script_template))
     elif aligner.lower() == STAR.lower():
-        fcid="default"
-        lane="default"
-        index="default"
+        #the read groups, one per lane (in the order of the FASTQs), separated as STAR expects:
+        sample.script_template = re.sub("%READ_GROUPS%", " , ".join(sample.read_groups), str(sample.script_template))
 
-        #if the samplesheet format changes, these could potentially throw exceptions.  Catch and quietly leave as default:
-        try:
-            fcid = sample.sequencing_info_dict["FCID"]
-            lane = sample.sequencing_info_dict["Lane"]
-            index = sample.sequencing_info_dict["Index"]
-        except (TypeError, KeyError) as e:
-            pass
+        #stream the alignments into the final BAM, or post-process them from a SAM file on disk:
+        sample.script_template = re.sub("%POSTPROCESS%", str(project_data.postprocess), str(sample.script_template))
 
-        sample.script_template = re.sub("%FCID%", str(fcid), str(sample.script_template))
-        sample.script_template = re.sub("%LANE%", str(lane), str(sample.script_template))
-        sample.script_template = re.sub("%INDEX%", str(index), str(sample.script_template))
+        #attach to the genome loaded into shared memory for the batch (see run_alignments.py), or load it privately:
+        if project_data.shared_genome == 1:
+            sample.script_template = re.sub("%GENOME_LOAD%", "LoadAndKeep", str(sample.script_template))
+        else:
+            sample.script_template = re.sub("%GENOME_LOAD%", "NoSharedMemory", str(sample.script_template))
 
     return sample
 
 
+def script_path(sample, project_data):
+    return os.path.join(sample.sample_dir, str(sample.sample_name)+str(project_data.script_nametag))
+
+
+def shard_script_path(sample, project_data, shard):
+    return os.path.join(sample.sample_dir, shard_fastq.shard_name(sample.sample_name, shard)+str(project_data.script_nametag))
+
+
 def write_script(sample, project_data):
     """
-    Writes the formatted template to a file in the appropriate location
+    Writes the formatted template to a file in the appropriate location (and those of its shards, replacing any earlier ones)
     """
-    outfile = str(sample.sample_name)+str(project_data.script_nametag)
-    outfile = os.path.join(sample.sample_dir, outfile)
-    with open(outfile, 'w') as o:
+    with open(script_path(sample, project_data), 'w') as o:
         o.write(sample.script_template)
+    for old_script in shard_fastq.shard_scripts(sample.sample_dir, sample.sample_name, project_data.script_nametag):
+        os.remove(old_script)
+    for shard, shard_template in enumerate(sample.shard_templates):
+        with open(shard_script_path(sample, project_data, shard), 'w') as o:
+            o.write(shard_template)
+
+
+def sample_shard_dir(sample, project_data):
+    return os.path.join(sample.sample_dir, project_data.shard_dir)
+
+
+def inject_shard_scripts(sample, project_data, fastq_suffix):
+    """
+    For a sample split into shards: fills the alignment template for each shard (aligning the shard's FASTQs into its own
+    directory, without removing duplicates, which can only be done once the shards are merged), and makes the script of
+    the sample the merge of the shards
+    """
+    shard_bams = []
+    shard_dirs = [sample_shard_dir(sample, project_data)]
+    for shard in range(sample.num_shards):
+        name = shard_fastq.shard_name(sample.sample_name, shard)
+        #each lane is split into the shards separately, so a shard has the FASTQs (and read group) of every lane:
+        shard_sample = copy.copy(sample)
+        fastqs = [shard_fastq.shard_fastqs(sample_shard_dir(sample, project_data), sample.sample_name, shard, lane_number,
+                                           project_data.paired_end_reads == 1, fastq_suffix) for lane_number in range(len(sample.lanes))]
+        shard_sample.fastq_a = ",".join(a for a, b in fastqs)
+        shard_sample.fastq_b = ",".join(b for a, b in fastqs if b)
+        shard_sample.read_groups = [read_group(sample, lane) for lane, a, b in sample.lanes]
+        shard_data = copy.copy(project_data)
+        shard_data.output_dir = os.path.join(project_data.output_dir, name)
+        shard_data.bam_suffix = shard_fastq.SHARD_BAM_SUFFIX
+        shard_data.dedup = 0
+        sample.shard_templates.append(inject_script(shard_sample, shard_data).script_template)
+        shard_bams.append(os.path.join(sample.sample_dir, shard_data.output_dir, str(sample.sample_name)+shard_fastq.SHARD_BAM_SUFFIX))
+        shard_dirs.append(os.path.join(sample.sample_dir, shard_data.output_dir))
+
+    sample.script_template = project_data.merge_template
+    sample = inject_script(sample, project_data)
+    sample.script_template = re.sub("%SHARD_BAMS%", " ".join(shard_bams), str(sample.script_template))
+    sample.script_template = re.sub("%SHARD_DIRS%", " ".join(shard_dirs), str(sample.script_template))
+    return sample
+
+
+def split_samples(samples, project_data, manifest, fastq_suffix):
+    """
+    Splits the FASTQs of the sharded samples (those whose alignment is not up to date), several samples at a time.
+    Returns the names of the samples that could not be split
+    """
+    to_split = [(s.sample_name, s.lanes, sample_shard_dir(s, project_data), s.num_shards, fastq_suffix)
+                for s in samples if s.num_shards > 1 and not manifest.is_planned_current('alignment', s.sample_name)]
+    if not to_split:
+        return []
+    for args in to_split:
+        print "Splitting the FASTQ files of sample "+str(args[0])+" into "+str(args[3])+" shards"
+    sys.stdout.flush()
+    pool = multiprocessing.Pool(min(len(to_split), max(1, multiprocessing.cpu_count()/3)))
+    try:
+        results = pool.map(shard_fastq.split_sample, to_split)
+    finally:
+        pool.close()
+        pool.join()
+    failed = []
+    for sample_name, counts, error in results:
+        if error is None:
+            print "Split sample "+str(sample_name)+" into shards of "+", ".join(str(c) for c in counts)+" reads ("+str(sum(counts))+" in total)"
+        else:
+            print "(Warning) Could not split the FASTQ files of sample "+str(sample_name)+": "+error
+            failed.append(sample_name)
+    return failed
+
+
+def concatenate_samples(samples, project_data, manifest):
+    """
+    Joins the lanes of the samples that are aligned from concatenated FASTQs (those whose alignment is not up to date),
+    several samples at a time.  Returns the names of the samples whose lanes could not be joined
+    """
+    to_join = []
+    for s in samples:
+        if len(s.lanes) > 1 and s.num_shards == 1 and project_data.lane_mode == "concat" and not manifest.is_planned_current('alignment', s.sample_name):
+            outputs = [(s.fastq_a, [a for lane, a, b in s.lanes])]
+            if project_data.paired_end_reads == 1:
+                outputs.append((s.fastq_b, [b for lane, a, b in s.lanes]))
+            to_join.append((s.sample_name, outputs))
+    if not to_join:
+        return []
+    pool = multiprocessing.Pool(min(len(to_join), max(1, multiprocessing.cpu_count()/2)))
+    try:
+        results = pool.map(concatenate_lanes, to_join)
+    finally:
+        pool.close()
+        pool.join()
+    failed = []
+    for sample_name, error in results:
+        if error is None:
+            print "Joined the lanes of sample "+str(sample_name)
+        else:
+            print "(Warning) Could not join the lanes of sample "+str(sample_name)+": "+error
+            failed.append(sample_name)
+    return failed
+
+
+def plan_alignment(sample, project_data, manifest):
+    """
+    Registers the alignment of this sample in the stage manifest.  The alignment is up to date if a previous run
+    produced the final BAM from the same FASTQ files with an identical alignment script (which holds all the parameters
+    but the threads and memory, which do not change the BAM and are read from the resource file)
+    """
+    inputs = [a for lane, a, b in sample.lanes]
+    if project_data.paired_end_reads == 1:
+        inputs.extend(b for lane, a, b in sample.lanes)
+    inputs.append(script_path(sample, project_data))
+    final_bam = os.path.join(sample.sample_dir, project_data.output_dir, str(sample.sample_name)+str(project_data.bam_suffix))
+    manifest.plan('alignment', sample.sample_name, inputs, {}, [final_bam])
+
+
+def gtf_fingerprint(gtf_file, annotation_cache_dir):
+    #(the checksum is kept by the annotation cache, so the GTF is only read again when it changes):
+    if not os.path.isfile(gtf_file):
+        return gtf_file
+    if not os.path.isdir(annotation_cache_dir):
+        os.makedirs(annotation_cache_dir)
+    return gtf_checksum(gtf_file, annotation_cache_dir)
+
+
+def template_checksum(*templates):
+    #(the templates hold the options of the aligner and of the sort and de-duplication that follow it):
+    return hashlib.sha1("".join(templates)).hexdigest()
+
+
+def artifact_params(sample, project_data, gtf_id):
+    """
+    The settings (besides the FASTQs) that determine the alignment of a sample, for its key in the artifact store
+    """
+    return {
+        'aligner': project_data.aligner.lower(),
+        'assembly': project_data.assembly,
+        'genome_index': os.path.abspath(project_data.genome_index),
+        'transcriptome_index': project_data.transcriptome_index,
+        'gtf': gtf_id,
+        #(with a shared genome, STAR uses the junctions built into the index rather than inserting those of the GTF):
+        'shared_genome': project_data.shared_genome if project_data.aligner.lower() == STAR.lower() else 0,
+        'templates': project_data.template_checksum,
+        'dedup': project_data.dedup,
+        'paired_end_reads': project_data.paired_end_reads,
+        'bam_suffix': project_data.bam_suffix,
+        'read_groups': sample.read_groups
+    }
+
+
+def restore_alignment(sample, project_data, manifest, store, gtf_id):
+    """
+    Looks up the alignment of this sample in the artifact store.  If it is there (and the alignment is not already up to
+    date), its files are linked into the alignment directory and the alignment is recorded as complete, so it is not run.
+    Otherwise the files linked from an earlier entry are unlinked, so the alignment does not write over the store's copies
+    """
+    aln_dir = os.path.join(sample.sample_dir, project_data.output_dir)
+    fastqs = [a for lane, a, b in sample.lanes]+[b for lane, a, b in sample.lanes if b]
+    key = alignment_key(fastqs, artifact_params(sample, project_data, gtf_id))
+    previous = read_key(aln_dir, sample.sample_name)
+    if manifest.is_planned_current('alignment', sample.sample_name):
+        if previous != key:
+            write_key(aln_dir, sample.sample_name, key)
+        return
+    store.detach(previous, ALIGNMENT, aln_dir)
+    write_key(aln_dir, sample.sample_name, key)
+    final_bam = str(sample.sample_name)+str(project_data.bam_suffix)
+    if store.restore(key, ALIGNMENT, aln_dir, final_bam) is not None and manifest.record_planned('alignment', sample.sample_name):
+        print "The alignment of sample "+str(sample.sample_name)+" is in the artifact store.  Linked its files into "+str(aln_dir)
 
 
 if __name__ == '__main__':
@@ -238,6 +556,27 @@ if __name__ == '__main__':
     bam_suffix: is a file suffix to place on the output BAM file so that it may be easily identified later on in the pipeline
     dedup: specifies if we should dedup (1) or not (0)
     picard_location: path to picard tools
+    shared_genome: specifies if the STAR alignments share a genome loaded once into shared memory (1) or each load their own (0)
+    postprocess: how the STAR alignments are turned into the final BAM: streamed ('stream') or through a SAM file on disk ('sam')
+    shard_gb: samples (aligned with STAR) whose read 1 FASTQ is larger than this (in GB) are split into shards of about this
+            size, which are aligned separately and then merged.  Zero means 'never shard'
+    shard_dir: the directory (relative to the sample directory) for the FASTQs of the shards
+    merge_template: a template script for merging the alignments of the shards of a sample
+    lane_mode: how the FASTQs of a sample sequenced on several lanes are given to the aligner: as comma-separated lists
+            ('comma', STAR only), or concatenated into one file per read ('concat')
+    lane_dir: the directory (relative to the sample directory) for the concatenated FASTQs
+    preflight_enabled: specifies if the FASTQs are checked (decompressed in full, reads counted and pairs matched) before
+            the alignments (1) or not (0).  Samples that fail the checks are left out of the validated sample file
+    preflight_workers: the number of FASTQ lanes checked at once (zero means 'all the cpus')
+    fastq_stats_file: a file for the read statistics of the samples (see fastq_preflight.py)
+    resource_profile: a file giving the cpus and memory to plan the alignments for (see align_resources.py).  If empty,
+            those of this host are used
+    resource_file: the file the chosen threads and memory are written to, which the alignment scripts read when they start
+    plan_for_pool: specifies if the resources are planned for as many alignments as fit in the memory pool (1, set by
+            watch_project.py, which prepares the samples in batches) or for the samples being prepared (0)
+    artifact_store_dir: the store of alignments shared by the projects (see artifact_store.py).  If empty, there is none
+    artifact_store_budget_gb: the disk space (in GB) the store may use before its least recently used entries are evicted
+    annotation_cache_dir: the annotation cache, which holds the checksum of the GTF (part of the key of an alignment in the store)
     """
 
     try:
@@ -257,6 +596,31 @@ if __name__ == '__main__':
         aligner = os.environ['ALIGNER']
         dedup = int(os.environ['DEDUP'])
         picard_location = os.environ['PICARD_LOCATION']
+        project_index_file = os.environ['PROJECT_INDEX_FILE']
+        shared_genome = int(os.environ['STAR_SHARED_GENOME'])
+        postprocess = os.environ['STAR_POSTPROCESS']
+        resource_profile = os.environ['ALIGN_RESOURCE_PROFILE']
+        resource_file = os.environ['ALIGN_RESOURCE_FILE']
+        plan_for_pool = int(os.environ.get('ALIGN_PLAN_FOR_POOL', 0))
+        memory_fraction = float(os.environ['ALIGN_MEMORY_FRACTION'])
+        shard_gb = float(os.environ['ALIGN_SHARD_GB'])
+        shard_dir = os.environ['ALIGN_SHARD_DIR']
+        merge_template = read_template_script(os.environ['STAR_MERGE_SCRIPT'])
+        fastq_suffix = os.environ['FASTQ_SUFFIX']
+        preflight_enabled = int(os.environ['FASTQ_PREFLIGHT'])
+        preflight_workers = int(os.environ['FASTQ_PREFLIGHT_WORKERS'])
+        fastq_stats_file = os.environ['FASTQ_STATS_FILE']
+        lane_dir = os.environ['FASTQ_LANE_DIR']
+        artifact_store_dir = os.environ['ARTIFACT_STORE_DIR']
+        artifact_store_budget_gb = float(os.environ['ARTIFACT_STORE_BUDGET_GB'])
+        annotation_cache_dir = os.environ['ANNOTATION_CACHE_DIR']
+        #SNAPR takes a single FASTQ per read:
+        lane_mode = os.environ['FASTQ_LANE_MODE'] if aligner.lower() == STAR.lower() else "concat"
+        if lane_mode not in ('comma', 'concat'):
+            sys.exit("FASTQ_LANE_MODE must be 'comma' or 'concat', not: "+str(lane_mode))
+
+        if aligner.lower() == STAR.lower() and postprocess not in ('stream', 'sam'):
+            sys.exit("STAR_POSTPROCESS must be 'stream' or 'sam', not: "+str(postprocess))
 
         if aligner.lower() == SNAPR.lower():
             try:
@@ -267,6 +631,9 @@ if __name__ == '__main__':
         else:
             transcriptome_index=""
 
+        #read-in the default script to a string
+        script_template_string = read_template_script(template_script)
+
         #create a data object to hold all the metadata about the project/sample:
         project_data = ProjectVariables(
             project_dir,
@@ -281,34 +648,99 @@ if __name__ == '__main__':
             bam_suffix,
             aligner,
             dedup,
-            picard_location
+            picard_location,
+            shared_genome,
+            postprocess,
+            None,
+            resource_file,
+            shard_gb,
+            shard_dir,
+            merge_template,
+            lane_mode,
+            lane_dir,
+            template_checksum(script_template_string, merge_template)
         )
 
         #get a list of tuples for samples/conditions from the sample file:
         samples = read_samples(samples_file)
 
-        #read-in the default script to a string
-        script_template_string = read_template_script(template_script)
-
         #create a list of Sample objects
         all_samples = [Sample(sample_name, condition, script_template_string, samplesheet) for sample_name, condition in samples]
 
+        #scan the project directory once (or refresh a saved scan) to locate the files for all the samples:
+        project_index = open_project_index(project_dir, project_index_file)
+
         #prepare samples
-        all_samples = map(lambda s: prepare_sample(s, project_data), all_samples)
+        all_samples = map(lambda s: prepare_sample(s, project_data, project_index), all_samples)
 
         #validate the samples-- check that the correct files exist:
         all_samples = [s for s in all_samples if valid_sample(s, project_data)]
 
+        #check the contents of the FASTQs, so a bad file fails here rather than in the middle of the alignments:
+        if preflight_enabled == 1:
+            failed = preflight(dict((s.sample_name, [(a, b) for lane, a, b in s.lanes]) for s in all_samples),
+                               fastq_stats_file, resolve_workers(preflight_workers))
+            for sample_name in sorted(failed):
+                print "(Warning) The FASTQ files of sample "+str(sample_name)+" failed the checks.  Skipping.  Reason: "+failed[sample_name]
+            all_samples = [s for s in all_samples if s.sample_name not in failed]
+
         with open(validated_sample_filepath, 'w') as vsf:
             for s in all_samples:
                 vsf.write(str(s.sample_name)+"\t"+str(s.condition)+"\n")
 
 
+        #decide which samples are large enough to be split into shards:
+        if aligner.lower() == STAR.lower():
+            for s in all_samples:
+                s.num_shards = shard_fastq.num_shards([a for lane, a, b in s.lanes], shard_gb)
+
+        #choose the threads and memory of each alignment, given how many will run at once in the memory pool:
+        try:
+            footprint_gb = float(os.environ['ALIGN_MEMORY_GB'])
+        except ValueError:
+            footprint_gb = None
+        resident_gb = 0
+        if aligner.lower() == STAR.lower() and shared_genome == 1 and footprint_gb is not None:
+            #one copy of the genome is shared, and each alignment needs only its working memory:
+            resident_gb = footprint_gb
+            footprint_gb = float(os.environ['STAR_SHARED_GENOME_ALIGN_MEMORY_GB'])
+        #(in watch mode this is one batch of the samples, and the alignments of the other batches may still be waiting to
+        #start and read the resource file, so the resources are planned for a full pool instead):
+        planned_alignments = None if plan_for_pool == 1 else sum(s.num_shards for s in all_samples)
+        project_data.resources = choose_resources(resource_profile, memory_fraction, footprint_gb, planned_alignments, resident_gb)
+        write_resource_file(project_data.resources, resource_file)
+
         #inject the parameters:
-        all_samples = map(lambda s: inject_script(s, project_data), all_samples)
+        all_samples = map(lambda s: inject_script(s, project_data) if s.num_shards == 1 else inject_shard_scripts(s, project_data, fastq_suffix), all_samples)
+
+        for s in all_samples:
+            shards = " (in "+str(s.num_shards)+" shards)" if s.num_shards > 1 else ""
+            print "Resources for the alignment of "+str(s.sample_name)+shards+": "+describe(project_data.resources)
 
         #write the scripts
         map(lambda s: write_script(s, project_data), all_samples)
 
+        #register the alignments so that completed ones can be skipped on a re-run:
+        manifest = load_manifest()
+        for s in all_samples:
+            plan_alignment(s, project_data, manifest)
+        manifest.save()
+
+        #link the alignments that are in the artifact store (made under another project), rather than running them again:
+        store = open_store(artifact_store_dir, artifact_store_budget_gb)
+        if store is not None:
+            gtf_id = gtf_fingerprint(gtf_file, annotation_cache_dir)
+            for s in all_samples:
+                restore_alignment(s, project_data, manifest, store, gtf_id)
+
+        #split the FASTQs of the sharded samples, and join the lanes of the others if needed (a sample that could not be
+        #split or joined is not aligned):
+        failed = split_samples(all_samples, project_data, manifest, fastq_suffix)+concatenate_samples(all_samples, project_data, manifest)
+        if failed:
+            with open(validated_sample_filepath, 'w') as vsf:
+                for s in all_samples:
+                    if s.sample_name not in failed:
+                        vsf.write(str(s.sample_name)+"\t"+str(s.condition)+"\n")
+
     except KeyError:
         sys.exit("Alignment script preparation failed.")
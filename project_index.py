@@ -0,0 +1,326 @@
+"""
+This script builds a single index of the files in the project directory, so that the helper scripts can locate
+FASTQ, BAM, count files and QC reports without repeatedly globbing (or running 'find') over the project tree,
+which is slow on network storage.
+  -- the tree is walked once (with scandir where available); symbolic links to directories are followed, as with 'find -L'
+  -- the index can be saved in the project directory and re-used by the helpers that run later.  On re-use, only
+     directories whose modification time has changed are listed again; the files of the other directories are stat-ed
+     again, since a file rewritten in place does not change its directory's modification time
+  -- glob patterns, 'newest file matching a pattern' and existence checks are then answered from memory.  The lookups by
+     file name use the files of the tree sorted by name (built once), so a pattern with a literal start (e.g. the sample
+     name) only looks at the files whose names begin with it
+
+Run as a script (with 'newest_bams') it reports the most recent BAM file for every sample in SAMPLES_FILE,
+which is used when the pipeline is started with -noalign.
+"""
+
+import os
+import sys
+import json
+import re
+import time
+import bisect
+import fnmatch
+import glob as _glob
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+#directories modified this recently (in seconds) before a scan are listed again on the next refresh,
+#since files added within the same timestamp granularity would not change the directory's modification time
+RACY_WINDOW = 2.0
+
+#the part of a name pattern before its first wildcard:
+LITERAL_PREFIX = re.compile(r"[^*?\[]*")
+
+
+def list_directory(path):
+    """
+    Returns the files (name -> (size, mtime)) and subdirectories (names) of a directory.
+    Symbolic links are followed; broken links are ignored.
+    """
+    files = {}
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                else:
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime)
+            except OSError:
+                pass
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                continue
+            if os.path.isdir(full_path):
+                subdirs.append(name)
+            else:
+                files[name] = (st.st_size, st.st_mtime)
+    return files, sorted(subdirs)
+
+
+def stat_files(path, names):
+    """
+    Returns the (size, mtime) of the named files of a directory (name -> (size, mtime)), leaving out those that are gone
+    """
+    files = {}
+    for name in names:
+        try:
+            st = os.stat(os.path.join(path, name))
+        except OSError:
+            continue
+        files[name] = (st.st_size, st.st_mtime)
+    return files
+
+
+class ProjectIndex:
+    """
+    In-memory listing of a directory tree.  'dirs' maps each (absolute) directory path to a dictionary holding
+    its modification time, its files and its subdirectories.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.dirs = {}
+        self.scan_time = None
+        #(the files by name, built on the first lookup by name):
+        self._names = None
+
+    def scan(self):
+        self.dirs = {}
+        self._names = None
+        self.scan_time = time.time()
+        self._scan_tree(self.root, set())
+        return self
+
+    def _scan_tree(self, path, visited):
+        try:
+            st = os.stat(path)
+            if (st.st_dev, st.st_ino) in visited:
+                return #a symlink loop
+            visited.add((st.st_dev, st.st_ino))
+            files, subdirs = list_directory(path)
+        except OSError:
+            return
+        self.dirs[path] = {'mtime': st.st_mtime, 'files': files, 'subdirs': subdirs}
+        for d in subdirs:
+            self._scan_tree(os.path.join(path, d), visited)
+
+    def refresh(self):
+        """
+        Re-lists the directories that changed (or may have changed) since the index was built, and updates the size and
+        modification time of the files in the others
+        """
+        last_scan = self.scan_time or 0
+        self.scan_time = time.time()
+        self._names = None
+        for path in sorted(self.dirs.keys()):
+            if path not in self.dirs:
+                continue #removed along with a changed parent
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                self._drop(path)
+                continue
+            if mtime != self.dirs[path]['mtime'] or mtime >= last_scan - RACY_WINDOW:
+                old_subdirs = self.dirs[path]['subdirs']
+                files, subdirs = list_directory(path)
+                self.dirs[path] = {'mtime': mtime, 'files': files, 'subdirs': subdirs}
+                for d in old_subdirs:
+                    if d not in subdirs:
+                        self._drop(os.path.join(path, d))
+                for d in subdirs:
+                    if os.path.join(path, d) not in self.dirs:
+                        self._scan_tree(os.path.join(path, d), set())
+            else:
+                self.dirs[path]['files'] = stat_files(path, self.dirs[path]['files'].keys())
+        return self
+
+    def _drop(self, path):
+        prefix = path+os.sep
+        for d in [d for d in self.dirs if d == path or d.startswith(prefix)]:
+            del self.dirs[d]
+
+    def save(self, index_file):
+        #write to a temporary file and move it into place, so concurrent readers never see a partial index:
+        tmp_file = index_file+'.'+str(os.getpid())+'.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'root': self.root, 'scan_time': self.scan_time, 'dirs': self.dirs}, f)
+        os.rename(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file):
+        with open(index_file, 'r') as f:
+            contents = json.load(f)
+        index = cls(contents['root'])
+        index.scan_time = contents['scan_time']
+        index.dirs = dict((str(path), {'mtime': d['mtime'],
+                                       'files': dict((str(name), tuple(stats)) for name, stats in d['files'].items()),
+                                       'subdirs': [str(s) for s in d['subdirs']]})
+                          for path, d in contents['dirs'].items())
+        return index
+
+    def contains(self, path):
+        path = os.path.abspath(path)
+        return path == self.root or path.startswith(self.root+os.sep)
+
+    def isdir(self, path):
+        return os.path.abspath(path) in self.dirs
+
+    def isfile(self, path):
+        path = os.path.abspath(path)
+        d = self.dirs.get(os.path.dirname(path))
+        return d is not None and os.path.basename(path) in d['files']
+
+    def exists(self, path):
+        if not self.contains(path):
+            return os.path.exists(path)
+        return self.isfile(path) or self.isdir(path)
+
+    def mtime(self, path):
+        path = os.path.abspath(path)
+        d = self.dirs.get(os.path.dirname(path))
+        if d is not None and os.path.basename(path) in d['files']:
+            return d['files'][os.path.basename(path)][1]
+        return self.dirs[path]['mtime']
+
+    def glob(self, pattern):
+        """
+        Same matching rules as glob.glob (including not matching hidden names with wildcards), in sorted order.
+        Patterns outside of the indexed tree fall back to glob.glob
+        """
+        pattern = os.path.abspath(pattern)
+        if not self.contains(pattern) or pattern == self.root:
+            return sorted(_glob.glob(pattern))
+        components = os.path.relpath(pattern, self.root).split(os.sep)
+        candidates = [self.root]
+        for i, component in enumerate(components):
+            last = (i == len(components)-1)
+            matches = []
+            for parent in candidates:
+                d = self.dirs.get(parent)
+                if d is None:
+                    continue
+                names = d['subdirs'] if not last else d['subdirs']+list(d['files'].keys())
+                if _glob.has_magic(component):
+                    if not component.startswith('.'):
+                        names = [n for n in names if not n.startswith('.')]
+                    matches.extend(os.path.join(parent, n) for n in fnmatch.filter(names, component))
+                elif component in names:
+                    matches.append(os.path.join(parent, component))
+            candidates = matches
+        return sorted(candidates)
+
+    def name_index(self):
+        """
+        The files of the tree by name: (the names, sorted, and a dictionary of name -> [(path, mtime)...])
+        """
+        if self._names is None:
+            by_name = {}
+            for path, d in self.dirs.items():
+                for name, (size, mtime) in d['files'].items():
+                    by_name.setdefault(name, []).append((os.path.join(path, name), mtime))
+            self._names = (sorted(by_name), by_name)
+        return self._names
+
+    def _find(self, name_pattern):
+        #the (path, mtime) of the files whose name matches, looking only at the names that start with the pattern's literal part:
+        names, by_name = self.name_index()
+        prefix = LITERAL_PREFIX.match(name_pattern).group(0)
+        found = []
+        for i in xrange(bisect.bisect_left(names, prefix), len(names)):
+            if not names[i].startswith(prefix):
+                break
+            if fnmatch.fnmatch(names[i], name_pattern):
+                found.extend(by_name[names[i]])
+        return found
+
+    def find(self, name_pattern):
+        """
+        Like 'find -L <root> -type f -name <name_pattern>'
+        """
+        return sorted(path for path, mtime in self._find(name_pattern))
+
+    def newest(self, name_pattern):
+        """
+        Returns the most recently modified file (anywhere in the tree) whose name matches the pattern, or None.
+        Links are resolved, so a link to a file is not reported in place of the file itself
+        """
+        files = {}
+        for path, mtime in self._find(name_pattern):
+            files[os.path.realpath(path)] = mtime
+        if not files:
+            return None
+        return max(files.keys(), key=lambda f: files[f])
+
+
+def open_project_index(project_dir, index_file=None):
+    """
+    Loads and refreshes the saved index of the project (if there is one), otherwise scans the project.
+    If index_file is given (a name relative to the project directory, or a full path), the up-to-date index is saved there.
+    """
+    index = None
+    if index_file:
+        index_file = os.path.join(project_dir, index_file)
+        if os.path.isfile(index_file):
+            try:
+                index = ProjectIndex.load(index_file)
+                if index.root != os.path.abspath(project_dir):
+                    index = None
+                else:
+                    index.refresh()
+            except (IOError, ValueError, KeyError):
+                index = None
+    if index is None:
+        index = ProjectIndex(project_dir).scan()
+    if index_file:
+        try:
+            index.save(index_file)
+        except (IOError, OSError):
+            print "(Warning) Could not save the project index to "+str(index_file)
+    return index
+
+
+def newest_bams(project_index, samples_file, target_bam):
+    """
+    For each sample (and condition) in the samples file, finds the newest BAM whose name starts with the sample name
+    and ends with the target suffix.  Returns a list of (sample, condition, path or None) tuples
+    """
+    results = []
+    try:
+        with open(samples_file, 'r') as sf:
+            for line in sf:
+                split_line = line.strip().split()
+                if len(split_line) >= 2:
+                    sample, condition = split_line[0], split_line[1]
+                    results.append((sample, condition, project_index.newest(str(sample)+"*"+str(target_bam))))
+        return results
+    except IOError:
+        sys.exit("I/O Error: Could not find samples file: "+str(samples_file))
+
+
+if __name__ == "__main__":
+
+    try:
+        project_dir = os.environ['PROJECT_DIR']
+        index_file = os.environ['PROJECT_INDEX_FILE']
+        project_index = open_project_index(project_dir, index_file)
+
+        if len(sys.argv) > 1 and sys.argv[1] == 'newest_bams':
+            samples_file = os.environ['SAMPLES_FILE']
+            target_bam = os.environ['TARGET_BAM']
+            for sample, condition, bam in newest_bams(project_index, samples_file, target_bam):
+                print str(sample)+"\t"+str(condition)+"\t"+(bam or "")
+
+    except KeyError:
+        sys.exit("Could not index the project directory.  Check that PROJECT_DIR and PROJECT_INDEX_FILE are set.")
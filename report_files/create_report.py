@@ -2,8 +2,18 @@ import os
 import glob
 import sys
 import re
-import fnmatch
+import cgi
+import json
+import shutil
 import traceback
+import multiprocessing
+
+#the helper modules shared with the rest of the pipeline are located in the pipeline's home directory, one level up:
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from project_index import open_project_index
+from file_matching import SampleMatcher, ContrastMatcher
+from telemetry import load_timeline
+import qc_metrics
 
 # required html template elements:
 accordion_panel="accordion_panel"
@@ -12,7 +22,13 @@ iframe="iframe"
 img_content="img_content"
 new_tab="new_tab"
 tab_content="tab_content"
-required_elements = [accordion_panel, file_link, iframe, img_content, new_tab, tab_content]
+table="table"
+lazy_section="lazy_section"
+required_elements = [accordion_panel, file_link, iframe, img_content, new_tab, tab_content, table]
+
+# the report modes: everything in one html file, or a shell page whose sections are loaded (a page of items at a time) when shown
+INLINE_MODE="inline"
+LAZY_MODE="lazy"
 
 HTML="html"
 IMG_TYPES=["png", "jpg", "jpeg"]
@@ -34,6 +50,10 @@ DGE_ANALYSIS="#DGE_ANALYSIS#"
 ALIGNER="#ALIGNER#"
 ALIGNER_REF_URL="#ALIGNER_REF_URL#"
 ASSEMBLY="#ASSEMBLY#"
+TABLE_TITLE="#TABLE_TITLE#"
+TABLE_HEADER="#TABLE_HEADER#"
+TABLE_ROW="#TABLE_ROW#"
+PAGES="#PAGES#"
 
 def read_file(filepath):
 	#read-in a file to a string:
@@ -99,26 +119,18 @@ def read_template_elements(template_elements_dir, template_element_tag):
 	return template_dict
 
 
-def find_files(search_string, report_dir, samples=None, contrasts=None, tag=None):
+def find_files(project_index, search_string, report_dir, matcher, suffixes=()):
 	"""
-	Given a search path and optionally a list of all the sample names
-	Return a list of lists, where each list has the paths for files corresponding to a particular sample.  The sample reference is contained in the filename, so no need to carry that around
+	Given a search path (matched against the project index) and a SampleMatcher or ContrastMatcher (see file_matching.py),
+	return a dictionary mapping each sample (or contrast) to a list of the paths for its files.
+	Known suffixes of the file names (e.g. the FASTQ suffix) can be given, which are removed before matching file names to sample names.
 	"""
-	found_files = glob.glob(search_string)
-	valid_files = {}
-	if samples:
-		for sample in samples:
-			valid_files[sample]=[x for x in found_files if sample in x]
-	elif contrasts and tag:
-		for a,b in contrasts:
-			match1="*"+str(a)+"*"+str(tag)+"*"+str(b)+"*" 
-			match2="*"+str(b)+"*"+str(tag)+"*"+str(a)+"*" 
-			key = str(b)+str(tag)+str(a)
-			#if the filenames 'match' (in a wildcard sense) the contrasted samples anywhere in the filepath, then point this contrast at that file (should only be 1)
-			try:
-				valid_files[key]=[found_files[[x for x,y in enumerate(found_files) if fnmatch.fnmatch(y, match1) or fnmatch.fnmatch(y, match2)][0]]]
-			except IndexError: #if no match was found
-				pass #just ignore
+	found_files = project_index.glob(search_string)
+	if isinstance(matcher, SampleMatcher):
+		valid_files = matcher.match_all(found_files, suffixes)
+	else:
+		valid_files = matcher.match_all(found_files)
+
 	#make links relative to the report directory:
 	for key, files in valid_files.iteritems():
 		valid_files[key] = [os.path.relpath(f, report_dir) for f in files]
@@ -136,31 +148,111 @@ def insert(main_text, pattern, new_text):
 	The argument 'pattern' defines the boundaries of the text region into which new_text is inserted.
 	new_text is inserted as the last item in that region.
 	"""
-	search_pattern = str(pattern) + ".*" + str(pattern) # greedy regex to grab the region of interest
-	m = re.search(search_pattern, main_text, flags=re.DOTALL) #get the section of text that matches our regex.
-	block_start = m.start()
-	block_end = m.end()
-	
-	#this loops through the occurrences of 'pattern' in the extracted text block.  Upon exiting the loop,
-	# the variable pattern_match holds information about the last occurrence-- the end of our region.
-	for pattern_match in re.finditer(pattern, main_text[block_start:block_end], flags=re.DOTALL):
+	return insert_all(main_text, pattern, [new_text])
+
+
+def insert_all(main_text, pattern, new_texts):
+	"""
+	Inserts each of new_texts (in order) as the last items of the region bounded by 'pattern'-- the same result as calling insert() 
+	once per item, but main_text is only searched and rebuilt once.
+	The region ends at the last occurrence of 'pattern', which is where the new text goes.
+	"""
+	for pattern_match in re.finditer(pattern, main_text, flags=re.DOTALL):
 		pass
-	
-	index=block_start+pattern_match.start() #the location (in the original main_text) of that last occurrence of 'pattern'
-	return main_text[:index]+str(new_text)+main_text[index:] #insert the new text at that position and return.
+	index=pattern_match.start() #the location of the last occurrence of 'pattern'
+	return main_text[:index]+"".join([str(t) for t in new_texts])+main_text[index:]
 
-	
-def add_navigation_tab(main_html, template_dict, tab_text, id):
 
-	#prepare the tab section
-	tab_pattern = search_pattern(TAB_SECTION)
-	tab_template_text = template_dict[new_tab]
-	tab_template_text = re.sub(ID, "#"+str(id), tab_template_text)
-	tab_template_text = re.sub(TAB_TEXT, tab_text, tab_template_text)
+class ReportBuilder:
+	"""
+	Assembles the report.  The navigation tabs and the content sections are collected in lists as they are added, and each
+	section's repeating components (file links, accordion panels) are collected the same way.  Everything is joined into 
+	the template once, by serialize()
+	"""
+	def __init__(self, main_html, template_dict):
+		self.main_html = main_html
+		self.template_dict = template_dict
+		self.tabs = []
+		self.sections = []
+
+	def add_navigation_tab(self, tab_text, id):
+		tab_template_text = self.template_dict[new_tab]
+		tab_template_text = re.sub(ID, "#"+str(id), tab_template_text)
+		tab_template_text = re.sub(TAB_TEXT, tab_text, tab_template_text)
+		self.tabs.append(tab_template_text)
+
+	def add_section(self, tab_text, section_header, components):
+		"""
+		Adds a tab and its page content, which holds the given list of repeating components
+		"""
+		id = tab_text.replace(" ","_") #create an ID used as a html id attribute (to reference the content panel).
+		self.add_navigation_tab(tab_text, id)
+
+		#prepare the content section
+		content_template_text = self.template_dict[tab_content]
+		content_template_text = re.sub(ID, id, content_template_text)
+		content_template_text = re.sub(SECTION_HEADER, section_header, content_template_text)
+		self.sections.append(insert_all(content_template_text, search_pattern(REPEATING_COMPONENT), components))
+
+	def defer(self, content):
+		"""
+		Returns the html for content (e.g. an iframe) that is only needed once its panel is opened.  Here it is simply kept
+		"""
+		return content
+
+	def serialize(self):
+		main_html = insert_all(self.main_html, search_pattern(TAB_SECTION), self.tabs)
+		return insert_all(main_html, search_pattern(CONTENT_SECTION), self.sections)
 
-	return insert(main_html, tab_pattern, tab_template_text)
 
+class LazyReportBuilder(ReportBuilder):
+	"""
+	Assembles the report as a small shell page, whose size does not grow with the number of samples or contrasts.  The
+	components of each section are written to page files of page_size components, in manifest_dir (with a JSON manifest
+	of the sections and their pages), and rnaseq_report_custom.js loads a section's pages only when the section is shown.
+	The pages are javascript (each calls loadReportPage), since a browser will not fetch a JSON file for a page opened from
+	the file system.  The content of the panels (iframes and images) is only inserted, and so fetched, when a panel is opened
+	"""
+	def __init__(self, main_html, template_dict, report_dir, manifest_dir, page_size):
+		ReportBuilder.__init__(self, main_html, template_dict)
+		if lazy_section not in template_dict:
+			sys.exit("Missing the HTML template for the lazy report mode: "+str(lazy_section))
+		self.report_dir = report_dir
+		self.manifest_dir = manifest_dir
+		self.page_size = max(1, page_size)
+		self.manifest = []
+		self.pages = {}
+
+	def add_section(self, tab_text, section_header, components):
+		id = tab_text.replace(" ","_")
+		pages = [components[i:i+self.page_size] for i in range(0, len(components), self.page_size)] or [[]]
+		self.pages[id] = pages
+		self.manifest.append({'id': id, 'title': tab_text, 'header': section_header, 'items': len(components),
+			'pages': [os.path.join(self.manifest_dir, id+"."+str(i)+".js") for i in range(len(pages))]})
+
+		placeholder = re.sub(ID, id, self.template_dict[lazy_section])
+		placeholder = re.sub(PAGES, str(len(pages)), placeholder)
+		placeholder = re.sub(LINK, self.manifest_dir, placeholder)
+		ReportBuilder.add_section(self, tab_text, section_header, [placeholder])
+
+	def defer(self, content):
+		#(held in an attribute, so that nothing is fetched until the script inserts it):
+		return '<div class="lazy-content" data-content="'+cgi.escape(content, True)+'"></div>'
+
+	def serialize(self):
+		manifest_path = os.path.join(self.report_dir, self.manifest_dir)
+		if os.path.isdir(manifest_path):
+			shutil.rmtree(manifest_path)
+		os.makedirs(manifest_path)
+		for id, pages in self.pages.iteritems():
+			for i, components in enumerate(pages):
+				with open(os.path.join(manifest_path, id+"."+str(i)+".js"), 'w') as f:
+					f.write("loadReportPage("+json.dumps(id)+", "+str(i)+", "+json.dumps([str(c) for c in components])+");\n")
+		with open(os.path.join(manifest_path, "manifest.json"), 'w') as f:
+			json.dump({'page_size': self.page_size, 'sections': self.manifest}, f, indent=1)
+		return ReportBuilder.serialize(self)
 
+	
 def create_content_item(filepath, template_dict, id):
 
 	if filepath.lower().endswith(HTML.lower()):
@@ -176,62 +268,42 @@ def create_content_item(filepath, template_dict, id):
 	return template
 
 
-def add_accordion_content(main_html, template_dict, tab_text, section_header, file_dict):
-        """
+def add_accordion_content(report, tab_text, section_header, file_dict):
+	"""
 	Adds a tab and page content for content that is held in accordion-style panels
-        """
-
-	id = tab_text.replace(" ","_") #create an ID used as a html id attribute (to reference the content panel).
-        main_html = add_navigation_tab(main_html, template_dict, tab_text, id)
-
-        #prepare the content section
-        content_pattern = search_pattern(CONTENT_SECTION)
-        content_template_text = template_dict[tab_content]
-        content_template_text = re.sub(ID, id, content_template_text)
-        content_template_text = re.sub(SECTION_HEADER, section_header, content_template_text)
+	"""
+	id = tab_text.replace(" ","_")
+	acc_panel_template_text = report.template_dict[accordion_panel]
 
-        #for each of the files, insert a new accordion element into the content template
-        acc_panel_template_text = template_dict[accordion_panel]
-	
+	#for each of the files, create a new accordion element for the content template
+	panels = []
 	for key, files in file_dict.iteritems():
-	        for idx, path in enumerate(files):
+		for idx, path in enumerate(files):
 			#create another ID:
 			panel_id = str(id)+"_"+str(key)+"_"+str(idx)
-        	        #replace in the template:
-        	        new_panel = re.sub(PANEL_ID, panel_id, acc_panel_template_text)
+			#replace in the template:
+			new_panel = re.sub(PANEL_ID, panel_id, acc_panel_template_text)
 			if len(files)==1:
-	        	        new_panel = re.sub(PANEL_TITLE, key, new_panel)
+				new_panel = re.sub(PANEL_TITLE, key, new_panel)
 			else:
-	        	        new_panel = re.sub(PANEL_TITLE, str(key)+" ("+str(idx+1)+")", new_panel)
-			
+				new_panel = re.sub(PANEL_TITLE, str(key)+" ("+str(idx+1)+")", new_panel)
 
 			#depending on type of file, sub in the content
-			content_item = create_content_item(path, template_dict, panel_id)
-			new_panel = insert(new_panel, search_pattern(PANEL_CONTENT), content_item)
-        	        content_template_text = insert(content_template_text, search_pattern(REPEATING_COMPONENT), new_panel)
+			content_item = report.defer(create_content_item(path, report.template_dict, panel_id))
+			panels.append(insert(new_panel, search_pattern(PANEL_CONTENT), content_item))
 
-        main_html=insert(main_html, content_pattern, content_template_text)
-        return main_html
+	report.add_section(tab_text, section_header, panels)
 
 
-
-def add_simple_link_content(main_html, template_dict, tab_text, section_header, file_dict, alias_link=False):
+def add_simple_link_content(report, tab_text, section_header, file_dict, alias_link=False):
 	"""
 	Adds a tab and page content for simple links to the data files
 	The arg 'file_dict' is a dictionary 
 	"""
-	id = tab_text.replace(" ","_") #create an ID used as a html id attribute (to reference the content panel).
-	main_html = add_navigation_tab(main_html, template_dict, tab_text, id)
-
-	#prepare the content section
-	content_pattern = search_pattern(CONTENT_SECTION)	
-	content_template_text = template_dict[tab_content]	
-	content_template_text = re.sub(ID, id, content_template_text)
-	content_template_text = re.sub(SECTION_HEADER, section_header, content_template_text)
-
-	#for each of the files, insert a new file link into the content template
-	file_link_template_text = template_dict[file_link]
+	file_link_template_text = report.template_dict[file_link]
 
+	#for each of the files, create a new file link for the content template
+	links = []
 	for key, files in file_dict.iteritems():
 		for path in files:
 			#replace in the template:
@@ -240,11 +312,154 @@ def add_simple_link_content(main_html, template_dict, tab_text, section_header,
 				new_file_link = re.sub(FILE_NAME, key, new_file_link)
 			else:
 				new_file_link = re.sub(FILE_NAME, os.path.basename(path), new_file_link)
-			#insert the link into the content block:
-			content_template_text = insert(content_template_text, search_pattern(REPEATING_COMPONENT), new_file_link)		
+			links.append(new_file_link)
+
+	report.add_section(tab_text, section_header, links)
+
+def create_table(template_dict, title, header, rows):
+	"""
+	Fills the table template.  'header' is a list of column names and 'rows' a list of lists of the (string) cell values
+	"""
+	return create_html_table(template_dict, title, header, [["<td>"+cgi.escape(c)+"</td>" for c in row] for row in rows])
+
+
+def create_html_table(template_dict, title, header, rows):
+	"""
+	As create_table, but the rows are lists of the html of the cells (the <td> elements), e.g. for cells holding links
+	"""
+	template = re.sub(TABLE_TITLE, cgi.escape(title), template_dict[table])
+	template = re.sub(TABLE_HEADER, "<tr>"+"".join(["<th>"+cgi.escape(h)+"</th>" for h in header])+"</tr>", template)
+	html_rows = ["<tr>"+"".join(row)+"</tr>\n" for row in rows]
+	return insert_all(template, search_pattern(TABLE_ROW), html_rows)
+
+
+def report_links(label, paths):
+	#numbered when a sample has several reports (e.g. FastQC of read 1 and read 2):
+	if len(paths) == 1:
+		return ['<a href="'+cgi.escape(paths[0], True)+'">'+label+'</a>']
+	return ['<a href="'+cgi.escape(p, True)+'">'+label+' ('+str(i+1)+')</a>' for i, p in enumerate(paths)]
+
+
+def add_qc_content(report, samples, qc, rna_qc_files, fastqc_files, table_links):
+	"""
+	Adds a tab with the table of QC metrics (see qc_metrics.py): one row per sample, with the outlying values flagged, and
+	links to the sample's RNA-SeQC and FastQC reports (which are linked, rather than embedded, so the report stays light)
+	"""
+	header = ["Sample"]+[title for key, title in qc['columns']]+["Outliers", "Reports"]
+	rows = []
+	for sample in samples:
+		metrics = qc['samples'][sample]
+		outliers = qc['outliers'][sample]
+		row = ['<td>'+cgi.escape(sample)+'</td>']
+		for key, title, decimals in qc_metrics.COLUMNS:
+			value = qc_metrics.format_value(metrics.get(key), decimals)
+			if key in outliers:
+				row.append('<td class="qc-outlier" title="Outlier among the samples">'+value+'</td>')
+			elif key == 'fastqc_failed_modules' and metrics.get('fastqc_failed'):
+				row.append('<td title="'+cgi.escape(", ".join(metrics['fastqc_failed']), True)+'">'+value+'</td>')
+			else:
+				row.append('<td>'+value+'</td>')
+		row.append('<td>'+str(len(outliers))+'</td>')
+		links = report_links("RNA-SeQC", rna_qc_files.get(sample, []))+report_links("FastQC", fastqc_files.get(sample, []))
+		row.append('<td>'+" ".join(links)+'</td>')
+		rows.append(row)
+
+	components = [create_html_table(report.template_dict, "Quality metrics (click a column to sort; outliers are highlighted)", header, rows)]
+	for name, path in table_links:
+		link = re.sub(LINK, path, report.template_dict[file_link])
+		components.append(re.sub(FILE_NAME, name, link))
+	report.add_section("QC Summary", "Quality metrics of the samples", components)
+
+
+def format_duration(seconds):
+	if seconds is None:
+		return "NA"
+	seconds = int(round(seconds))
+	return "%d:%02d:%02d" % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
 
-	main_html=insert(main_html, content_pattern, content_template_text)
-	return main_html
+
+def format_bytes(n):
+	if n is None:
+		return "NA"
+	for unit in ["B", "KB", "MB", "GB"]:
+		if abs(n) < 1024:
+			return "%.1f %s" % (n, unit) if unit != "B" else "%d B" % n
+		n /= 1024.0
+	return "%.1f TB" % n
+
+
+def format_rss(mb):
+	return "NA" if mb is None else "%.1f" % mb
+
+
+def cpu_seconds(record):
+	#phases of a unit (e.g. the genome loading of an alignment) are only timed:
+	if record['user_cpu_seconds'] is None:
+		return None
+	return record['user_cpu_seconds']+record['system_cpu_seconds']
+
+
+def total(values):
+	values = [v for v in values if v is not None]
+	return sum(values) if values else None
+
+
+def median(values):
+	values = sorted(values)
+	mid = len(values) // 2
+	return values[mid] if len(values) % 2 else (values[mid-1]+values[mid])/2.0
+
+
+def add_performance_content(report, timeline, timeline_link):
+	"""
+	Adds a tab summarizing the run timeline (see telemetry.py): the resources used by each stage, and by each unit of work.
+	A unit's wall time relative to the median of its stage points out the stragglers
+	"""
+	run_start = min([r['start'] for r in timeline])
+	stages = []
+	by_stage = {}
+	for r in timeline:
+		if r['stage'] not in by_stage:
+			stages.append(r['stage'])
+			by_stage[r['stage']] = []
+		by_stage[r['stage']].append(r)
+
+	stage_rows = []
+	for stage in stages:
+		records = by_stage[stage]
+		slowest = max(records, key=lambda r: r['wall_seconds'])
+		rss = [r['peak_rss_mb'] for r in records if r['peak_rss_mb'] is not None]
+		stage_rows.append([stage, str(len(records)),
+			format_duration(max([r['end'] for r in records]) - min([r['start'] for r in records])),
+			format_duration(sum([r['wall_seconds'] for r in records])),
+			format_duration(total([cpu_seconds(r) for r in records])),
+			format_rss(max(rss) if rss else None),
+			format_bytes(total([r['read_bytes'] for r in records])),
+			format_bytes(total([r['write_bytes'] for r in records])),
+			slowest['unit']+" ("+format_duration(slowest['wall_seconds'])+")"])
+
+	unit_rows = []
+	stage_medians = dict([(stage, median([r['wall_seconds'] for r in by_stage[stage]])) for stage in stages])
+	for r in timeline:
+		relative = r['wall_seconds']/stage_medians[r['stage']] if stage_medians[r['stage']] > 0 else 1.0
+		unit_rows.append([r['stage'], r['unit'], r['host'], "+"+format_duration(r['start']-run_start),
+			format_duration(r['wall_seconds']),
+			format_duration(cpu_seconds(r)),
+			format_rss(r['peak_rss_mb']),
+			format_bytes(r['read_bytes']),
+			format_bytes(r['write_bytes']),
+			"%.2f" % relative,
+			"NA" if r['exit_code'] is None else str(r['exit_code'])])
+
+	components = [
+		create_table(report.template_dict, "Stages",
+			["Stage", "Units", "Elapsed", "Total wall time", "Total CPU time", "Peak RSS (MB)", "Read", "Written", "Slowest unit"], stage_rows),
+		create_table(report.template_dict, "Units of work (in order of starting)",
+			["Stage", "Unit", "Host", "Started", "Wall time", "CPU time", "Peak RSS (MB)", "Read", "Written", "Wall time / stage median", "Exit code"], unit_rows)
+	]
+	link = re.sub(LINK, timeline_link, report.template_dict[file_link])
+	components.append(re.sub(FILE_NAME, "Run timeline (JSON records)", link))
+	report.add_section("Run Performance", "Time and resources used by each stage of the pipeline", components)
 
 
 def unhide_analysis_help(main_html):
@@ -286,6 +501,14 @@ if __name__ == "__main__":
 		aligner = os.environ['ALIGNER']
 		aligner_ref_url = os.environ['ALIGNER_REF_URL']
 		genome = os.environ['ASSEMBLY']
+		project_index_file = os.environ['PROJECT_INDEX_FILE']
+		report_mode = os.environ['REPORT_MODE'] #'inline' or 'lazy' (see LazyReportBuilder)
+		report_page_size = int(os.environ['REPORT_PAGE_SIZE'])
+		report_manifest_dir = os.environ['REPORT_MANIFEST_DIR']
+		align_dir_name = os.environ['ALN_DIR_NAME']
+		fastq_stats_file = os.environ['FASTQ_STATS_FILE'] #the reads and read lengths found by the FASTQ checks
+		qc_json_file = os.path.join(os.environ['REPORT_DIR'], os.environ['QC_METRICS_JSON']) #the table of QC metrics, as JSON and TSV
+		qc_tsv_file = os.path.join(os.environ['REPORT_DIR'], os.environ['QC_METRICS_TSV'])
 
 		#the directory of the results, which we can extract from the intended final location of the html report:
 		output_report_dir = os.path.dirname(completed_html_report)
@@ -299,13 +522,16 @@ if __name__ == "__main__":
 		#get the sample names
 		all_samples = get_sample_ids(sample_file)
 
+		#scan the project once (or refresh the saved scan); all the file searches below use this index:
+		project_index = open_project_index(project_dir, project_index_file)
+
 		"""
 		default sections of the output report include:
 			-fastq files
 			-fastqc reports
 			-bam files
 			-counts/normalized counts
-			-RNA QC
+			-QC metrics of all the samples (linking the RNA-SeQC and FastQC reports)
 		"""
 		
 		#plug-in some basic information:
@@ -313,28 +539,44 @@ if __name__ == "__main__":
 		main_html = re.sub(ALIGNER_REF_URL, aligner_ref_url, main_html)
 		main_html = re.sub(ASSEMBLY, genome, main_html)
 
-		#for each of the file types, get a list of tuples containing the sample name and path:
-		fastq_files = find_files(os.path.join(project_dir, str(sample_dir_prefix)+"*","*"+str(fastq_suffix)), output_report_dir, samples=all_samples)
-		bam_files = find_files(os.path.join(project_dir, str(sample_dir_prefix)+"*", "*", "*"+str(final_bam_suffix)), output_report_dir, samples=all_samples)
-		count_files = find_files(os.path.join(project_dir, str(output_report_dir), "*", "*"+str(countfile_suffix)), output_report_dir, samples=all_samples)
+		#the sections of the report are collected by the builder and written into the template at the end:
+		if report_mode == LAZY_MODE:
+			report = LazyReportBuilder(main_html, template_element_dict, output_report_dir, report_manifest_dir, report_page_size)
+		elif report_mode == INLINE_MODE:
+			report = ReportBuilder(main_html, template_element_dict)
+		else:
+			sys.exit("Unknown REPORT_MODE: "+str(report_mode)+".  Use "+INLINE_MODE+" or "+LAZY_MODE)
+
+		#assigns the files of each type to the samples:
+		sample_matcher = SampleMatcher(all_samples, project_dir, sample_dir_prefix)
+
+		#for each of the file types, get a dictionary mapping the sample name to its paths:
+		fastq_files = find_files(project_index, os.path.join(project_dir, str(sample_dir_prefix)+"*","*"+str(fastq_suffix)), output_report_dir, sample_matcher, suffixes=[fastq_suffix])
+		bam_files = find_files(project_index, os.path.join(project_dir, str(sample_dir_prefix)+"*", "*", "*"+str(final_bam_suffix)), output_report_dir, sample_matcher, suffixes=[final_bam_suffix])
+		count_files = find_files(project_index, os.path.join(project_dir, str(output_report_dir), "*", "*"+str(countfile_suffix)), output_report_dir, sample_matcher, suffixes=[countfile_suffix])
 		norm_count_file = {}
-		if len(glob.glob(normalized_count_file)) == 1:
+		if project_index.isfile(normalized_count_file):
 			norm_count_file[os.path.basename(normalized_count_file)]=[os.path.relpath(normalized_count_file, output_report_dir)]
-		rna_qc_files = find_files(os.path.join(project_dir, output_report_dir, qc_dir, "*", rna_qc_report), output_report_dir, samples=all_samples)
-		fastqc_files = find_files(os.path.join(project_dir, "*", "*", fastqc_default_html), output_report_dir, samples=all_samples)
+		rna_qc_files = find_files(project_index, os.path.join(project_dir, output_report_dir, qc_dir, "*", rna_qc_report), output_report_dir, sample_matcher)
+		fastqc_files = find_files(project_index, os.path.join(project_dir, "*", "*", fastqc_default_html), output_report_dir, sample_matcher)
 	
 		if has_files(fastq_files):
-			main_html = add_simple_link_content(main_html, template_element_dict, "FASTQ Files", "Sequence files (FASTQ) in compressed format:", fastq_files)
+			add_simple_link_content(report, "FASTQ Files", "Sequence files (FASTQ) in compressed format:", fastq_files)
 		if has_files(bam_files):
-			main_html = add_simple_link_content(main_html, template_element_dict, "BAM Files", "Binary sequence alignment files (BAM)", bam_files, alias_link=True)
+			add_simple_link_content(report, "BAM Files", "Binary sequence alignment files (BAM)", bam_files, alias_link=True)
 		if has_files(count_files):
-			main_html = add_simple_link_content(main_html, template_element_dict, "Raw read-count Files", "Raw (sample-level) sequence counts", count_files, alias_link=True)
+			add_simple_link_content(report, "Raw read-count Files", "Raw (sample-level) sequence counts", count_files, alias_link=True)
 		if has_files(norm_count_file):
-			main_html = add_simple_link_content(main_html, template_element_dict, "Normalized read-count Files", "Normalized count file", norm_count_file, alias_link=True)		
-		if has_files(rna_qc_files):
-			main_html = add_accordion_content(main_html, template_element_dict, "RNA-Seq QC", "RNA-Seq experiment quality reports", rna_qc_files)
-		if has_files(fastqc_files):
-			main_html = add_accordion_content(main_html, template_element_dict, "FASTQC report", "Sequencing quality reports", fastqc_files)
+			add_simple_link_content(report, "Normalized read-count Files", "Normalized count file", norm_count_file, alias_link=True)		
+
+		#the QC metrics of all the samples, in one table (the per-sample QC reports are linked from it):
+		align_dirs = dict([(s, os.path.join(project_dir, str(sample_dir_prefix)+s, align_dir_name)) for s in all_samples])
+		rna_seqc_dirs = dict([(s, os.path.join(qc_dir, s)) for s in all_samples])
+		fastqc_dirs = dict([(s, [os.path.dirname(os.path.join(output_report_dir, f)) for f in files]) for s, files in fastqc_files.iteritems()])
+		qc = qc_metrics.collect(all_samples, align_dirs, rna_seqc_dirs, fastqc_dirs, fastq_stats_file, multiprocessing.cpu_count())
+		qc_metrics.write_metrics(qc, all_samples, qc_json_file, qc_tsv_file)
+		table_links = [("QC metrics (TSV)", os.path.relpath(qc_tsv_file, output_report_dir)), ("QC metrics (JSON)", os.path.relpath(qc_json_file, output_report_dir))]
+		add_qc_content(report, all_samples, qc, rna_qc_files, fastqc_files, table_links)
 
 		"""
 		Other sections of the output report include:
@@ -353,18 +595,27 @@ if __name__ == "__main__":
 
 			#parse the contrast file:
 			all_contrasts = get_contrasts(contrast_file)			
+			contrast_matcher = ContrastMatcher(all_contrasts, project_dir, contrast_tag)
 
-			deseq_files = find_files(os.path.join(project_dir, output_report_dir, "*", "*"+str(deseq_outfile_tag)+"*"), output_report_dir, contrasts=all_contrasts, tag=contrast_tag)
-			heatmap_files = find_files(os.path.join(project_dir, output_report_dir, "*", "*"+str(heatmap_file_tag)+"*"), output_report_dir, contrasts=all_contrasts, tag=contrast_tag)
-			gsea_files = find_files(os.path.join(project_dir, output_report_dir, gsea_dir, "*", gsea_default_html), output_report_dir, contrasts=all_contrasts, tag=contrast_tag)
+			deseq_files = find_files(project_index, os.path.join(project_dir, output_report_dir, "*", "*"+str(deseq_outfile_tag)+"*"), output_report_dir, contrast_matcher)
+			heatmap_files = find_files(project_index, os.path.join(project_dir, output_report_dir, "*", "*"+str(heatmap_file_tag)+"*"), output_report_dir, contrast_matcher)
+			gsea_files = find_files(project_index, os.path.join(project_dir, output_report_dir, gsea_dir, "*", gsea_default_html), output_report_dir, contrast_matcher)
 
 			if has_files(deseq_files):
-				main_html = add_simple_link_content(main_html, template_element_dict, "Differential Expression Analysis", "Results from differential expression analysis", deseq_files, alias_link=True)
+				add_simple_link_content(report, "Differential Expression Analysis", "Results from differential expression analysis", deseq_files, alias_link=True)
 			if has_files(heatmap_files):
-				main_html = add_accordion_content(main_html, template_element_dict, "Heatmaps", "Heatmaps of the most highly expressed genes in each contrast", heatmap_files)
+				add_accordion_content(report, "Heatmaps", "Heatmaps of the most highly expressed genes in each contrast", heatmap_files)
 			if has_files(gsea_files):
-				main_html = add_accordion_content(main_html, template_element_dict, "GSEA", "Gene-set enrichment analysis of each between-group contrast", gsea_files)
+				add_accordion_content(report, "GSEA", "Gene-set enrichment analysis of each between-group contrast", gsea_files)
 
+		#the resources used by the stages of the run (the report itself is recorded once it completes):
+		timeline_file = os.environ['RUN_TIMELINE_FILE']
+		timeline = load_timeline(timeline_file)
+		if timeline:
+			add_performance_content(report, timeline, os.path.relpath(timeline_file, output_report_dir))
+
+		main_html = report.serialize()
+		if not skip_analysis:
 			main_html = unhide_analysis_help(main_html)
 		write_completed_template(completed_html_report, main_html)
 
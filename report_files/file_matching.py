@@ -0,0 +1,155 @@
+"""
+Assigns the files found for the report to the samples and contrasts they belong to.
+
+A path is split into its components (relative to the project directory), and each component is matched exactly against
+the sample (or condition) names:
+  -- a directory named <SAMPLE_DIR_PREFIX><sample> belongs to that sample
+  -- a file or directory name belongs to a sample if it starts with the sample name followed by a delimiter (any
+     non-alphanumeric character) or by nothing at all.  Known suffixes are removed from file names first.
+     When several sample names qualify, the longest wins-- so 'S10_R1.fastq.gz' belongs to S10, never S1.
+  -- a name containing the CONTRAST_FLAG belongs to the contrast of the conditions on either side of the flag
+The components are searched from the file name upwards; the first that matches decides.  Since a name can only end at a
+delimiter, each component is cut at its delimiters and the pieces are looked up in a hash of the names-- so the matching
+takes time proportional to the total length of the paths, whatever the number of samples.
+"""
+
+import os
+import re
+
+DELIMITER = re.compile('[^0-9A-Za-z]')
+
+
+class NameIndex:
+    """
+    A set of names, for finding the name at the start (or end) of a string
+    """
+    def __init__(self, names):
+        self.names = set(names)
+        #delimiters further into a string than this cannot end (or begin) a name:
+        self.max_length = max([len(n) for n in self.names] or [0])
+
+    def longest_prefix(self, text):
+        """
+        Returns the longest name which text begins with, where the name is followed by the end of text
+        or by a delimiter.  Returns None if there is no such name.
+        """
+        if text in self.names:
+            return text
+        for m in reversed(list(DELIMITER.finditer(text, 0, self.max_length+1))):
+            if text[:m.start()] in self.names:
+                return text[:m.start()]
+        return None
+
+    def longest_suffix(self, text):
+        """
+        Returns the longest name which text ends with, where the name is preceded by the start of text
+        or by a delimiter.  Returns None if there is no such name.
+        """
+        if text in self.names:
+            return text
+        for m in DELIMITER.finditer(text, max(0, len(text)-self.max_length-1)):
+            if text[m.end():] in self.names:
+                return text[m.end():]
+        return None
+
+
+def path_components(path, root_prefix):
+    """
+    Splits the path (relative to the root, if it begins with root_prefix) into its components, deepest first
+    """
+    if path.startswith(root_prefix):
+        path = path[len(root_prefix):]
+    return [c for c in reversed(path.split(os.sep)) if c]
+
+
+def strip_suffixes(name, suffixes):
+    for suffix in suffixes:
+        if suffix and name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+class SampleMatcher:
+    """
+    Built once for the project's samples and used for each category of files
+    """
+    def __init__(self, samples, root, sample_dir_prefix):
+        self.samples = list(samples)
+        self.sample_set = set(self.samples)
+        self.index = NameIndex(self.samples)
+        self.root_prefix = os.path.abspath(root)+os.sep
+        self.sample_dir_prefix = sample_dir_prefix
+
+    def match(self, path, suffixes=()):
+        """
+        Returns the sample that the path belongs to, or None
+        """
+        components = path_components(path, self.root_prefix)
+        for i, component in enumerate(components):
+            if self.sample_dir_prefix and component.startswith(self.sample_dir_prefix):
+                if component[len(self.sample_dir_prefix):] in self.sample_set:
+                    return component[len(self.sample_dir_prefix):]
+            if i == 0:
+                component = strip_suffixes(component, suffixes)
+            sample = self.index.longest_prefix(component)
+            if sample is not None:
+                return sample
+        return None
+
+    def match_all(self, paths, suffixes=()):
+        """
+        Returns a dictionary mapping each sample to the (possibly empty) list of its paths, in the order given
+        """
+        matched = dict((sample, []) for sample in self.samples)
+        for path in paths:
+            sample = self.match(path, suffixes)
+            if sample is not None:
+                matched[sample].append(path)
+        return matched
+
+
+class ContrastMatcher:
+    """
+    Built once for the contrasts (tuples of two conditions) and used for each category of contrast-level files
+    """
+    def __init__(self, contrasts, root, contrast_flag):
+        self.contrasts = list(contrasts)
+        self.root_prefix = os.path.abspath(root)+os.sep
+        self.contrast_flag = contrast_flag
+        self.index = NameIndex(c for contrast in self.contrasts for c in contrast)
+        self.pairs = {}
+        for a, b in self.contrasts:
+            self.pairs[(a, b)] = (a, b)
+            self.pairs.setdefault((b, a), (a, b))
+
+    def key(self, contrast):
+        a, b = contrast
+        return str(b)+str(self.contrast_flag)+str(a)
+
+    def match(self, path):
+        """
+        Returns the contrast (as given in the contrast file) that the path belongs to, or None
+        """
+        for component in path_components(path, self.root_prefix):
+            start = component.find(self.contrast_flag)
+            while start != -1:
+                before = self.index.longest_suffix(component[:start])
+                after = self.index.longest_prefix(component[start+len(self.contrast_flag):])
+                if before is not None and after is not None:
+                    contrast = self.pairs.get((before, after))
+                    if contrast is not None:
+                        return contrast
+                start = component.find(self.contrast_flag, start+1)
+        return None
+
+    def match_all(self, paths):
+        """
+        Returns a dictionary mapping the key of each contrast to a list holding the first of its paths (in the order given).
+        Contrasts without a matching path are left out.
+        """
+        matched = {}
+        for path in paths:
+            contrast = self.match(path)
+            if contrast is not None and self.key(contrast) not in matched:
+                matched[self.key(contrast)] = [path]
+        return matched
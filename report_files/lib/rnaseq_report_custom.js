@@ -1,16 +1,85 @@
 
-//for opening/closing the sample-specific panels in the QC report
+//the lazy report mode (see LazyReportBuilder in create_report.py): the items of a section are loaded from its page
+//files, a page at a time, when the section is shown.  A page file calls loadReportPage with its items
+var reportPages = {};
+
+function loadReportPage(section, page, items){
+	reportPages[section+'.'+page] = items;
+	showReportPage(section, page);
+}
+
+function showReportPage(section, page){
+	var container = $('.lazy-section[data-section="'+section+'"]');
+	var key = section+'.'+page;
+	container.data('page', page);
+	if(!(key in reportPages)){
+		var script = document.createElement('script');
+		script.src = container.attr('data-source')+'/'+key+'.js';
+		document.body.appendChild(script);
+		return;
+	}
+	container.children('.lazy-items').html(reportPages[key].join(''));
+	var pages = parseInt(container.attr('data-pages'));
+	var pager = container.children('.lazy-pager').empty();
+	if(pages > 1){
+		pager.append($('<button class="btn btn-default lazy-page" type="button">Previous</button>').attr('data-page', page-1).prop('disabled', page == 0));
+		pager.append($('<span class="padded-link"></span>').text('Page '+(page+1)+' of '+pages));
+		pager.append($('<button class="btn btn-default lazy-page padded-link" type="button">Next</button>').attr('data-page', page+1).prop('disabled', page == pages-1));
+	}
+}
+
+//(the handlers are delegated, so they also apply to the items loaded later):
 $(document).ready(function() {
-	$('.panel-heading').click(function(){
+	//for opening/closing the sample-specific panels in the QC report.  Deferred content is inserted when a panel is first opened
+	$(document).on('click', '.panel-heading', function(){
 		var panel="_panel"
 		var view="_view"
-		var target = $(this).attr("id");
-		$('#'+target.replace(panel, view)).slideToggle();
+		var target = $('#'+$(this).attr("id").replace(panel, view));
+		target.find('.lazy-content').each(function(){
+			$(this).replaceWith($(this).attr('data-content'));
+		});
+		target.slideToggle();
 	});
-	$('.view_close').click(function(){
+	$(document).on('click', '.view_close', function(){
 		var parent_panel = $(this).parents(".content-panel");
 		parent_panel.slideToggle();
 	});
+
+	//sort a table by the clicked column (numerically, where the values are numbers), reversing on a second click:
+	$(document).on('click', 'table thead th', function(){
+		var column = $(this).index();
+		var ascending = !$(this).data('ascending');
+		$(this).data('ascending', ascending);
+		var tbody = $(this).parents('table').children('tbody');
+		var rows = tbody.children('tr').get();
+		rows.sort(function(a, b){
+			var x = $(a).children('td').eq(column).text();
+			var y = $(b).children('td').eq(column).text();
+			var nx = parseFloat(x), ny = parseFloat(y);
+			var order;
+			if(isNaN(nx) || isNaN(ny)){
+				order = isNaN(nx) - isNaN(ny) || x.localeCompare(y);
+			} else {
+				order = nx - ny;
+			}
+			return ascending ? order : -order;
+		});
+		$.each(rows, function(i, row){ tbody.append(row); });
+	});
+
+	$(document).on('click', '.lazy-page', function(){
+		var section = $(this).parents('.lazy-section').attr('data-section');
+		showReportPage(section, parseInt($(this).attr('data-page')));
+	});
+
+	//load the first page of a lazy section the first time its tab is shown:
+	$(document).on('shown.bs.tab', 'a[data-toggle="tab"]', function(e){
+		$($(e.target).attr('href')).find('.lazy-section').each(function(){
+			if($(this).data('page') === undefined){
+				showReportPage($(this).attr('data-section'), 0);
+			}
+		});
+	});
 });
 
 
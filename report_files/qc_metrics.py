@@ -0,0 +1,236 @@
+"""
+Collects the quality metrics of every sample into one table, for the QC summary of the report (see create_report.py):
+  -- the reads and read lengths of the FASTQs (from the FASTQ checks, see fastq_preflight.py)
+  -- STAR's summary of the alignment (<sample>.Log.final.out)
+  -- samtools flagstat of the raw and de-duplicated alignments, and the duplication found by Picard's MarkDuplicates
+  -- the RNA-SeQC metrics (metrics.tsv) and the FastQC summaries (fastqc_data.txt)
+The files of the samples are read in parallel.  A metric is flagged as an outlier for a sample when it lies far from the
+other samples' values (a robust z-score, from the median and the median absolute deviation, above OUTLIER_Z).
+The table is saved as JSON and as TSV.
+"""
+
+import os
+import re
+import json
+import multiprocessing
+
+#(key, column title, number of decimals) in the order they are shown:
+COLUMNS = [
+    ('fastq_reads', 'FASTQ reads', 0),
+    ('mean_read_length', 'Mean read length', 1),
+    ('star_input_reads', 'STAR input reads', 0),
+    ('star_unique_pct', 'Uniquely mapped (%)', 1),
+    ('star_multi_pct', 'Multi-mapped (%)', 1),
+    ('star_mismatch_pct', 'Mismatch rate (%)', 2),
+    ('mapped_pct', 'Mapped (flagstat, %)', 1),
+    ('dedup_reads', 'Reads after de-duplication', 0),
+    ('duplication_pct', 'Duplication (%)', 1),
+    ('exonic_pct', 'Exonic (%)', 1),
+    ('intronic_pct', 'Intronic (%)', 1),
+    ('intergenic_pct', 'Intergenic (%)', 1),
+    ('rrna_pct', 'rRNA (%)', 2),
+    ('genes_detected', 'Genes detected', 0),
+    ('gc_pct', 'GC (%)', 1),
+    ('fastqc_failed_modules', 'FastQC modules failed', 0)
+]
+
+#robust z-scores (0.6745*(value-median)/MAD) above this flag an outlier.  Fewer samples than MIN_OUTLIER_SAMPLES are not flagged:
+OUTLIER_Z = 3.5
+MIN_OUTLIER_SAMPLES = 4
+
+STAR_METRICS = {
+    'Number of input reads': 'star_input_reads',
+    'Uniquely mapped reads %': 'star_unique_pct',
+    '% of reads mapped to multiple loci': 'star_multi_pct',
+    'Mismatch rate per base, %': 'star_mismatch_pct'
+}
+
+#RNA-SeQC gives rates (fractions), which are shown as percentages:
+RNA_SEQC_METRICS = {
+    'Exonic Rate': ('exonic_pct', 100),
+    'Intronic Rate': ('intronic_pct', 100),
+    'Intergenic Rate': ('intergenic_pct', 100),
+    'rRNA rate': ('rrna_pct', 100),
+    'Genes Detected': ('genes_detected', 1)
+}
+
+FLAGSTAT_TOTAL = re.compile(r"^(\d+) \+ (\d+) in total")
+FLAGSTAT_MAPPED = re.compile(r"^(\d+) \+ (\d+) mapped \(([0-9.]+)%")
+
+
+def to_number(text):
+    try:
+        return float(text.strip().rstrip('%').replace(',', ''))
+    except ValueError:
+        return None
+
+
+def read_lines(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().splitlines()
+    except IOError:
+        return None
+
+
+def parse_star_log(path):
+    metrics = {}
+    for line in read_lines(path) or []:
+        if '|' in line:
+            name, value = [x.strip() for x in line.split('|', 1)]
+            if name in STAR_METRICS:
+                metrics[STAR_METRICS[name]] = to_number(value)
+    return metrics
+
+
+def parse_flagstat(path):
+    """
+    Returns the total reads and the percentage mapped (either may be None) of a samtools flagstat output
+    """
+    total, mapped_pct = None, None
+    for line in read_lines(path) or []:
+        m = FLAGSTAT_TOTAL.match(line)
+        if m:
+            total = int(m.group(1))+int(m.group(2))
+        m = FLAGSTAT_MAPPED.match(line)
+        if m:
+            mapped_pct = float(m.group(3))
+    return total, mapped_pct
+
+
+def parse_duplication_metrics(path):
+    """
+    Returns the PERCENT_DUPLICATION (as a percentage) of a Picard MarkDuplicates metrics file, or None
+    """
+    lines = read_lines(path) or []
+    for i, line in enumerate(lines):
+        if line.startswith('## METRICS CLASS') and i+2 < len(lines):
+            header, values = lines[i+1].split('\t'), lines[i+2].split('\t')
+            if 'PERCENT_DUPLICATION' in header and len(values) == len(header):
+                value = to_number(values[header.index('PERCENT_DUPLICATION')])
+                return None if value is None else value*100
+    return None
+
+
+def parse_rna_seqc_metrics(path):
+    lines = read_lines(path) or []
+    metrics = {}
+    if len(lines) >= 2:
+        for name, value in zip(lines[0].split('\t'), lines[1].split('\t')):
+            if name in RNA_SEQC_METRICS:
+                key, scale = RNA_SEQC_METRICS[name]
+                number = to_number(value)
+                metrics[key] = None if number is None else number*scale
+    return metrics
+
+
+def parse_fastqc_data(path):
+    """
+    Returns the %GC and the names of the failed modules of a FastQC report (fastqc_data.txt)
+    """
+    gc, failed = None, []
+    for line in read_lines(path) or []:
+        if line.startswith('>>') and not line.startswith('>>END_MODULE'):
+            fields = line[2:].split('\t')
+            if len(fields) > 1 and fields[1].strip() == 'fail':
+                failed.append(fields[0])
+        elif line.startswith('%GC\t'):
+            gc = to_number(line.split('\t')[1])
+    return gc, failed
+
+
+def collect_sample(args):
+    """
+    Reads the metrics of one sample (as it is run by a process pool).  args is (sample name, alignment directory,
+    RNA-SeQC directory, [FastQC report directories]).  Returns (sample name, metrics dictionary)
+    """
+    sample, align_dir, rna_seqc_dir, fastqc_dirs = args
+    metrics = parse_star_log(os.path.join(align_dir, sample+'.Log.final.out'))
+
+    #(a sharded sample has no flagstat of its raw alignments, only of its merged primary alignments):
+    total, mapped_pct = parse_flagstat(os.path.join(align_dir, 'flagstat.raw.sorted.BAM.out'))
+    if mapped_pct is None:
+        total, mapped_pct = parse_flagstat(os.path.join(align_dir, 'flagstat.merged.primary.BAM.out'))
+    metrics['mapped_pct'] = mapped_pct
+    metrics['dedup_reads'] = parse_flagstat(os.path.join(align_dir, 'flagstat.dedupBAM.out'))[0]
+    metrics['duplication_pct'] = parse_duplication_metrics(os.path.join(align_dir, sample+'.sort.dedup.metrics.out'))
+    metrics.update(parse_rna_seqc_metrics(os.path.join(rna_seqc_dir, 'metrics.tsv')))
+
+    gcs, failed = [], set()
+    for fastqc_dir in fastqc_dirs:
+        gc, failed_modules = parse_fastqc_data(os.path.join(fastqc_dir, 'fastqc_data.txt'))
+        if gc is not None:
+            gcs.append(gc)
+        failed.update(failed_modules)
+    metrics['gc_pct'] = sum(gcs)/len(gcs) if gcs else None
+    metrics['fastqc_failed_modules'] = len(failed) if gcs else None
+    metrics['fastqc_failed'] = sorted(failed)
+    return sample, metrics
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid-1]+values[mid])/2.0
+
+
+def find_outliers(table):
+    """
+    Returns {sample: [keys of the metrics that are outliers]}
+    """
+    outliers = dict((sample, []) for sample in table)
+    for key, title, decimals in COLUMNS:
+        values = dict((s, m[key]) for s, m in table.items() if m.get(key) is not None)
+        if len(values) < MIN_OUTLIER_SAMPLES:
+            continue
+        center = median(values.values())
+        mad = median([abs(v-center) for v in values.values()])
+        if mad == 0:
+            continue
+        for sample, value in values.items():
+            if abs(0.6745*(value-center)/mad) > OUTLIER_Z:
+                outliers[sample].append(key)
+    return outliers
+
+
+def format_value(value, decimals):
+    if value is None:
+        return "NA"
+    return "%.*f" % (decimals, value)
+
+
+def collect(samples, align_dirs, rna_seqc_dirs, fastqc_dirs, fastq_stats_file, workers):
+    """
+    Collects the metrics of the samples (in parallel), given their alignment and RNA-SeQC directories and their FastQC
+    report directories (dictionaries keyed by sample).  Returns {'columns': ..., 'samples': ..., 'outliers': ...}
+    """
+    args = [(s, align_dirs[s], rna_seqc_dirs[s], fastqc_dirs.get(s, [])) for s in samples]
+    pool = multiprocessing.Pool(max(1, min(workers, len(args))))
+    try:
+        table = dict(pool.map(collect_sample, args, chunksize=1))
+    finally:
+        pool.close()
+        pool.join()
+
+    try:
+        with open(fastq_stats_file, 'r') as f:
+            fastq_stats = json.load(f).get('samples', {})
+    except (IOError, ValueError):
+        fastq_stats = {}
+    for sample in samples:
+        stats = fastq_stats.get(sample, {})
+        table[sample]['fastq_reads'] = stats.get('reads')
+        table[sample]['mean_read_length'] = stats.get('mean_length')
+
+    return {'columns': [[key, title] for key, title, decimals in COLUMNS], 'samples': table, 'outliers': find_outliers(table)}
+
+
+def write_metrics(qc_metrics, samples, json_file, tsv_file):
+    with open(json_file, 'w') as f:
+        json.dump(qc_metrics, f, indent=1, sort_keys=True)
+    with open(tsv_file, 'w') as f:
+        f.write("\t".join(['Sample']+[title for key, title, decimals in COLUMNS]+['Outliers'])+"\n")
+        for sample in samples:
+            metrics = qc_metrics['samples'][sample]
+            row = [format_value(metrics.get(key), decimals) for key, title, decimals in COLUMNS]
+            f.write("\t".join([sample]+row+[",".join(qc_metrics['outliers'][sample])])+"\n")
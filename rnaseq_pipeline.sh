@@ -25,6 +25,8 @@ function usage
                 -no_dedup (optional, default will dedup the BAM files.  Final result is a sorted, primary BAM file)
                 -a | --aligner <STAR | SNAPR> (optional, default is STAR)
                 -skip_analysis (optional, if generating only BAM, count files, and QC.  Skips differential expression analysis.)
+                -resume (optional, allows an existing output directory.  Steps that are up to date from an earlier run are skipped.)
+                -watch (optional, align the samples as they arrive in the project directory, and continue once the sequencer's completion marker appears.  See watch_project.py)
                 -test (optional, for simple test)"
         echo "**************************************************************************************************"
 }
@@ -126,6 +128,12 @@ while [ "$1" != "" ]; do
                 -no_rna_qc )
                         SKIP_RNA_QC=1
                         ;;
+                -resume )
+                        RESUME=1
+                        ;;
+                -watch )
+                        WATCH=1
+                        ;;
 		-h | --help )
 			usage
 			exit
@@ -193,6 +201,22 @@ if [ "$SKIP_RNA_QC" == "" ]; then
     SKIP_RNA_QC=0
 fi
 
+#if RESUME was not set, the target directory must not exist yet
+if [ "$RESUME" == "" ]; then
+    RESUME=0
+fi
+
+#if WATCH was not set, align the samples that are in the project directory now
+if [ "$WATCH" == "" ]; then
+    WATCH=0
+fi
+
+if [ $WATCH -eq 1 ] && [ $ALN -eq 0 ]; then
+    echo -e "\n\nERROR: -watch aligns the samples as they arrive, so it cannot be used with -noalign.  Please try again.\n\n"
+    usage
+    exit 1
+fi
+
 #if the aligner was not explicitly set, default to STAR
 if [ "$ALIGNER" == "" ]; then
     ALIGNER=STAR
@@ -232,6 +256,11 @@ set +a
 
 ############# After inputs have been read, proceed with setting up parameters based on these inputs:  #################################
 
+# a test run (whose alignments are mocked) neither uses nor adds to the artifact store of alignments:
+if [ $TEST -eq $NUM1 ]; then
+    ARTIFACT_STORE_DIR=""
+fi
+
 # if DEDUP was not set to zero (using the -no_dedup flag), then set it to 1 for true
 # also set the file extension tag for the final BAM file.
 if [ "$DEDUP" == "" ]; then
@@ -253,11 +282,14 @@ if [ "$SAMPLES_FILE" == "" ]; then
 
     #create a sample annotation file by parsing the directory structure and assigning a dummy group annotation
     SAMPLES_FILE=$PROJECT_DIR/samples.txt
-    ls -d $PROJECT_DIR/$SAMPLE_DIR_PREFIX* | sed -e "s/.*$SAMPLE_DIR_PREFIX//g" | sed -e 's/$/\tX/g' >$SAMPLES_FILE
+    #(in watch mode, the samples that arrive later are added to it)
+    WATCH_INFER_SAMPLES=1
+    ls -d $PROJECT_DIR/$SAMPLE_DIR_PREFIX* 2>/dev/null | sed -e "s/.*$SAMPLE_DIR_PREFIX//g" | sed -e 's/$/\tX/g' >$SAMPLES_FILE
 fi
 
 
 ###############  identify the correct genome files to use  ######################################################
+# (STAR_MEMORY_GB and SNAPR_MEMORY_GB are the memory, in GB, that one alignment against the assembly's index needs)
 if [[ "$ASSEMBLY" == hg19 ]]; then
     GTF=/cccbstore-rc/projects/db/genomes/Human/GRCh37.75/GTF/Homo_sapiens.GRCh37.75.gtf
     GENOMEFASTA=/cccbstore-rc/projects/db/genomes/Human/GRCh37.75/Homo_sapiens.GRCh37.75.dna.primary_assembly.reordered.fa
@@ -265,6 +297,8 @@ if [[ "$ASSEMBLY" == hg19 ]]; then
     SNAPR_TRANSCRIPTOME_INDEX=/cccbstore-rc/projects/db/genomes/Human/GRCh37.75/SNAPR/transcriptome-dir
     STAR_GENOME_INDEX=/cccbstore-rc/projects/db/genomes/Human/GRCh37.75/STAR_INDEX  
     GTF_FOR_RNASEQC=/cccbstore-rc/projects/db/genomes/Human/GRCh37.75/GTF/Homo_sapiens.GRCh37.75.transcript_id.chr_trimmed.gtf
+    STAR_MEMORY_GB=32
+    SNAPR_MEMORY_GB=48
 elif [[ "$ASSEMBLY" == mm9 ]]; then
     GTF=/cccbstore-rc/projects/db/genomes/Mm/build37/Mus_musculus.NCBIM37.62.edit.gtf
     GENOMEFASTA=/cccbstore-rc/projects/db/genomes/Mm/build37/mm9.fa
@@ -272,6 +306,8 @@ elif [[ "$ASSEMBLY" == mm9 ]]; then
     SNAPR_TRANSCRIPTOME_INDEX=
     STAR_GENOME_INDEX=/cccbstore-rc/projects/db/genomes/Mm/build37/STAR_INDEX
     GTF_FOR_RNASEQC=/cccbstore-rc/projects/db/genomes/Mm/build37/Mus_musculus.NCBIM37.62.edit.gtf #filtering to require transcript_id attribute yielded same number of rows.
+    STAR_MEMORY_GB=30
+    SNAPR_MEMORY_GB=
 elif [[ "$ASSEMBLY" == mm10 ]]; then
     GTF=/cccbstore-rc/projects/db/genomes/Mm/build38/Mus_musculus.GRCm38.75.chr_trimmed.gtf
     GENOMEFASTA=/cccbstore-rc/projects/db/genomes/Mm/build38/mm10.fa
@@ -279,6 +315,8 @@ elif [[ "$ASSEMBLY" == mm10 ]]; then
     SNAPR_TRANSCRIPTOME_INDEX=/cccbstore-rc/projects/db/genomes/Mm/build38/snapr_transcriptome_index
     STAR_GENOME_INDEX=/cccbstore-rc/projects/db/genomes/Mm/build38/STAR_INDEX
     GTF_FOR_RNASEQC=/cccbstore-rc/projects/db/genomes/Mm/build38/Mus_musculus.GRCm38.75.transcript_id.chr_trimmed.gtf
+    STAR_MEMORY_GB=30
+    SNAPR_MEMORY_GB=48
 elif [[ "$ASSEMBLY" == tb_h37rv_2 ]]; then
     GTF=/cccbstore-rc/projects/db/genomes/M_tuberculosis/h37rv_2/mycobacterium_tuberculosis_h37rv_2_transcripts.gtf
     GENOMEFASTA=/cccbstore-rc/projects/db/genomes/M_tuberculosis/h37rv_2/mycobacterium_tuberculosis_h37rv_2_supercontigs.fasta
@@ -286,6 +324,8 @@ elif [[ "$ASSEMBLY" == tb_h37rv_2 ]]; then
     SNAPR_TRANSCRIPTOME_INDEX=
     STAR_GENOME_INDEX=/cccbstore-rc/projects/db/genomes/M_tuberculosis/h37rv_2/STAR_INDEX
     GTF_FOR_RNASEQC=
+    STAR_MEMORY_GB=2
+    SNAPR_MEMORY_GB=
 elif [[ "$ASSEMBLY" == a_fumigatus_af293 ]]; then
     GTF=/cccbstore-rc/projects/db/genomes/a_fumigatus/af293/final.edit.gtf
     GENOMEFASTA=/cccbstore-rc/projects/db/genomes/a_fumigatus/af293/A_fumigatus_Af293_current_chromosomes.fasta
@@ -293,6 +333,8 @@ elif [[ "$ASSEMBLY" == a_fumigatus_af293 ]]; then
     SNAPR_TRANSCRIPTOME_INDEX=
     STAR_GENOME_INDEX=/cccbstore-rc/projects/db/genomes/a_fumigatus/af293/STAR_INDEX
     GTF_FOR_RNASEQC=/cccbstore-rc/projects/db/genomes/a_fumigatus/af293/final.edit.rna_seqc.gtf
+    STAR_MEMORY_GB=4
+    SNAPR_MEMORY_GB=
 else
     echo "Unknown or un-indexed genome."
     exit 1
@@ -304,12 +346,14 @@ if [[ $ALIGNER == $STAR  ]]; then
     ALIGN_SCRIPT=$STAR_ALIGN_SCRIPT
     GENOME_INDEX=$STAR_GENOME_INDEX
     TRANSCRIPTOME_INDEX=    #nothing
+    ALIGN_MEMORY_GB=$STAR_MEMORY_GB
     ALIGNER_REF_URL=$STAR_REF_URL
 elif [[ $ALIGNER == $SNAPR ]]; then
     ALN_DIR_NAME=$SNAPR_ALIGN_DIR
     ALIGN_SCRIPT=$SNAPR_ALIGN_SCRIPT
     GENOME_INDEX=$SNAPR_GENOME_INDEX
     TRANSCRIPTOME_INDEX=$SNAPR_TRANSCRIPTOME_INDEX    
+    ALIGN_MEMORY_GB=$SNAPR_MEMORY_GB
     ALIGNER_REF_URL=$SNAPR_REF_URL
 else
     echo -e "\n\nERROR: Unrecognized aligner.  Exiting\n\n"
@@ -319,12 +363,17 @@ fi
 # construct the full paths to some files by prepending the project directory:
 export VALID_SAMPLE_FILE=$PROJECT_DIR'/'$VALID_SAMPLE_FILE
 export DESIGN_MTX_FILE=$PROJECT_DIR'/'$DESIGN_MTX_FILE
+export ALIGN_RESOURCE_FILE=$PROJECT_DIR'/'$ALIGN_RESOURCE_FILE
 
 #create a report directory to hold the report and the output analysis:
 export REPORT_DIR=$PROJECT_DIR'/'$REPORT_DIR
-mkdir $REPORT_DIR
+mkdir -p $REPORT_DIR
 
 export COUNTS_DIR=$REPORT_DIR'/'$COUNTS_DIR
+export RUN_TIMELINE_FILE=$REPORT_DIR'/'$RUN_TIMELINE_FILE
+#the timeline (and its part of the report) is of this run only:
+> $RUN_TIMELINE_FILE
+export FASTQ_STATS_FILE=$REPORT_DIR'/'$FASTQ_STATS_FILE
 
 # export some additional variables:
 export ASSEMBLY
@@ -341,6 +390,7 @@ export ALN_DIR_NAME
 export ALIGN_SCRIPT
 export GENOME_INDEX
 export TRANSCRIPTOME_INDEX
+export ALIGN_MEMORY_GB
 export ALIGNER_REF_URL
 export SKIP_ANALYSIS
 
@@ -357,7 +407,14 @@ export SKIP_ANALYSIS
 LOGFILE=log.txt
 
 #create the target directory where the logfile (and analysis) will be placed
-mkdir $TARGET_DIR || { echo -e "\n\nCould not create your target directory (does it already exist? Do you have the proper permissions?).  Try again. Exiting.\n\n"; exit 1; }
+#when resuming an earlier run, the directory may already exist and the log is appended to
+if [ $RESUME -eq $NUM1 ]; then
+	mkdir -p $TARGET_DIR || { echo -e "\n\nCould not create your target directory (Do you have the proper permissions?).  Try again. Exiting.\n\n"; exit 1; }
+	TEE_OPTS="-a"
+else
+	mkdir $TARGET_DIR || { echo -e "\n\nCould not create your target directory (does it already exist? Do you have the proper permissions?).  Try again, or use -resume.  Exiting.\n\n"; exit 1; }
+	TEE_OPTS=""
+fi
 
 
 #open brace for "logging block"-- everything inside the braces is tee'd into the logfile
@@ -412,13 +469,27 @@ if ! which java ; then
 	exit 1
 fi
 
-PYTHON='/cccbstore-rc/projects/cccb/apps/bin/python2.7'
+#(PIPELINE_PYTHON selects another interpreter, e.g. for the benchmarks in benchmarks/)
+PYTHON=${PIPELINE_PYTHON:-'/cccbstore-rc/projects/cccb/apps/bin/python2.7'}
 #check for python- for regex syntax need 2.7 or greater!
 if ! which $PYTHON ; then
 	echo "Could not access python located at $PYTHON.  Require version 2.7 or greater"
 	exit 1
 fi
 
+#compile the annotation (once for each GTF, see annotation_cache.py), and derive the GTF for RNA-SeQC from it:
+if [ $TEST -eq $NUM0 ] && [ -f "$GTF" ]; then
+	$PYTHON $ANNOTATION_CACHE_SCRIPT compile || { echo "Could not compile the annotation $GTF.  Exiting"; exit 1; }
+	if [ $DERIVE_RNA_SEQC_GTF -eq $NUM1 ] && [ $SKIP_RNA_QC -eq $NUM0 ]; then
+		if DERIVED_GTF=$($PYTHON $ANNOTATION_CACHE_SCRIPT rna_seqc_gtf $GENOMEFASTA); then
+			GTF_FOR_RNASEQC=$DERIVED_GTF
+		else
+			echo "(Warning) Could not derive the GTF for RNA-SeQC from $GTF.  Using the prepared GTF of the assembly instead."
+		fi
+		echo "GTF for RNA-SeQC: $GTF_FOR_RNASEQC"
+	fi
+fi
+
 
 echo "
 #########################################################################################################################################
@@ -428,7 +499,17 @@ echo "
 #########################################################################################################################################
 "
 
-if [ $ALN -eq $NUM1 ]; then
+if [ $WATCH -eq $NUM1 ]; then
+
+    #align the samples as they land from the sequencer (the valid sample file is appended to as their alignments finish),
+    #until the completion marker appears in the project directory:
+    > $VALID_SAMPLE_FILE
+    TEST=$TEST WATCH_INFER_SAMPLES=${WATCH_INFER_SAMPLES:-0} $PYTHON $WATCH_PROJECT_SCRIPT || { echo "Something went wrong while watching the project for samples.  Exiting"; exit 1; }
+
+    echo "The sequencing is complete.  Aligned the following samples:"
+    print_sample_report $VALID_SAMPLE_FILE
+
+elif [ $ALN -eq $NUM1 ]; then
 
     #call a python script that scans the sample directory, checks for the correct files,
     # and injects the proper parameters into the alignment shell script
@@ -438,45 +519,10 @@ if [ $ALN -eq $NUM1 ]; then
     echo "After examining project structure, will attempt to align on the following samples:"
     print_sample_report $VALID_SAMPLE_FILE
 
-    #given the valid samples (determined by the python script), run the alignment
-    # note that this is NOT done in parallel!  SNAPR and STAR are VERY memory intensive
-
-    for sample in $( cut -f1 $VALID_SAMPLE_FILE ); do
-		FLAG=0
-		ATTEMPTS=0
-		#while loop attempts to submit/wait the same job if there happens to be another star/snapr process running
-		while [ $FLAG -eq 0 ]; do
-			#check if other SNAPR or STAR processes are running first:
-			if [ "$(pgrep $SNAPR_PROCESS)" == "" ] && [ "$(pgrep $STAR)" == "" ]; then
-				ALN_SCRIPT=$PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$sample'/'$sample$FORMATTED_ALIGN_SCRIPT_NAMETAG
-			        chmod a+x $ALN_SCRIPT
-      				echo -e "\nRun alignment with script at: $ALN_SCRIPT \n"
-				date
-				
-				#kickoff the script and wait until completion:
-			        if [ $TEST -eq $NUM0 ]; then
-					$ALN_SCRIPT                
-				else
-					echo "...[Mock alignment]..."
-					mkdir $PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$sample'/'$ALN_DIR_NAME
-					touch $PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$sample'/'$ALN_DIR_NAME'/'$sample$FINAL_BAM_SUFFIX
-				fi
-				echo "Alignment on sample $sample completed at: "
-				date
-				FLAG=1 #to break out of while loop
-			else
-				if [ $ATTEMPTS -le $MAX_ALIGN_ATTEMPTS ]; then
-					echo "Another snapr or star process is running.  Will sleep for $SLEEP_TIME seconds and try again. (Max attempts=$MAX_ALIGN_ATTEMPTS)"
-					sleep $SLEEP_TIME
-					let ATTEMPTS+=1
-				else
-					echo "Reached the maximum amount of attempts.  Exiting with task incomplete."
-					exit 1
-				fi
-			fi
-		done
-	
-    done
+    #given the valid samples (determined by the python script), run the alignments.
+    # SNAPR and STAR are VERY memory intensive, so an alignment is only started once the memory it needs is available
+    # (shared with any other pipelines running on this host).  Samples that are up to date are skipped.
+    TEST=$TEST $PYTHON $RUN_ALIGNMENTS_SCRIPT || { echo "Something went wrong in running the alignments.  Exiting"; exit 1; }
 
 else  # if did not ask for alignment, find the BAM files that are implied to exist:
 
@@ -488,34 +534,36 @@ else  # if did not ask for alignment, find the BAM files that are implied to exi
 
     #given bam files contained anywhere in PROJECT_DIR, construct the assumed project
     #hierarchy and create symbolic links to the bam files
+    #(start from an empty valid sample file, in case this is a re-run)
+    > $VALID_SAMPLE_FILE
 
-    while read line; do
-    	SAMPLE=$(echo $line | awk '{print $1}')
+    #find bam files that begin with the sample name and end with the proper extension.  There may be >1, so take the LAST modified.
+    #The project directory is scanned once for all samples (rather than once per sample):
+    LATEST_BAM_LIST=$PROJECT_DIR'/latest_bam_files.txt'
+    $PYTHON $PROJECT_INDEX_SCRIPT newest_bams > $LATEST_BAM_LIST \
+        || { echo "Failed to search the project directory for BAM files.  Exiting."; exit 1; }
+
+    while IFS=$'\t' read SAMPLE CONDITION LATEST_BAM_FILE; do
 
 	#the name of the link (in our convention) which will link to the original bam file
 	FINAL_BAM_FILE=$SAMPLE$FINAL_BAM_SUFFIX
-	
-	#find bam files that begin with the sample name and end with the proper extension.  There may be >1, so we have to watch for that.
-	ALL_BAM_FILES=( $( find -L $PROJECT_DIR -type f -name $SAMPLE*$TARGET_BAM | xargs ls -t) ) #an array!  sorted by time
-
-        #take the LAST modified BAM file that matches the target:
-        LATEST_BAM_FILE=${ALL_BAM_FILES[0]}
 
 	if [ "$LATEST_BAM_FILE" != "" ]; then
 		echo "Most recent BAM file for $SAMPLE: $LATEST_BAM_FILE"
 		SAMPLE_ALN_DIR=$PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$SAMPLE'/'$ALN_DIR_NAME
 		mkdir -p $SAMPLE_ALN_DIR
-		ln -s $LATEST_BAM_FILE $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE
-		if [ ! -e "$LATEST_BAM_FILE$BAM_IDX_EXTENSION" ]; then
-			samtools index $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE				
-		else
-			ln -s $LATEST_BAM_FILE$BAM_IDX_EXTENSION $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE$BAM_IDX_EXTENSION
+		ln -sf $LATEST_BAM_FILE $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE
+		#link the index, if there is one.  Missing or out-of-date indexes are built (in parallel) when the BAM files are checked, below
+		rm -f $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE$BAM_IDX_EXTENSION
+		if [ -e "$LATEST_BAM_FILE$BAM_IDX_EXTENSION" ]; then
+			ln -sf $LATEST_BAM_FILE$BAM_IDX_EXTENSION $SAMPLE_ALN_DIR'/'$FINAL_BAM_FILE$BAM_IDX_EXTENSION
 		fi
-		printf "%s\t%s\n" $(echo $SAMPLE) $(echo $line | awk '{print $2}') >> $VALID_SAMPLE_FILE
+		printf "%s\t%s\n" $SAMPLE $CONDITION >> $VALID_SAMPLE_FILE
 	else
 		echo "Could not locate a properly named BAM file for sample "$SAMPLE
 	fi
-    done < $SAMPLES_FILE
+    done < $LATEST_BAM_LIST
+    rm $LATEST_BAM_LIST
 
     echo "Found BAM files for the following samples:"
     print_sample_report $VALID_SAMPLE_FILE
@@ -531,18 +579,19 @@ echo "
 "
 
 
-########## check for the appropriate bam files and update the valid sample file accordingly: #####################################################
-$PYTHON $CHECK_BAM_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error when checking for BAM files, prior to read counting.  Exiting"; exit 1; }
+########## check for the appropriate bam files (and their headers and indexes) and update the valid sample file accordingly: ######################
+TEST=$TEST SKIP_RNA_QC=$SKIP_RNA_QC $PYTHON $CHECK_BAM_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error when checking for BAM files, prior to read counting.  Exiting"; exit 1; }
 
 echo "
 #########################################################################################################################################
 #                                                                                                                                       #
-#                                                     Read Counting Section                                                             #
+#                                                     Post-alignment Section                                                            #
 #                                                                                                                                       #
 #########################################################################################################################################
 "
 
-# create or move the count files to prepare for differential analysis:
+# read counting, RNA-SeQC, DESeq and GSEA are run by the stage executor, which runs the per-sample and per-contrast
+# jobs concurrently (within the MAX_STAGE_CPUS/MAX_STAGE_MEMORY_GB budget) as their dependencies complete
 
 mkdir -p $COUNTS_DIR
 
@@ -551,209 +600,51 @@ if [ ! -d "$COUNTS_DIR" ]; then
     exit 1
 fi
 
-if [ $TEST -eq $NUM0 ]; then
-
-	#if used STAR for alignment or was directly provided with BAM files, get the read counts: 
-	if [[ $ALIGNER == $STAR  ]] || [[ $ALN -eq $NUM0 ]] ; then
-
-		#a tag for the temporary count file:
-		TMP='.tmp'
-
-    		#create the count files from the BAM files
-    		for sample in $( cut -f1 $VALID_SAMPLE_FILE ); do
-		    COUNT_FILE=$COUNTS_DIR'/'$sample$COUNTFILE_SUFFIX
-
-    		    featureCounts -a $GTF \
-				  -o $COUNT_FILE$TMP \
-				  -t exon \
-				  -g gene_name $PROJECT_DIR"/"$SAMPLE_DIR_PREFIX$sample"/"$ALN_DIR_NAME"/"$sample$FINAL_BAM_SUFFIX
-
-		    Rscript \
-			$PROCESS_COUNT_FILE_SCRIPT \
-			$COUNT_FILE$TMP \
-			$COUNT_FILE || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Parsing of the raw count files failed.  Exiting."; exit 1; }
-		    
-                    rm $COUNT_FILE$TMP &
-    		done
-
-	elif [[ $ALIGNER == $SNAPR ]]; then
-	    #move the count files
-	    for sample in $( cut -f1 $VALID_SAMPLE_FILE ); do
-	    	mv $PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$sample'/'$ALN_DIR_NAME'/'$sample$SORTED_TAG$COUNTFILE_SUFFIX $COUNTS_DIR'/'$sample$COUNTFILE_SUFFIX        
-            done
-	fi
+# the counts of all samples are combined into the count matrix (and exported as a CSV file):
+COUNT_MATRIX_DIR=$PROJECT_DIR'/'$COUNT_MATRIX_DIR
+RAW_COUNT_MATRIX_FILE=$COUNTS_DIR'/'$RAW_COUNT_MATRIX_FILE
+export COUNT_MATRIX_DIR
+export RAW_COUNT_MATRIX_FILE
 
-#if test case (create dummy files in counts directory):
-else 
-	for sample in $( cut -f1 $VALID_SAMPLE_FILE ); do
-		touch $COUNTS_DIR'/'$sample$COUNTFILE_SUFFIX
-	done
-fi
-
-# with the count files moved, create a design matrix for count normalization/DESeq:
-$PYTHON $CREATE_DESIGN_MATRIX_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Failed in creating design matrix.  Exiting"; exit 1; }
-
-# create a normalized count matrix via DESeq:
+# the normalized count matrix is produced by normalize_counts.py (with DESeq's median-of-ratios size factors):
 NORMALIZED_COUNTS_FILE=$COUNTS_DIR'/'$NORMALIZED_COUNTS_FILE
 export NORMALIZED_COUNTS_FILE
 
-if [ $TEST -eq $NUM0 ]; then
-	Rscript $NORMALIZED_COUNTS_SCRIPT $DESIGN_MTX_FILE $NORMALIZED_COUNTS_FILE
-else
-	echo "Perform mock normalized counts with DESeq."
-fi
-
-
-echo "
-#########################################################################################################################################
-#                                                                                                                                       #
-#                                                     Read Counting Section (end)                                                       #
-#                                                                                                                                       #
-#########################################################################################################################################
-"
-
-
-echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                       RNA-SEQC SECTION                                                  #  
-#                                                                                                         #  
-###########################################################################################################
-"
-
-if [ $SKIP_RNA_QC -eq $NUM0 ]; then
- 
-	#create the reports with RNA-seQC:
-	while read line; do
- 		SAMPLE=$(echo $line | awk '{print $1}')
-		SAMPLE_BAM=$PROJECT_DIR'/'$SAMPLE_DIR_PREFIX$SAMPLE'/'$ALN_DIR_NAME'/'$SAMPLE$FINAL_BAM_SUFFIX
-
-	        #create output directory
-	        SAMPLE_QC_DIR=$REPORT_DIR'/'$RNA_SEQC_DIR'/'$SAMPLE
-	        mkdir -p $SAMPLE_QC_DIR
- 
-	    	if [ $TEST -eq $NUM0 ]; then
-			java -jar $RNA_SEQC_JAR \
-			-o $SAMPLE_QC_DIR \
-			-r $GENOMEFASTA \
-			-s "$SAMPLE|$SAMPLE_BAM|-" \
-			-t $GTF_FOR_RNASEQC || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Something failed on performing QC step.  Check the output for guidance."; }
-		else
-			echo "Perform mock QC analysis, etc. on "$SAMPLE
-		fi
-	done < $VALID_SAMPLE_FILE
-fi
-
-echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                       RNA-SEQC SECTION   (end)                                          #  
-#                                                                                                         #  
-###########################################################################################################
-"
-
-
-echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                            DESEQ SECTION                                                #  
-#                                                                                                         #  
-###########################################################################################################
-"
-
 if [ $SKIP_ANALYSIS -eq $NUM0 ]; then
 
-	#first create an output directory for the deseq scripts that will be run:
+	#create output directories for the deseq scripts and GSEA analyses that will be run:
 	DESEQ_RESULT_DIR=$REPORT_DIR'/'$DESEQ_RESULT_DIR
-	mkdir $DESEQ_RESULT_DIR
-
-
-	if [ -e "$CONTRAST_FILE" ]; then
-		echo "Run differential expression with DESeq"
-		while read contrast; do
-    			conditionA=$(echo $contrast | awk '{print $1}')
-    			conditionB=$(echo $contrast | awk '{print $2}')
-
-    			if [ $TEST -eq $NUM0 ]; then
-    				echo Rscript $DESEQ_SCRIPT $DESEQ_RESULT_DIR $DESIGN_MTX_FILE $DESEQ_OUTFILE_TAG $conditionA $conditionB $HEATMAP_FILE $HEATMAP_GENE_COUNT $CONTRAST_FLAG
-    				Rscript $DESEQ_SCRIPT $DESEQ_RESULT_DIR $DESIGN_MTX_FILE $DESEQ_OUTFILE_TAG $conditionA $conditionB $HEATMAP_FILE $HEATMAP_GENE_COUNT $CONTRAST_FLAG || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error during DESeq script.  Exiting"; exit 1; }
-			else
-				echo "Perform mock DESeq step on contrast between "$conditionA "and" $conditionB
-    			fi
-		done < $CONTRAST_FILE
-	else
-		echo -e "\nSkipping differential analysis since no contrast file was specified.\n"
-	fi
-else
-	echo -e "\nSkipping differential analysis since -skip_analysis flag was set.\n"
-fi
-
-echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                            DESEQ SECTION  (end)                                         #  
-#                                                                                                         #  
-###########################################################################################################
-"
-
-
-echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                              GSEA SECTION                                               #  
-#                                                                                                         #  
-###########################################################################################################
-"
+	mkdir -p $DESEQ_RESULT_DIR
+	DESEQ_WORK_DIR=$PROJECT_DIR'/'$DESEQ_WORK_DIR
 
-if [ $SKIP_ANALYSIS -eq $NUM0 ]; then
-
-	#create the GSEA directory:
 	GSEA_OUTPUT_DIR=$REPORT_DIR'/'$GSEA_OUTPUT_DIR
-	mkdir $GSEA_OUTPUT_DIR
-	export GSEA_OUTPUT_DIR
-	
-	#create the formatted GSEA input files
+	mkdir -p $GSEA_OUTPUT_DIR
+
+	#the formatted GSEA input files:
 	GSEA_CLS_FILE=$GSEA_OUTPUT_DIR'/'$GSEA_CLS_FILE
 	GSEA_GCT_FILE=$GSEA_OUTPUT_DIR'/'$GSEA_GCT_FILE
-
-	Rscript $CREATE_GSEA_CLS_SCRIPT $VALID_SAMPLE_FILE $GSEA_CLS_FILE
-	Rscript $CREATE_GSEA_GCT_SCRIPT $NORMALIZED_COUNTS_FILE $VALID_SAMPLE_FILE $GSEA_GCT_FILE
-
-
-	if [ -e "$CONTRAST_FILE" ]; then
-	        while read contrast; do
-        	        conditionA=$(echo $contrast | awk '{print $1}')
-                	conditionB=$(echo $contrast | awk '{print $2}')
-
-      	        	if [ $TEST -eq $NUM0 ]; then
-				$RUN_GSEA_SCRIPT \
-				$GSEA_JAR \
-				$GSEA_ANALYSIS \
-				$GSEA_GCT_FILE \
-				$GSEA_CLS_FILE \
-				$conditionA'_versus_'$conditionB \
-				$DEFAULT_GMX_FILE \
-				$NUM_GSEA_PERMUTATIONS \
-				$conditionA$CONTRAST_FLAG$conditionB \
-				$DEFAULT_CHIP_FILE \
-				$GSEA_OUTPUT_DIR || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error occurred in running GSEA.  Exiting."; exit 1; }
-         	        else
-                    		echo "Perform mock GSEA step on contrast between "$conditionA "and" $conditionB
-			fi
-        	done < $CONTRAST_FILE
-	else
-	    	echo -e "\nSkipping GSEA analysis since no contrast file was specified.\n"
-	fi
-else
-	echo -e "\nSkipping GSEA analysis since -skip_analysis flag was set.\n"
 fi
 
+export PYTHON
+export TEST
+export ALN
+export SKIP_RNA_QC
+export GENOMEFASTA
+export GTF_FOR_RNASEQC
+export DESEQ_RESULT_DIR
+export DESEQ_WORK_DIR
+export GSEA_OUTPUT_DIR
+export GSEA_CLS_FILE
+export GSEA_GCT_FILE
+
+$PYTHON $STAGE_EXECUTOR_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error during the post-alignment stages.  Exiting"; exit 1; }
+
 echo "
-###########################################################################################################
-#                                                                                                         #  
-#                                              GSEA SECTION (end)                                         #  
-#                                                                                                         #  
-###########################################################################################################
+#########################################################################################################################################
+#                                                                                                                                       #
+#                                                     Post-alignment Section (end)                                                      #
+#                                                                                                                                       #
+#########################################################################################################################################
 "
 
 echo "
@@ -769,7 +660,7 @@ cp -r $REPORT_TEMPLATE_LIBRARIES $REPORT_DIR
 
 #run the injection script to create the report:
 if [ $TEST -eq $NUM0 ]; then
-	$PYTHON $CREATE_REPORT_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error creating the report.  Exiting. "; exit 1; }
+	$PYTHON $TELEMETRY_SCRIPT run $RUN_TIMELINE_FILE report report $PYTHON $CREATE_REPORT_SCRIPT || { ( set -o posix ; set ) >>$PROJECT_DIR/$VARIABLES; echo "Error creating the report.  Exiting. "; exit 1; }
 else
 	echo "Perform mock creation of output report."
 fi
@@ -793,7 +684,7 @@ echo "
 #move everything to the target directory:
 
 # create the same directory structure as the PROJECT_DIR
-find $PROJECT_DIR -type d -not -path "$PROJECT_DIR" | sed -e "s:$PROJECT_DIR:$TARGET_DIR:g" | xargs -t -i mkdir {}
+find $PROJECT_DIR -type d -not -path "$PROJECT_DIR" | sed -e "s:$PROJECT_DIR:$TARGET_DIR:g" | xargs -t -i mkdir -p {}
 
 # move all the files (EXCEPT FASTQ) into the target directory:
 #find $PROJECT_DIR -type f | grep -Pv ".*$FASTQ_SUFFIX" | sed -e "s:.*:'&':;p;s:$PROJECT_DIR:$TARGET_DIR:g" | xargs -t -n2 mv
@@ -810,7 +701,7 @@ echo "
 "
 
 #close the logging block
-} | tee $TARGET_DIR/$LOGFILE
+} | tee $TEE_OPTS $TARGET_DIR/$LOGFILE
 
 
 
@@ -0,0 +1,263 @@
+"""
+This script runs the alignment scripts of the valid samples (<sample><FORMATTED_ALIGN_SCRIPT_NAMETAG>, written to each
+sample directory by prepare_align_script.py)
+   -- the alignments are admitted through the host-wide memory pool (see align_admission.py), each needing ALIGN_MEMORY_GB,
+      so as many run at once as fit in the memory of the host, shared fairly with the other pipelines on the host
+   -- samples whose alignment is up to date (see the stage manifest) are skipped
+   -- the output of each alignment goes to a log file next to its script, and is echoed to stdout once it finishes,
+      so the pipeline log does not interleave concurrent alignments
+   -- the resource usage of each alignment is recorded in the run timeline (see telemetry.py), as is the time each STAR
+      alignment spent loading the genome (from its Log.final.out)
+   -- a sample split into shards (see shard_fastq.py) is aligned as one alignment per shard, which are queued like the
+      alignments of other samples (so the shards run at the same time, as the memory pool allows).  Once they have all
+      succeeded, the merge of the shards (the sample's alignment script) is queued, needing ALIGN_MERGE_MEMORY_GB
+   -- with STAR_SHARED_GENOME, the STAR genome index is loaded into shared memory once, before the alignments (which attach
+      to it), and is counted once in the memory pool.  It is removed once the alignments finish (or fail, or this script is
+      interrupted), unless the alignments of another pipeline on this host are still using it.  The index must have been
+      built with the GTF's splice junctions, which cannot be added to a shared genome
+"""
+
+import os
+import sys
+import stat
+import time
+import signal
+import subprocess
+
+from align_admission import AdmissionPool, pool_capacity_gb, STALE_CHECK_INTERVAL
+from stage_executor import read_valid_samples, TELEMETRY_SCRIPT
+from stage_manifest import load_manifest
+from telemetry import append_record, phase_record
+from shard_fastq import shard_scripts
+
+LOG_SUFFIX = ".log"
+
+#how often (in seconds) to check on the running alignments:
+POLL_INTERVAL = 1
+
+#the STAR build used by star_align_template.sh, which also loads and removes the shared genome:
+STAR_EXECUTABLE = "STARstatic"
+
+#the splice junctions built into a STAR genome index (junctions cannot be added to a genome in shared memory, so a shared
+#genome must have them):
+STAR_JUNCTIONS_FILE = "sjdbList.out.tab"
+
+#STAR's summary of an alignment, and the lines giving when the job started and when mapping started (once the genome was loaded):
+STAR_FINAL_LOG = ".Log.final.out"
+STAR_JOB_START = "Started job on"
+STAR_MAPPING_START = "Started mapping on"
+STAR_LOG_TIME_FORMAT = "%b %d %H:%M:%S"
+
+
+#the kinds of unit that are run: the alignment of a whole sample, of one shard of a sample, or the merge of the shards:
+ALIGNMENT = 'alignment'
+SHARD = 'shard'
+MERGE = 'merge'
+STAGES = {ALIGNMENT: 'alignment', SHARD: 'alignment', MERGE: 'alignment_merge'}
+
+
+def alignment_command(env, unit, kind, sample, aln_script, test):
+    if test:
+        aln_dir = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'])
+        mock = "echo '...[Mock "+STAGES[kind]+"]...'"
+        if kind != SHARD:
+            mock += " && mkdir -p "+aln_dir+" && touch "+os.path.join(aln_dir, sample+env['FINAL_BAM_SUFFIX'])
+        command = ["/bin/bash", "-c", mock]
+    else:
+        os.chmod(aln_script, os.stat(aln_script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        command = [aln_script]
+    return [sys.executable, TELEMETRY_SCRIPT, 'run', env['RUN_TIMELINE_FILE'], STAGES[kind], unit]+command
+
+
+def report_finished(unit, kind, log_file, returncode):
+    description = "merge of the shards of" if kind == MERGE else "alignment of"
+    print "\n---------- Output of the "+description+" "+str(unit)+" ----------"
+    try:
+        with open(log_file, 'r') as log:
+            sys.stdout.write(log.read())
+    except IOError:
+        pass
+    print description[0].upper()+description[1:]+" "+str(unit)+" completed at: "+time.strftime("%c")+" (exit code "+str(returncode)+")\n"
+    sys.stdout.flush()
+
+
+def star_log_time(value):
+    #STAR does not log the year:
+    t = time.strptime(time.strftime("%Y")+" "+value.strip(), "%Y "+STAR_LOG_TIME_FORMAT)
+    return time.mktime(t)
+
+
+def record_genome_load(env, unit, kind, sample):
+    """
+    Records the time a STAR alignment spent loading (or attaching to) the genome, from its Log.final.out, in the run timeline
+    """
+    aln_dir = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'])
+    if kind == SHARD:
+        aln_dir = os.path.join(aln_dir, unit)
+    final_log = os.path.join(aln_dir, sample+STAR_FINAL_LOG)
+    times = {}
+    try:
+        with open(final_log, 'r') as f:
+            for line in f:
+                fields = line.split('|')
+                if len(fields) == 2 and fields[0].strip() in (STAR_JOB_START, STAR_MAPPING_START):
+                    times[fields[0].strip()] = star_log_time(fields[1])
+    except (IOError, ValueError):
+        return
+    if len(times) == 2:
+        append_record(env['RUN_TIMELINE_FILE'], phase_record('genome_load', unit, times[STAR_JOB_START], times[STAR_MAPPING_START]))
+
+
+def run_star_genome_command(env, genome_load, stage, unit, genome_dir=None):
+    """
+    Runs STAR to load the genome (of this project, unless genome_dir is given) into shared memory (LoadAndExit) or to
+    remove it (Remove).  Returns True if it succeeded
+    """
+    genome_dir = genome_dir or env['GENOME_INDEX']
+    log_dir = os.path.join(env['PROJECT_DIR'], env['STAR_GENOME_LOAD_DIR'])
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    command = [sys.executable, TELEMETRY_SCRIPT, 'run', env['RUN_TIMELINE_FILE'], stage, unit,
+               STAR_EXECUTABLE, '--genomeDir', genome_dir, '--genomeLoad', genome_load,
+               '--outFileNamePrefix', os.path.join(log_dir, genome_load+".")]
+    print genome_load+" of the STAR genome at "+str(genome_dir)+" (started "+time.strftime("%c")+")"
+    sys.stdout.flush()
+    return subprocess.call(command) == 0
+
+
+def raise_exit(signum, frame):
+    #turns a termination signal into an exception, so the shared genome and the pool are released on the way out:
+    sys.exit("Interrupted by signal "+str(signum))
+
+
+def main(env):
+    test = int(env['TEST']) != 0
+    manifest = None if test else load_manifest()
+
+    #the units to run, as (unit, kind, sample, script):
+    to_align = []
+    #the number of shards of each sharded sample that have not finished, and the sharded samples with a failed shard:
+    shards_left = {}
+    failed_shards = set()
+    for sample, condition in read_valid_samples(env['VALID_SAMPLE_FILE']):
+        #skip samples whose alignment is up to date (an earlier run aligned the same FASTQs with an identical alignment script):
+        if manifest is not None and manifest.is_planned_current('alignment', sample):
+            print "Alignment for sample "+str(sample)+" is up to date.  Skipping."
+            continue
+        sample_dir = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample)
+        shards = shard_scripts(sample_dir, sample, env['FORMATTED_ALIGN_SCRIPT_NAMETAG'])
+        if shards:
+            shards_left[sample] = len(shards)
+            for shard_script in shards:
+                to_align.append((os.path.basename(shard_script)[:-len(env['FORMATTED_ALIGN_SCRIPT_NAMETAG'])], SHARD, sample, shard_script))
+        else:
+            to_align.append((sample, ALIGNMENT, sample, os.path.join(sample_dir, sample+env['FORMATTED_ALIGN_SCRIPT_NAMETAG'])))
+    if not to_align:
+        return
+
+    star = env['ALIGNER'] == env['STAR']
+    shared_genome = star and not test and int(env['STAR_SHARED_GENOME']) == 1
+    if shared_genome and not os.path.isfile(os.path.join(env['GENOME_INDEX'], STAR_JUNCTIONS_FILE)):
+        sys.exit("The STAR genome index "+str(env['GENOME_INDEX'])+" has no splice junctions ("+STAR_JUNCTIONS_FILE+"), and they cannot be "+
+                 "added to a shared genome.  Build the index with the GTF (--sjdbGTFfile), or set STAR_SHARED_GENOME=0")
+    try:
+        footprint_gb = float(env['ALIGN_MEMORY_GB'])
+    except ValueError:
+        sys.exit("The memory needed for an alignment (ALIGN_MEMORY_GB) is not known for this assembly and aligner.")
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, raise_exit)
+    pool = AdmissionPool(env['ALIGN_POOL_DIR'], pool_capacity_gb(float(env['ALIGN_MEMORY_FRACTION'])))
+    running = []
+    resident = False
+    try:
+        if star and not test:
+            #genomes left loaded by pipelines that exited without removing them are removed (this pipeline's own shared
+            #genome is kept, and used).  If the memory was already freed (e.g. with ipcrm), the removal fails harmlessly:
+            for genome in pool.adopt_orphans():
+                if shared_genome and genome == env['GENOME_INDEX']:
+                    continue
+                print "The STAR genome at "+str(genome)+" was left in shared memory by a pipeline that exited."
+                run_star_genome_command(env, "Remove", "genome_remove", "orphan."+os.path.basename(genome.rstrip('/')), genome)
+                pool.release_residency(genome)
+        if shared_genome:
+            #the genome is queued first (it is needed by all the alignments), and each alignment needs only its working memory:
+            genome_ticket = pool.request_residency(env['GENOME_INDEX'], footprint_gb)
+            resident = True
+            footprint_gb = float(env['STAR_SHARED_GENOME_ALIGN_MEMORY_GB'])
+        queued = [(unit, ticket, kind, sample, aln_script) for (unit, kind, sample, aln_script), ticket
+                  in zip(to_align, pool.enqueue([footprint_gb]*len(to_align)))]
+        if shared_genome:
+            if genome_ticket is not None and not pool.try_admit(genome_ticket):
+                print "Waiting for memory to load the STAR genome into shared memory."
+                sys.stdout.flush()
+                while not pool.try_admit(genome_ticket):
+                    pool.wait()
+            #this loads the genome, or (if another pipeline already loaded it) checks that it is there:
+            if not run_star_genome_command(env, "LoadAndExit", "genome_load", "shared."+env['ASSEMBLY']):
+                sys.exit("Could not load the STAR genome into shared memory.  Check the logs in "+str(env['STAR_GENOME_LOAD_DIR'])+
+                         ", or set STAR_SHARED_GENOME=0")
+
+        print "Queued "+str(len(queued))+" alignments, each needing "+str(footprint_gb)+" GB of the "+str(pool.capacity_gb)+" GB aligner memory pool."
+        sys.stdout.flush()
+        waiting = None
+        while queued or running:
+            for unit, ticket, kind, sample, process, log_file in list(running):
+                returncode = process.poll()
+                if returncode is None:
+                    continue
+                running.remove((unit, ticket, kind, sample, process, log_file))
+                pool.release(ticket)
+                report_finished(unit, kind, log_file, returncode)
+                if star and not test and kind != MERGE:
+                    record_genome_load(env, unit, kind, sample)
+                if kind == SHARD:
+                    shards_left[sample] -= 1
+                    if returncode != 0:
+                        failed_shards.add(sample)
+                    if shards_left[sample] == 0:
+                        if sample in failed_shards:
+                            print "The alignment of a shard of "+str(sample)+" failed, so its shards will not be merged."
+                        else:
+                            aln_script = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, sample+env['FORMATTED_ALIGN_SCRIPT_NAMETAG'])
+                            ticket = pool.enqueue([float(env['ALIGN_MERGE_MEMORY_GB'])])[0]
+                            queued.append((sample, ticket, MERGE, sample, aln_script))
+                elif manifest is not None and returncode != 0:
+                    print "The alignment of "+str(sample)+" failed and will be re-run next time."
+                elif manifest is not None and not manifest.record_planned('alignment', sample):
+                    print "The alignment of "+str(sample)+" did not produce a BAM file and will be re-run next time."
+
+            while queued and pool.try_admit(queued[0][1]):
+                unit, ticket, kind, sample, aln_script = queued.pop(0)
+                log_file = aln_script+LOG_SUFFIX
+                with open(log_file, 'w') as log:
+                    #in its own process group, so the whole alignment can be stopped if this script is interrupted:
+                    process = subprocess.Popen(alignment_command(env, unit, kind, sample, aln_script, test), stdout=log, stderr=subprocess.STDOUT,
+                                               preexec_fn=os.setsid)
+                running.append((unit, ticket, kind, sample, process, log_file))
+                print "Run "+STAGES[kind].replace('_', ' ')+" with script at: "+str(aln_script)+" (started "+time.strftime("%c")+")"
+                sys.stdout.flush()
+
+            if queued and waiting != queued[0][0]:
+                waiting = queued[0][0]
+                print "Waiting for aligner memory to start sample "+str(waiting)+" ("+str(pool.in_use_gb())+" GB in use by the alignments on this host)."
+                sys.stdout.flush()
+            if queued or running:
+                #woken at once when another pipeline releases memory; our own alignments are checked every POLL_INTERVAL:
+                pool.wait(POLL_INTERVAL if running else STALE_CHECK_INTERVAL)
+    finally:
+        for unit, ticket, kind, sample, process, log_file in running:
+            if process.poll() is None:
+                os.killpg(process.pid, signal.SIGTERM)
+        #remove the shared genome, unless the alignments of another pipeline are still using it:
+        if resident and pool.release_residency(env['GENOME_INDEX']):
+            run_star_genome_command(env, "Remove", "genome_remove", "shared."+env['ASSEMBLY'])
+        pool.close()
+
+
+if __name__ == "__main__":
+
+    try:
+        main(os.environ)
+    except KeyError as e:
+        sys.exit("Could not run the alignments.  Missing variable: "+str(e))
@@ -0,0 +1,107 @@
+"""
+This script runs the DESeq analysis of every contrast in the contrast file.  The work that the contrasts share is done once:
+   -- the count matrix is loaded once, and the size factors (median-of-ratios, as DESeq's estimateSizeFactors) are computed
+      here for the samples of each contrast, and for all the samples
+   -- the counts, and the variance-stabilized counts used for the heatmaps, are prepared once by DESEQ_VST_SCRIPT and saved
+      in the DESeq work directory
+Then the contrasts are run (DESEQ_SCRIPT, one R process per contrast) concurrently, up to DESEQ_WORKERS at a time.
+Each contrast writes <B><CONTRAST_FLAG><A><DESEQ_OUTFILE_TAG>.csv and its heatmap to DESEQ_RESULT_DIR, as before.
+The completed units are recorded in a manifest in the work directory, so contrasts that are up to date are not re-run,
+and the resources used by each unit are recorded in the run timeline (RUN_TIMELINE_FILE).
+"""
+
+import os
+import sys
+import numpy as np
+
+from count_matrix import CountMatrix, read_design_matrix
+from normalize_counts import size_factors
+from stage_executor import StageGraph, StageNode, run_graph, stage_budget, read_contrasts
+from stage_manifest import StageManifest
+
+ALL_SAMPLES = "all"
+SIZE_FACTOR_SUFFIX = ".size_factors.txt"
+SHARED_DATA_FILE = "shared_data.rds"
+MANIFEST_FILE = "deseq_manifest.json"
+LOG_DIR = "logs"
+#the stage of the units in the run timeline (the 'deseq' stage is the whole of this script, which includes them):
+UNIT_STAGE = "deseq_units"
+
+
+def write_size_factors(size_factor_file, samples, factors):
+    with open(size_factor_file, 'w') as f:
+        f.write("".join(str(s)+"\t"+repr(float(x))+"\n" for s, x in zip(samples, factors)))
+
+
+def prepare_size_factors(count_matrix, design, contrasts, contrast_flag, work_dir):
+    """
+    Writes the size factors of all the samples, and of the samples in each contrast, to the work directory.
+    Returns a dictionary mapping the contrast (and ALL_SAMPLES) to the file
+    """
+    groups = [(ALL_SAMPLES, [sample for sample, count_file, condition in design])]
+    for condition_a, condition_b in contrasts:
+        groups.append(((condition_a, condition_b), [sample for sample, count_file, condition in design if condition in (condition_a, condition_b)]))
+
+    size_factor_files = {}
+    for group, samples in groups:
+        if not samples:
+            sys.exit("There are no samples in the design matrix for the contrast: "+str(group))
+        name = ALL_SAMPLES if group == ALL_SAMPLES else group[1]+contrast_flag+group[0]
+        size_factor_files[group] = os.path.join(work_dir, name+SIZE_FACTOR_SUFFIX)
+        write_size_factors(size_factor_files[group], samples, size_factors(count_matrix.select(samples).astype(np.float64)))
+    return size_factor_files
+
+
+def build_deseq_graph(env, contrasts, size_factor_files, work_dir):
+    """
+    The shared data is prepared first; each contrast depends only on it
+    """
+    cpus, memory_gb = stage_budget(env, 'DESEQ')
+    shared_data_file = os.path.join(work_dir, SHARED_DATA_FILE)
+    graph = StageGraph()
+
+    inputs = [env['DESIGN_MTX_FILE'], env['RAW_COUNT_MATRIX_FILE'], size_factor_files[ALL_SAMPLES]]
+    command = "Rscript "+" ".join([env['DESEQ_VST_SCRIPT']]+inputs+[shared_data_file])
+    vst_node = graph.add_node(StageNode("deseq_shared_data", UNIT_STAGE, command, cpus, memory_gb,
+                                        inputs=inputs, outputs=[shared_data_file])).name
+
+    for condition_a, condition_b in contrasts:
+        file_id = condition_b+env['CONTRAST_FLAG']+condition_a
+        size_factor_file = size_factor_files[(condition_a, condition_b)]
+        args = [env['DESEQ_SCRIPT'], env['DESEQ_RESULT_DIR'], env['DESIGN_MTX_FILE'], env['DESEQ_OUTFILE_TAG'],
+                condition_a, condition_b, env['HEATMAP_FILE'], env['HEATMAP_GENE_COUNT'], env['CONTRAST_FLAG'],
+                shared_data_file, size_factor_file]
+        outputs = [os.path.join(env['DESEQ_RESULT_DIR'], file_id+env['DESEQ_OUTFILE_TAG']+".csv"),
+                   os.path.join(env['DESEQ_RESULT_DIR'], file_id+"."+env['HEATMAP_FILE'])]
+        graph.add_node(StageNode("deseq."+file_id, UNIT_STAGE, "Rscript "+" ".join(args), cpus, memory_gb,
+                                 dependencies=[vst_node], inputs=[env['DESIGN_MTX_FILE'], shared_data_file, size_factor_file],
+                                 outputs=outputs))
+    return graph
+
+
+def main(env):
+    work_dir = env['DESEQ_WORK_DIR']
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    design = read_design_matrix(env['DESIGN_MTX_FILE'])
+    contrasts = read_contrasts(env['CONTRAST_FILE'])
+    count_matrix = CountMatrix(env['COUNT_MATRIX_DIR'])
+    size_factor_files = prepare_size_factors(count_matrix, design, contrasts, env['CONTRAST_FLAG'], work_dir)
+
+    graph = build_deseq_graph(env, contrasts, size_factor_files, work_dir)
+    cpus, memory_gb = stage_budget(env, 'DESEQ')
+    workers = int(env['DESEQ_WORKERS'])
+    print "Running DESeq on "+str(len(contrasts))+" contrasts, "+str(workers)+" at a time."
+    log_dir = os.path.join(work_dir, LOG_DIR)
+    manifest = StageManifest(os.path.join(work_dir, MANIFEST_FILE))
+    if not run_graph(graph, cpus*workers, memory_gb*workers, log_dir, manifest, env['RUN_TIMELINE_FILE']):
+        sys.exit("DESeq failed for one or more contrasts.  Logs are in "+str(log_dir))
+
+
+if __name__ == "__main__":
+
+    try:
+        main(os.environ)
+    except KeyError as e:
+        sys.exit("Could not run the DESeq analysis.  Missing variable: "+str(e))
@@ -0,0 +1,151 @@
+"""
+Splits the (gzipped) FASTQ files of a very large sample into shards, so that the sample can be aligned as several smaller
+alignments and the alignments merged afterwards (see prepare_align_script.py and star_merge_template.sh)
+   -- a sample is sharded if its read 1 FASTQs (of all its lanes) are larger than ALIGN_SHARD_GB, into one shard per
+      ALIGN_SHARD_GB.  Each lane is split into the shards separately, so every shard has part of every lane (and the
+      alignment of a shard keeps the read groups of the lanes)
+   -- the input is streamed once: blocks of SHARD_BLOCK_RECORDS reads are dealt to the shards in turn, so the shards are
+      of (nearly) equal size without counting the reads first.  The two FASTQs of a paired sample are read in step, and
+      the read names of each pair are checked, so the mates stay together in the same shard
+   -- every read goes to exactly one shard; the reads written are checked against the reads read
+"""
+
+import os
+import re
+import sys
+import glob
+import math
+import shutil
+import itertools
+import subprocess
+
+SHARD_TAG = ".shard"
+SHARD_BAM_SUFFIX = ".sort.primary.bam"
+
+#reads are dealt to the shards in blocks of this many:
+SHARD_BLOCK_RECORDS = 100000
+
+#the suffix marking the mate in older read names (e.g. @READ/1):
+MATE_SUFFIX = re.compile(r"/[12]$")
+
+
+def shard_name(sample_name, shard):
+    return str(sample_name)+SHARD_TAG+"%03d" % shard
+
+
+def shard_scripts(sample_dir, sample_name, script_nametag):
+    """
+    The alignment scripts of the shards of a sample (written by prepare_align_script.py), in order
+    """
+    return sorted(glob.glob(os.path.join(sample_dir, str(sample_name)+SHARD_TAG+"[0-9]*"+script_nametag)))
+
+
+def num_shards(fastqs, shard_gb):
+    """
+    The number of shards for a sample: one per shard_gb of its (read 1) FASTQs.  Zero shard_gb means 'do not shard'
+    """
+    if shard_gb <= 0:
+        return 1
+    return max(1, int(math.ceil(sum(os.path.getsize(f) for f in fastqs)/(shard_gb*1024.0**3))))
+
+
+def shard_fastqs(shard_dir, sample_name, shard, lane_number, paired, fastq_suffix):
+    """
+    The FASTQ files (read 1 and read 2, or read 1 and None) of a lane (numbered from zero) of a shard
+    """
+    base = os.path.join(shard_dir, shard_name(sample_name, shard)+".lane%d" % (lane_number+1))
+    return base+"_R1."+fastq_suffix, (base+"_R2."+fastq_suffix if paired else None)
+
+
+def read_name(header):
+    return MATE_SUFFIX.sub("", header.split()[0]) if header.strip() else ""
+
+
+def records(stream):
+    """
+    Yields the FASTQ records (4-tuples of lines) of a stream.  Fails on a truncated record
+    """
+    for record in itertools.izip_longest(*[stream]*4):
+        if record[-1] is None or not record[0].startswith('@'):
+            raise ValueError("Malformed or truncated FASTQ record starting: "+str(record[0]).strip())
+        yield record
+
+
+def split_fastqs(fastq_a, fastq_b, outputs_a, outputs_b, first_shard=0):
+    """
+    Splits fastq_a (and its mate file fastq_b, if not None) into the given shard files, dealing the first block of reads to
+    first_shard.  Returns the reads in each shard
+    """
+    shards = len(outputs_a)
+    readers = [subprocess.Popen(['gzip', '-dc', f], stdout=subprocess.PIPE, bufsize=-1) for f in (fastq_a, fastq_b) if f]
+    writers = []
+    try:
+        for f in outputs_a+(outputs_b if fastq_b else []):
+            with open(f, 'wb') as out:
+                writers.append(subprocess.Popen(['gzip', '-c', '-1'], stdin=subprocess.PIPE, stdout=out, bufsize=-1))
+        writers_a, writers_b = writers[:shards], writers[shards:]
+
+        counts = [0]*shards
+        n = -1
+        if fastq_b:
+            streams = itertools.izip_longest(records(readers[0].stdout), records(readers[1].stdout))
+        else:
+            streams = ((r, None) for r in records(readers[0].stdout))
+        for n, (record_a, record_b) in enumerate(streams):
+            shard = (n/SHARD_BLOCK_RECORDS+first_shard) % shards
+            if fastq_b:
+                if record_a is None or record_b is None:
+                    raise ValueError("The FASTQ files "+str(fastq_a)+" and "+str(fastq_b)+" have different numbers of reads")
+                if read_name(record_a[0]) != read_name(record_b[0]):
+                    raise ValueError("The reads are out of step at read "+str(n+1)+": "+record_a[0].strip()+" and "+record_b[0].strip())
+                writers_b[shard].stdin.write("".join(record_b))
+            writers_a[shard].stdin.write("".join(record_a))
+            counts[shard] += 1
+    finally:
+        for w in writers:
+            w.stdin.close()
+        #(a reader stopped early, on an error, exits once its pipe is closed)
+        for r in readers:
+            r.stdout.close()
+        failed = [w for w in writers if w.wait() != 0]+[r for r in readers if r.wait() != 0]
+    if failed:
+        raise IOError("gzip failed while splitting "+str(fastq_a))
+
+    if sum(counts) != n+1:
+        raise ValueError("Not every read of "+str(fastq_a)+" was written to a shard")
+    return counts
+
+
+def split_sample(args):
+    """
+    Splits the FASTQ files of each lane of a sample into its shard directory (replacing any earlier shards).
+    args is (sample name, [(lane, fastq_a, fastq_b or None)...], shard directory, number of shards, fastq suffix), as it
+    is run by a process pool.  Returns (sample name, reads in each shard, error message or None)
+    """
+    sample_name, lanes, shard_dir, shards, fastq_suffix = args
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+    counts = [0]*shards
+    try:
+        for lane_number, (lane, fastq_a, fastq_b) in enumerate(lanes):
+            outputs = [shard_fastqs(shard_dir, sample_name, i, lane_number, bool(fastq_b), fastq_suffix) for i in range(shards)]
+            #(the lanes start on different shards, so that small lanes are spread over the shards too)
+            lane_counts = split_fastqs(fastq_a, fastq_b, [a for a, b in outputs], [b for a, b in outputs], lane_number)
+            counts = [c+l for c, l in zip(counts, lane_counts)]
+        return sample_name, counts, None
+    except (IOError, ValueError) as e:
+        return sample_name, None, str(e)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) not in (4, 5):
+        sys.exit("Usage: shard_fastq.py <shards> <output prefix> <R1 fastq.gz> [<R2 fastq.gz>]")
+
+    shards, prefix, fastq_a = int(sys.argv[1]), sys.argv[2], sys.argv[3]
+    fastq_b = sys.argv[4] if len(sys.argv) == 5 else None
+    outputs_a = [prefix+SHARD_TAG+"%03d" % i+"_R1.fastq.gz" for i in range(shards)]
+    outputs_b = [prefix+SHARD_TAG+"%03d" % i+"_R2.fastq.gz" for i in range(shards)]
+    for i, count in enumerate(split_fastqs(fastq_a, fastq_b, outputs_a, outputs_b)):
+        print outputs_a[i]+"\t"+str(count)
@@ -25,8 +25,18 @@ PAIRED=%PAIRED%
 NUM0=0
 NUM1=1
 OUTDIR=%OUTPUTDIRECTORY%
+
+#threads, chosen for this host and the number of alignments run at once (see align_resources.py).  They are read from
+#the resource file when the alignment starts, so they are not part of this script:
+RESOURCE_FILE=%RESOURCE_FILE%
 #############################################################
 
+if [ ! -f "$RESOURCE_FILE" ]; then
+    echo "Could not find the resource file: "$RESOURCE_FILE".  Exiting"
+    exit 1
+fi
+source $RESOURCE_FILE
+
 #create the output directory for the BAM files, etc.:
 mkdir $OUTDIR
 
@@ -53,16 +63,17 @@ echo Output will be placed in $OUTDIR
 echo 'GTF file used is '$GTF
 echo 'SNAPR Genome Index used is '$SNAPR_GENOME_INDEX 
 echo 'SNAPR Transcriptome Index used is '$SNAPR_TRANSCRIPTOME_INDEX
+echo 'Resources: '$RESOURCES
 date
 
 #############################################################
 #Run alignments with SNAPR
 if [ $PAIRED -eq $NUM0 ]; then
     echo "run single alignment for " $SAMPLE_NAME
-    snapr single $SNAPR_GENOME_INDEX $SNAPR_TRANSCRIPTOME_INDEX $GTF $FASTQFILEA -o $OUTDIR/$SAMPLE_NAME$BAM_FILE_SUFFIX -M -so
+    snapr single $SNAPR_GENOME_INDEX $SNAPR_TRANSCRIPTOME_INDEX $GTF $FASTQFILEA -o $OUTDIR/$SAMPLE_NAME$BAM_FILE_SUFFIX -M -so -t $ALIGN_THREADS
 elif [ $PAIRED -eq $NUM1 ]; then
     echo "run paired alignement for " $SAMPLE_NAME
-    snapr paired $SNAPR_GENOME_INDEX $SNAPR_TRANSCRIPTOME_INDEX $GTF $FASTQFILEA $FASTQFILEB -o $OUTDIR/$SAMPLE_NAME$BAM_FILE_SUFFIX -M -so
+    snapr paired $SNAPR_GENOME_INDEX $SNAPR_TRANSCRIPTOME_INDEX $GTF $FASTQFILEA $FASTQFILEB -o $OUTDIR/$SAMPLE_NAME$BAM_FILE_SUFFIX -M -so -t $ALIGN_THREADS
 else
     echo "Did not specify single- or paired-end option."
     exit 1
@@ -0,0 +1,419 @@
+"""
+This script runs the post-alignment stages of the pipeline (read counting, RNA-SeQC, DESeq, GSEA)
+  -- each stage is broken into units of work (one per sample or one per contrast) which form a dependency graph
+  -- units that do not depend on each other are run concurrently, bounded by an overall CPU/memory budget
+     and the per-stage requirements given in the configuration file
+  -- the output of each unit is collected in a log file and echoed to stdout once the unit finishes,
+     so the pipeline log does not interleave the output of concurrent jobs
+  -- units with known inputs and outputs are recorded in the stage manifest when they complete, and
+     are skipped on a re-run if their inputs and parameters have not changed
+  -- the resource usage of each unit is recorded in the run timeline (see telemetry.py)
+"""
+
+import os
+import sys
+import time
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+
+from stage_manifest import load_manifest
+
+#the states a node passes through:
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+#how long (in seconds) to wait between checks on the running jobs:
+POLL_INTERVAL = 0.5
+
+#wraps the jobs to record their resource usage in the run timeline:
+TELEMETRY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "telemetry.py")
+
+
+class StageNode:
+    """
+    Object to hold a single unit of work (e.g. featureCounts on one sample) and the resources it needs
+    """
+    def __init__(self, name, stage, command, cpus=1, memory_gb=1, dependencies=None, required=True, inputs=None, outputs=None):
+        self.name = name
+        self.stage = stage
+        self.command = command
+        self.cpus = cpus
+        self.memory_gb = memory_gb
+        self.dependencies = dependencies or []
+        self.required = required #if a required node fails, no further nodes are started
+        self.inputs = inputs or []
+        self.outputs = outputs or [] #nodes without outputs are always run
+        self.status = PENDING
+        self.process = None
+        self.log_file = None
+
+
+class StageGraph:
+    """
+    Holds the nodes in the order they were added.  Dependencies must be added before their dependents.
+    """
+    def __init__(self):
+        self.nodes = OrderedDict()
+
+    def add_node(self, node):
+        if node.name in self.nodes:
+            raise ValueError("Duplicate stage node: "+str(node.name))
+        for dependency in node.dependencies:
+            if dependency not in self.nodes:
+                raise ValueError("Stage node "+str(node.name)+" depends on unknown node "+str(dependency))
+        self.nodes[node.name] = node
+        return node
+
+    def nodes_with_status(self, status):
+        return [n for n in self.nodes.values() if n.status == status]
+
+    def ready_nodes(self):
+        """
+        Returns the pending nodes whose dependencies have all completed
+        """
+        return [n for n in self.nodes_with_status(PENDING)
+                if all(self.nodes[d].status == DONE for d in n.dependencies)]
+
+    def skip_blocked_nodes(self):
+        """
+        Marks pending nodes that can never run (a dependency failed or was skipped) as skipped
+        """
+        changed = True
+        while changed:
+            changed = False
+            for n in self.nodes_with_status(PENDING):
+                if any(self.nodes[d].status in (FAILED, SKIPPED) for d in n.dependencies):
+                    print "Skipping "+str(n.name)+" since a stage it depends on did not complete."
+                    n.status = SKIPPED
+                    changed = True
+
+
+def host_memory_gb():
+    """
+    Reads the total memory of this host from /proc/meminfo.  Returns None if it cannot be determined.
+    """
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1])/(1024.0*1024.0)
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+
+def resolve_budget(requested_cpus, requested_memory_gb):
+    """
+    A requested budget of zero (or less) means 'use everything detected on this host'
+    """
+    cpus = requested_cpus if requested_cpus > 0 else multiprocessing.cpu_count()
+    memory_gb = requested_memory_gb if requested_memory_gb > 0 else host_memory_gb()
+    if memory_gb is None:
+        memory_gb = float('inf')
+    return cpus, memory_gb
+
+
+def launch(node, log_dir, timeline_file=None):
+    node.log_file = os.path.join(log_dir, str(node.name)+".log")
+    log = open(node.log_file, 'w')
+    if timeline_file:
+        #run the command under telemetry.py, which records its resource usage in the run timeline:
+        command = [sys.executable, TELEMETRY_SCRIPT, 'run', timeline_file, node.stage, node.name, node.command]
+        node.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+    else:
+        node.process = subprocess.Popen(node.command, shell=True, executable='/bin/bash', stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    node.status = RUNNING
+    print "Started "+str(node.name)+" ("+str(node.cpus)+" cpu, "+str(node.memory_gb)+" GB): "+str(node.command)
+    sys.stdout.flush()
+
+
+def finish(node, returncode):
+    node.status = DONE if returncode == 0 else FAILED
+    print "\n---------- Output of "+str(node.name)+" ----------"
+    try:
+        with open(node.log_file, 'r') as log:
+            sys.stdout.write(log.read())
+    except IOError:
+        pass
+    if node.status == DONE:
+        print "---------- "+str(node.name)+" completed ----------\n"
+    else:
+        print "---------- "+str(node.name)+" FAILED (exit code "+str(returncode)+") ----------\n"
+    sys.stdout.flush()
+
+
+def is_up_to_date(node, manifest):
+    return manifest is not None and node.outputs and \
+        manifest.is_current(node.stage, node.name, node.inputs, {'command': node.command}, node.outputs)
+
+
+def run_graph(graph, max_cpus, max_memory_gb, log_dir, manifest=None, timeline_file=None):
+    """
+    Runs the nodes of the graph, starting every ready node that fits in the remaining budget.
+    A node that needs more than the whole budget is run on its own.
+    If a manifest is given, nodes that are up to date are not run, and completed nodes are recorded.
+    If a timeline file is given, the resource usage of each node is recorded in it (see telemetry.py).
+    Returns True if all the required nodes completed
+    """
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    running = []
+    used_cpus = 0
+    used_memory = 0
+    halted = False
+    while True:
+        #skipping an up-to-date node can make its dependents ready, so repeat until nothing changes:
+        progressed = not halted
+        while progressed:
+            progressed = False
+            for node in graph.ready_nodes():
+                if is_up_to_date(node, manifest):
+                    print str(node.name)+" is up to date.  Skipping."
+                    node.status = DONE
+                    progressed = True
+                    continue
+                cpus = min(node.cpus, max_cpus)
+                memory = min(node.memory_gb, max_memory_gb)
+                if not running or (used_cpus + cpus <= max_cpus and used_memory + memory <= max_memory_gb):
+                    launch(node, log_dir, timeline_file)
+                    running.append(node)
+                    used_cpus += cpus
+                    used_memory += memory
+
+        if not running:
+            break
+
+        time.sleep(POLL_INTERVAL)
+        for node in list(running):
+            returncode = node.process.poll()
+            if returncode is not None:
+                running.remove(node)
+                used_cpus -= min(node.cpus, max_cpus)
+                used_memory -= min(node.memory_gb, max_memory_gb)
+                finish(node, returncode)
+                if node.status == DONE and manifest is not None and node.outputs:
+                    manifest.record(node.stage, node.name, node.inputs, {'command': node.command}, node.outputs)
+                if node.status == FAILED and node.required:
+                    print "A required stage failed ("+str(node.name)+").  Waiting for running stages before exiting."
+                    halted = True
+        graph.skip_blocked_nodes()
+
+    #anything not started because of a failure is reported as skipped:
+    for node in graph.nodes_with_status(PENDING):
+        node.status = SKIPPED
+
+    failed_required = [n for n in graph.nodes.values() if n.required and n.status != DONE]
+    return len(failed_required) == 0
+
+
+def stage_budget(env, prefix):
+    """
+    Reads the cpu and memory requirements of a stage from the environment (e.g. RNA_SEQC_CPUS, RNA_SEQC_MEMORY_GB)
+    """
+    return int(env[prefix+'_CPUS']), float(env[prefix+'_MEMORY_GB'])
+
+
+def read_valid_samples(valid_sample_file):
+    samples = []
+    try:
+        with open(valid_sample_file, 'r') as vsf:
+            for line in vsf:
+                sample_condition_tuple = tuple(line.strip().split('\t'))
+                if len(sample_condition_tuple) == 2:
+                    samples.append(sample_condition_tuple)
+        return samples
+    except IOError:
+        sys.exit("I/O exception when reading the valid samples file: "+str(valid_sample_file))
+
+
+def read_contrasts(contrast_file):
+    contrasts = []
+    try:
+        with open(contrast_file, 'r') as cf:
+            for line in cf:
+                split_line = line.strip().split()
+                if len(split_line) >= 2:
+                    contrasts.append((split_line[0], split_line[1]))
+        return contrasts
+    except IOError:
+        sys.exit("I/O exception when reading the contrast file: "+str(contrast_file))
+
+
+def mock(description):
+    return "echo 'Perform mock "+str(description)+"'"
+
+
+def add_count_nodes(graph, env, samples, test):
+    """
+    Adds the read-counting nodes and returns their names.  With STAR (or no alignment) the reads of all the samples
+    are counted by a single node (see count_reads.py), which runs featureCounts on batches of BAM files
+    """
+    cpus, memory_gb = stage_budget(env, 'FEATURECOUNTS')
+    counts_dir = env['COUNTS_DIR']
+    count_files = [os.path.join(counts_dir, sample+env['COUNTFILE_SUFFIX']) for sample, condition in samples]
+    if not test and (env['ALIGNER'] == env['STAR'] or int(env['ALN']) == 0):
+        threads = int(env['FEATURECOUNTS_THREADS'])
+        bam_files = [os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'], sample+env['FINAL_BAM_SUFFIX'])
+                     for sample, condition in samples]
+        command = env['PYTHON']+" "+env['COUNT_READS_SCRIPT']
+        return [graph.add_node(StageNode("featureCounts", "featureCounts", command,
+                                         threads if threads > 0 else multiprocessing.cpu_count(), memory_gb,
+                                         inputs=bam_files+[env['GTF']], outputs=count_files)).name]
+
+    names = []
+    for (sample, condition), count_file in zip(samples, count_files):
+        aln_dir = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'])
+        if test:
+            command = "touch "+count_file
+        elif env['ALIGNER'] == env['SNAPR']:
+            #the count file may already have been moved by an earlier run (if the alignment was up to date):
+            snapr_count_file = os.path.join(aln_dir, sample+env['SORTED_TAG']+env['COUNTFILE_SUFFIX'])
+            command = "if [ -e "+snapr_count_file+" ]; then mv "+snapr_count_file+" "+count_file+"; else test -e "+count_file+"; fi"
+        else:
+            continue
+        names.append(graph.add_node(StageNode("featureCounts."+sample, "featureCounts", command, cpus, memory_gb)).name)
+    return names
+
+
+def add_rna_seqc_nodes(graph, env, samples, test):
+    cpus, memory_gb = stage_budget(env, 'RNA_SEQC')
+    for sample, condition in samples:
+        sample_bam = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'], sample+env['FINAL_BAM_SUFFIX'])
+        sample_qc_dir = os.path.join(env['REPORT_DIR'], env['RNA_SEQC_DIR'], sample)
+        inputs, outputs = [], []
+        if test:
+            command = "mkdir -p "+sample_qc_dir+" && "+mock("QC analysis, etc. on "+sample)
+        else:
+            command = "mkdir -p "+sample_qc_dir+" && java -jar "+env['RNA_SEQC_JAR']+" -o "+sample_qc_dir+ \
+                      " -r "+env['GENOMEFASTA']+" -s '"+sample+"|"+sample_bam+"|-' -t "+env['GTF_FOR_RNASEQC']
+            inputs = [sample_bam, env['GENOMEFASTA'], env['GTF_FOR_RNASEQC']]
+            outputs = [os.path.join(sample_qc_dir, env['DEFAULT_RNA_SEQC_REPORT'])]
+        #as before, a failed QC report does not stop the pipeline:
+        graph.add_node(StageNode("rna_seqc."+sample, "rna_seqc", command, cpus, memory_gb, required=False,
+                                 inputs=inputs, outputs=outputs))
+
+
+def add_count_matrix_node(graph, env, samples, design_matrix_node, test):
+    """
+    Adds the node which combines the counts of all the samples into the count matrix store
+    """
+    if test:
+        command = mock("combining the read counts into the count matrix")
+        inputs, outputs = [], []
+    else:
+        command = env['PYTHON']+" "+env['COUNT_MATRIX_SCRIPT']
+        inputs = [env['DESIGN_MTX_FILE']]+[os.path.join(env['COUNTS_DIR'], sample+env['COUNTFILE_SUFFIX']) for sample, condition in samples]
+        outputs = [env['COUNT_MATRIX_DIR'], env['RAW_COUNT_MATRIX_FILE']]
+    return graph.add_node(StageNode("count_matrix", "count_matrix", command, dependencies=[design_matrix_node],
+                                    inputs=inputs, outputs=outputs)).name
+
+
+def add_analysis_nodes(graph, env, samples, contrasts, normalized_counts_node, count_matrix_node, test):
+    """
+    Adds the contrast-level DESeq and GSEA nodes
+    """
+    #all the contrasts are run by a single DESeq driver, which shares the common work between them and runs
+    #up to DESEQ_WORKERS contrasts at once (so it reserves the resources of that many DESeq jobs):
+    cpus, memory_gb = stage_budget(env, 'DESEQ')
+    workers = int(env['DESEQ_WORKERS'])
+    if test:
+        command = " && ".join(mock("DESeq step on contrast between "+condition_a+" and "+condition_b) for condition_a, condition_b in contrasts)
+    else:
+        command = env['PYTHON']+" "+env['RUN_DESEQ_SCRIPT']
+    graph.add_node(StageNode("deseq", "deseq", command, cpus*workers, memory_gb*workers, dependencies=[count_matrix_node]))
+
+    cpus, memory_gb = stage_budget(env, 'GSEA')
+    if env['GSEA_ENGINE'] == 'python' and not test:
+        #all the contrasts are analyzed by gsea.py, which splits the permutations across GSEA_WORKERS processes:
+        requested_workers = int(env['GSEA_WORKERS'])
+        workers = requested_workers if requested_workers > 0 else multiprocessing.cpu_count()
+        inputs = [env['GSEA_GCT_FILE'], env['GSEA_CLS_FILE'], env['GSEA_GENE_SETS_FILE'], env['CONTRAST_FILE']]
+        outputs = [os.path.join(env['GSEA_OUTPUT_DIR'], condition_a+env['CONTRAST_FLAG']+condition_b+".Gsea.*") for condition_a, condition_b in contrasts]
+        graph.add_node(StageNode("gsea", "gsea", env['PYTHON']+" "+env['GSEA_SCRIPT'], cpus*workers, memory_gb,
+                                 dependencies=[normalized_counts_node], inputs=inputs, outputs=outputs))
+        return
+
+    for condition_a, condition_b in contrasts:
+        args = [env['RUN_GSEA_SCRIPT'], env['GSEA_JAR'], env['GSEA_ANALYSIS'], env['GSEA_GCT_FILE'], env['GSEA_CLS_FILE'],
+                condition_a+'_versus_'+condition_b, env['DEFAULT_GMX_FILE'], env['NUM_GSEA_PERMUTATIONS'],
+                condition_a+env['CONTRAST_FLAG']+condition_b, env['DEFAULT_CHIP_FILE'], env['GSEA_OUTPUT_DIR']]
+        inputs, outputs = [], []
+        if test:
+            command = mock("GSEA step on contrast between "+condition_a+" and "+condition_b)
+        else:
+            command = " ".join(args)
+            #GSEA names its output directory by the analysis label and a timestamp:
+            inputs = [env['GSEA_GCT_FILE'], env['GSEA_CLS_FILE']]
+            outputs = [os.path.join(env['GSEA_OUTPUT_DIR'], condition_a+env['CONTRAST_FLAG']+condition_b+".Gsea.*")]
+        graph.add_node(StageNode("gsea."+condition_a+env['CONTRAST_FLAG']+condition_b, "gsea", command, cpus, memory_gb,
+                                 dependencies=[normalized_counts_node], inputs=inputs, outputs=outputs))
+
+
+def build_graph(env):
+    """
+    Creates the dependency graph for the post-alignment stages:
+       counts (per sample) -> design matrix -> count matrix -> normalized counts and GSEA inputs -> GSEA (per contrast, or gsea.py)
+                                                          \-> DESeq (all the contrasts, see run_deseq.py)
+       RNA-SeQC (per sample) depends only on the alignments
+    """
+    test = int(env['TEST']) == 1
+    samples = read_valid_samples(env['VALID_SAMPLE_FILE'])
+    graph = StageGraph()
+
+    count_nodes = add_count_nodes(graph, env, samples, test)
+    design_matrix_node = graph.add_node(StageNode("design_matrix", "design_matrix",
+                                                  env['PYTHON']+" "+env['CREATE_DESIGN_MATRIX_SCRIPT'],
+                                                  dependencies=count_nodes)).name
+    count_matrix_node = add_count_matrix_node(graph, env, samples, design_matrix_node, test)
+
+    contrasts = None
+    if int(env['SKIP_ANALYSIS']) == 0:
+        if os.path.isfile(env['CONTRAST_FILE']):
+            contrasts = read_contrasts(env['CONTRAST_FILE'])
+        else:
+            print "\nSkipping differential and GSEA analysis since no contrast file was specified.\n"
+    else:
+        print "\nSkipping differential and GSEA analysis since -skip_analysis flag was set.\n"
+
+    #the normalized counts, and the GSEA input files (if GSEA will be run), are written together:
+    outputs = [env['NORMALIZED_COUNTS_FILE']]
+    if contrasts is not None:
+        outputs += [env['GSEA_GCT_FILE'], env['GSEA_CLS_FILE']]
+    if test:
+        command = mock("normalized counts (and GSEA input files)")
+        inputs, outputs = [], []
+    else:
+        command = env['PYTHON']+" "+env['NORMALIZE_COUNTS_SCRIPT']+" "+" ".join(outputs[1:])
+        inputs = [env['DESIGN_MTX_FILE'], env['COUNT_MATRIX_DIR']]
+    normalized_counts_node = graph.add_node(StageNode("normalized_counts", "normalized_counts", command,
+                                                      dependencies=[count_matrix_node], required=False,
+                                                      inputs=inputs, outputs=outputs)).name
+
+    if int(env['SKIP_RNA_QC']) == 0:
+        add_rna_seqc_nodes(graph, env, samples, test)
+
+    if contrasts is not None:
+        add_analysis_nodes(graph, env, samples, contrasts, normalized_counts_node, count_matrix_node, test)
+    return graph
+
+
+if __name__ == "__main__":
+
+    try:
+        env = os.environ
+        max_cpus, max_memory_gb = resolve_budget(int(env['MAX_STAGE_CPUS']), float(env['MAX_STAGE_MEMORY_GB']))
+        log_dir = os.path.join(env['PROJECT_DIR'], env['STAGE_LOG_DIR'])
+
+        graph = build_graph(env)
+        print "Running "+str(len(graph.nodes))+" post-alignment jobs with up to "+str(max_cpus)+" cpus and "+str(max_memory_gb)+" GB of memory."
+        if not run_graph(graph, max_cpus, max_memory_gb, log_dir, load_manifest(), env['RUN_TIMELINE_FILE']):
+            sys.exit("One or more of the post-alignment stages failed.  Logs are in "+str(log_dir))
+
+    except KeyError as e:
+        sys.exit("Could not run the post-alignment stages.  Missing variable: "+str(e))
@@ -0,0 +1,212 @@
+"""
+This script keeps a record (the stage manifest) of every unit of work the pipeline has completed--
+  e.g. the alignment of a sample, the read counts of a sample, or the DESeq analysis of a contrast.
+  For each unit, the manifest holds the inputs (path, size, modification time and, for files that are not too large, a checksum),
+  the parameters used, and the outputs that were produced.
+  On a re-run, a unit whose inputs and parameters are unchanged (and whose outputs are still in place) is up to date and can be skipped.
+
+  Python stages use the StageManifest class directly.  The shell uses the command-line form:
+      stage_manifest.py check <stage> <unit>    (exits 0 if the unit planned by a python helper is up to date)
+      stage_manifest.py record <stage> <unit> [exit status]
+                                                (records the planned unit as complete.  Given the exit status of the
+                                                unit's command, a failed unit is not recorded, e.g. record alignment X $?)
+"""
+
+import os
+import sys
+import glob
+import json
+import fcntl
+import hashlib
+
+#files up to this size (in bytes) are also fingerprinted by their contents, so that
+#a file which is re-written with the same contents (e.g. a regenerated script) is not considered changed
+CHECKSUM_SIZE_LIMIT = 256*1024*1024
+
+
+def checksum(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def fingerprint(path, previous=None):
+    """
+    Returns a dictionary describing the current state of a file or directory, or None if it does not exist.
+    Paths containing wildcards are expanded (e.g. for outputs whose names carry a timestamp).
+    If the size and modification time match a previous fingerprint, its checksum is reused rather than recomputed.
+    """
+    if glob.has_magic(path):
+        matches = sorted(glob.glob(path))
+        if not matches:
+            return None
+        parts = [fingerprint(m) for m in matches]
+        return {'path': path, 'matches': parts}
+    if os.path.isdir(path):
+        size = 0
+        mtime = os.path.getmtime(path)
+        count = 0
+        for root, dirs, files in os.walk(path):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime)
+                count += 1
+        return {'path': path, 'size': size, 'mtime': mtime, 'files': count}
+    if not os.path.isfile(path):
+        return None
+    st = os.stat(path)
+    fp = {'path': path, 'size': st.st_size, 'mtime': st.st_mtime}
+    if st.st_size <= CHECKSUM_SIZE_LIMIT:
+        if previous and previous.get('size') == st.st_size and previous.get('mtime') == st.st_mtime and 'sha1' in previous:
+            fp['sha1'] = previous['sha1']
+        else:
+            fp['sha1'] = checksum(path)
+    return fp
+
+
+def same_file(recorded, current):
+    """
+    Compares two fingerprints.  Files with checksums are compared by contents; everything else by size and modification time.
+    """
+    if recorded is None or current is None:
+        return recorded == current
+    if 'matches' in recorded or 'matches' in current:
+        r = recorded.get('matches', [])
+        c = current.get('matches', [])
+        return len(r) == len(c) and all(same_file(x, y) for x, y in zip(r, c))
+    if 'sha1' in recorded and 'sha1' in current:
+        return recorded['sha1'] == current['sha1']
+    return recorded.get('size') == current.get('size') and recorded.get('mtime') == current.get('mtime') \
+        and recorded.get('files') == current.get('files')
+
+
+class StageManifest:
+    """
+    The manifest is a JSON file.  Completed units are keyed by '<stage>/<unit>'.
+    Units may also be 'planned' by one process (e.g. prepare_align_script.py) and checked/recorded by another (the shell).
+    Several processes may update the manifest at once (e.g. the alignments of a watched project, see watch_project.py):
+    each saves only the units it changed, merged into the manifest on disk under a lock.
+    """
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.units = {}
+        self.planned = {}
+        #the keys of the units (and planned units) this process has changed or removed since it last saved:
+        self.changed = {'units': set(), 'planned': set()}
+        if os.path.isfile(manifest_file):
+            try:
+                with open(manifest_file, 'r') as f:
+                    contents = json.load(f)
+                self.units = contents.get('units', {})
+                self.planned = contents.get('planned', {})
+            except (IOError, ValueError):
+                print "(Warning) Could not read the stage manifest at "+str(manifest_file)+".  All stages will be re-run."
+
+    def save(self):
+        with open(self.manifest_file+'.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.manifest_file, 'r') as f:
+                    contents = json.load(f)
+            except (IOError, ValueError):
+                contents = {}
+            for section, ours in (('units', self.units), ('planned', self.planned)):
+                merged = contents.get(section, {})
+                for key in self.changed[section]:
+                    if key in ours:
+                        merged[key] = ours[key]
+                    else:
+                        merged.pop(key, None)
+                ours.clear()
+                ours.update(merged)
+                self.changed[section].clear()
+            #write to a temporary file and move it into place, so an interrupted run never leaves a truncated manifest:
+            tmp_file = self.manifest_file+'.tmp'
+            with open(tmp_file, 'w') as f:
+                json.dump({'units': self.units, 'planned': self.planned}, f, indent=1, sort_keys=True)
+            os.rename(tmp_file, self.manifest_file)
+
+    @staticmethod
+    def key(stage, unit):
+        return str(stage)+'/'+str(unit)
+
+    def is_current(self, stage, unit, inputs, params, outputs):
+        """
+        True if the unit was completed with the same inputs and parameters and its outputs are unchanged since
+        """
+        record = self.units.get(self.key(stage, unit))
+        if record is None or record['params'] != params:
+            return False
+        if [i['path'] for i in record['inputs']] != list(inputs) or [o['path'] for o in record['outputs']] != list(outputs):
+            return False
+        for recorded in record['inputs']+record['outputs']:
+            current = fingerprint(recorded['path'], recorded)
+            if current is None or not same_file(recorded, current):
+                return False
+        return True
+
+    def record(self, stage, unit, inputs, params, outputs):
+        """
+        Records a completed unit.  Returns False (and records nothing) if any of the outputs are missing.
+        """
+        previous = self.units.get(self.key(stage, unit), {})
+        previous_inputs = dict((i['path'], i) for i in previous.get('inputs', []))
+        output_fingerprints = [fingerprint(o) for o in outputs]
+        if any(o is None for o in output_fingerprints):
+            return False
+        self.units[self.key(stage, unit)] = {
+            'inputs': [fingerprint(i, previous_inputs.get(i)) or {'path': i} for i in inputs],
+            'params': params,
+            'outputs': output_fingerprints
+        }
+        self.changed['units'].add(self.key(stage, unit))
+        self.save()
+        return True
+
+    def invalidate(self, stage, unit):
+        if self.units.pop(self.key(stage, unit), None) is not None:
+            self.changed['units'].add(self.key(stage, unit))
+            self.save()
+
+    def plan(self, stage, unit, inputs, params, outputs):
+        self.planned[self.key(stage, unit)] = {'inputs': list(inputs), 'params': params, 'outputs': list(outputs)}
+        self.changed['planned'].add(self.key(stage, unit))
+
+    def is_planned_current(self, stage, unit):
+        spec = self.planned.get(self.key(stage, unit))
+        return spec is not None and self.is_current(stage, unit, spec['inputs'], spec['params'], spec['outputs'])
+
+    def record_planned(self, stage, unit):
+        spec = self.planned.get(self.key(stage, unit))
+        return spec is not None and self.record(stage, unit, spec['inputs'], spec['params'], spec['outputs'])
+
+
+def load_manifest():
+    """
+    Opens the project's manifest, as given by the environment (PROJECT_DIR and STAGE_MANIFEST_FILE)
+    """
+    return StageManifest(os.path.join(os.environ['PROJECT_DIR'], os.environ['STAGE_MANIFEST_FILE']))
+
+
+if __name__ == "__main__":
+
+    try:
+        action, stage, unit = sys.argv[1:4]
+        exit_status = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+        manifest = load_manifest()
+        if action == 'check':
+            sys.exit(0 if manifest.is_planned_current(stage, unit) else 1)
+        elif action == 'record':
+            if exit_status != 0:
+                sys.exit("Not recording "+str(stage)+" of "+str(unit)+" as complete: it failed (exit status "+str(exit_status)+")")
+            if not manifest.record_planned(stage, unit):
+                sys.exit("Could not record "+str(stage)+" of "+str(unit)+" as complete (was it planned?  are its outputs missing?)")
+        else:
+            sys.exit("Unknown action: "+str(action)+".  Use 'check' or 'record'.")
+    except ValueError:
+        sys.exit("Usage: stage_manifest.py <check|record> <stage> <unit> [exit status]")
+    except KeyError:
+        sys.exit("Could not locate the stage manifest.  Check that PROJECT_DIR and STAGE_MANIFEST_FILE are set.")
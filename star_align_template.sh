@@ -27,12 +27,25 @@ NUM1=1
 OUTDIR=%OUTPUTDIRECTORY%
 GTF=%GTF%
 GENOME_INDEX=%GENOME_INDEX% 
+GENOME_LOAD=%GENOME_LOAD%
 FINAL_BAM_FILE_SUFFIX=%BAM_FILE_SUFFIX%
 PICARD_DIR=%PICARD_DIR%
+
+#threads and memory, chosen for this host and the number of alignments run at once (see align_resources.py).  They are
+#read from the resource file when the alignment starts, so they are not part of this script:
+RESOURCE_FILE=%RESOURCE_FILE%
 #############################################################
 
+if [ ! -f "$RESOURCE_FILE" ]; then
+    echo "Could not find the resource file: "$RESOURCE_FILE".  Exiting"
+    exit 1
+fi
+source $RESOURCE_FILE
+SORT_MEMORY=$(($SORT_MEMORY_MB*1024*1024)) #per sort thread, in bytes
+DEDUP_HEAP=$DEDUP_HEAP_GB
+
 #create the output directory for the BAM files, etc.:
-mkdir $OUTDIR
+mkdir -p $OUTDIR
 
 if [ ! -d "$OUTDIR" ]; then
     echo "Could not create the output directory (permissions?).  Exiting"
@@ -56,89 +69,133 @@ echo The Assembly is $ASSEMBLY
 echo Output will be placed in $OUTDIR
 echo 'GTF file used is '$GTF
 echo 'STAR Genome Index used is located at '$GENOME_INDEX 
+echo 'STAR genome loading: '$GENOME_LOAD
+echo 'Resources: '$RESOURCES
 date
 
-#############################################################
-#Run alignments with SNAPR
-if [ $PAIRED -eq $NUM0 ]; then
-    echo "run single-end alignment for " $SAMPLE_NAME
+#when the genome is shared (already loaded into shared memory for this batch of samples), this alignment attaches to it.
+#Splice junctions cannot be added to a genome in shared memory, so the GTF is only passed when the genome is loaded privately,
+#and a shared genome must have the junctions built into its index (or the alignment would differ from an unshared one)
+SJDB_OPTION=""
+if [ "$GENOME_LOAD" == "NoSharedMemory" ]; then
+    SJDB_OPTION="--sjdbGTFfile $GTF"
+elif [ ! -f "$GENOME_INDEX/sjdbList.out.tab" ]; then
+    echo "The shared genome index $GENOME_INDEX has no splice junctions (sjdbList.out.tab).  Build it with the GTF, or set STAR_SHARED_GENOME=0.  Exiting"
+    exit 1
+fi
+
+#read-group info parsed from sample metadata: one read group per lane, in the order of the (comma-separated) FASTQs of the
+#lanes, separated by ' , ' as STAR expects.  STAR adds them to the header and tags each read with the read group of its lane.
+#Without read groups, the RNA-SeQC step breaks
+READ_GROUPS="%READ_GROUPS%"
+
+#how the alignments are post-processed into the final BAM: 'stream' (STAR's SAM output is piped through the primary-alignment
+#filter into a multi-threaded sort), or 'sam' (STAR writes a SAM file, which is then converted, sorted, and filtered as
+#separate passes on disk).  Both produce the same final BAM
+POSTPROCESS=%POSTPROCESS%
+
+#for convenience:
+BASE=$OUTDIR'/'$SAMPLE_NAME
+DEFAULT_SAM=$BASE'.Aligned.out.sam'  #default naming scheme by STAR
+UNSORTED_BAM=$BASE'.bam'
+SORTED_BAM=$BASE'.sort' # no .bam-- that is appended by default by samtools sort
+
+#runs STAR, with any extra arguments (e.g. for the output) appended:
+run_star(){
+    if [ $PAIRED -eq $NUM0 ]; then
+        READS=$FASTQFILEA
+    else
+        READS="$FASTQFILEA $FASTQFILEB"
+    fi
     STARstatic --genomeDir $GENOME_INDEX \
-         --readFilesIn $FASTQFILEA \
-         --runThreadN 4 \
+         --readFilesIn $READS \
+         --runThreadN $ALIGN_THREADS \
          --readFilesCommand zcat \
-         --genomeLoad NoSharedMemory \
-         --sjdbGTFfile $GTF \
+         --genomeLoad $GENOME_LOAD $SJDB_OPTION \
 	 --outSAMstrandField intronMotif \
 	 --outFilterIntronMotifs RemoveNoncanonical \
 	 --outFilterType BySJout \
-         --outFileNamePrefix $OUTDIR'/'$SAMPLE_NAME'.'
+         --outFileNamePrefix $OUTDIR'/'$SAMPLE_NAME'.' "$@"
+}
+
+#############################################################
+#Run alignments with STAR
+if [ $PAIRED -eq $NUM0 ]; then
+    echo "run single-end alignment for " $SAMPLE_NAME
 elif [ $PAIRED -eq $NUM1 ]; then
     echo "run paired alignement for " $SAMPLE_NAME
-    STARstatic --genomeDir $GENOME_INDEX \
-         --readFilesIn $FASTQFILEA $FASTQFILEB \
-         --runThreadN 4 \
-         --readFilesCommand zcat \
-         --genomeLoad NoSharedMemory \
-         --sjdbGTFfile $GTF \
-	 --outSAMstrandField intronMotif \
-	 --outFilterIntronMotifs RemoveNoncanonical \
-	 --outFilterType BySJout \
-         --outFileNamePrefix $OUTDIR'/'$SAMPLE_NAME'.'
 else
     echo "Did not specify single- or paired-end option."
     exit 1
 fi
-#############################################################
 
-#for convenience:
-BASE=$OUTDIR'/'$SAMPLE_NAME
-DEFAULT_SAM=$BASE'.Aligned.out.sam'  #default naming scheme by STAR
-UNSORTED_SAM=$BASE'.sam'
-UNSORTED_BAM=$BASE'.bam'
-SORTED_BAM=$BASE'.sort' # no .bam-- that is appended by default by samtools sort
-
-#read-group info parsed from sample metadata:
-FCID=%FCID%
-LANE=%LANE%
-INDEX=%INDEX%
-
-#add read-group lines.  Without this, the RNA-SeQC step breaks
-java -Xmx4g -jar /cccbstore-rc/projects/cccb/apps/picard-tools-1.42/AddOrReplaceReadGroups.jar \
-	  I=$DEFAULT_SAM \
-	  o=$UNSORTED_SAM \
-	  VALIDATION_STRINGENCY=LENIENT \
-	  TMP_DIR=$OUTDIR/tmp \
-	  SORT_ORDER=coordinate \
-	  RGID= $FCID'.Lane'$LANE \
-	  RGLB=$SAMPLE_NAME \
-	  RGPL=illumina \
-	  RGPU=$INDEX \
-	  RGSM=$SAMPLE_NAME \
-	  RGCN='CCCB'
-
-#convert to BAM
-samtools view -bS -o $UNSORTED_BAM $UNSORTED_SAM
-
-#sort
-samtools sort -m 2500000000 $UNSORTED_BAM $SORTED_BAM #e.g the output is named aln/X.sort.bam
-
-#create index on the raw, sorted bam:
-samtools index $SORTED_BAM.bam #note the extra .bam, which samtools sort already added by default. the SORTED_BAM variable does not have the .bam on the end
-samtools flagstat $SORTED_BAM.bam >$OUTDIR/flagstat.raw.sorted.BAM.out
-
-# Create a de-duped BAM file 
-if [ $DEDUP -eq $NUM1 ]; then
+if [ "$POSTPROCESS" == "stream" ]; then
+    #no intermediate SAM: the raw alignments are counted (flagstat) as they stream past, secondary alignments are dropped,
+    #and only the sorted, primary-alignment BAM is written.  The count reads a copy of the stream through a FIFO, as a
+    #background job that is waited on, so its output is complete before it is used:
+    FLAGSTAT_FIFO=$BASE'.flagstat.fifo'
+    rm -f $FLAGSTAT_FIFO
+    mkfifo $FLAGSTAT_FIFO || { echo "Could not create the FIFO "$FLAGSTAT_FIFO".  Exiting"; exit 1; }
+    samtools flagstat - <$FLAGSTAT_FIFO >$OUTDIR/flagstat.raw.sorted.BAM.out &
+    FLAGSTAT_PID=$!
+    set -o pipefail
+    run_star --outStd SAM --outSAMattrRGline $READ_GROUPS \
+	| samtools view -bSu - \
+	| tee $FLAGSTAT_FIFO \
+	| samtools view -bu -F 0x0100 - \
+	| samtools sort -@ $SORT_THREADS -m $SORT_MEMORY - $SORTED_BAM.primary \
+	|| { echo "The alignment of "$SAMPLE_NAME" failed."; kill $FLAGSTAT_PID 2>/dev/null; rm -f $FLAGSTAT_FIFO; exit 1; }
+    set +o pipefail
+    wait $FLAGSTAT_PID || { echo "Counting the alignments of "$SAMPLE_NAME" (flagstat) failed."; rm -f $FLAGSTAT_FIFO; exit 1; }
+    rm -f $FLAGSTAT_FIFO
+
+    # Create a de-duped BAM file (MarkDuplicates passes secondary alignments through untouched, so marking the primary-only
+    # BAM gives the same result as marking first and filtering after, as in the 'sam' mode)
+    if [ $DEDUP -eq $NUM1 ]; then
+	DEDUP_BAM=$SORTED_BAM.dedup # e.g. aln/X.sort.dedup (no .bam for ease in appending more file identifiers)
+	java -Xmx$DEDUP_HEAP'g' -jar $PICARD_DIR/MarkDuplicates.jar INPUT=$SORTED_BAM.primary.bam OUTPUT=$DEDUP_BAM.primary.bam ASSUME_SORTED=TRUE TMP_DIR=./picardTemp/ REMOVE_DUPLICATES=TRUE METRICS_FILE=$DEDUP_BAM.metrics.out VALIDATION_STRINGENCY=LENIENT
+	samtools flagstat $DEDUP_BAM.primary.bam >$OUTDIR/flagstat.dedupBAM.out
+	rm $SORTED_BAM.primary.bam
+	FILTERED_FILE=$DEDUP_BAM.primary.bam
+    else
+	FILTERED_FILE=$SORTED_BAM.primary.bam
+    fi
+elif [ "$POSTPROCESS" == "sam" ]; then
+    run_star --outSAMattrRGline $READ_GROUPS || { echo "The alignment of "$SAMPLE_NAME" failed."; exit 1; }
+
+    #convert to BAM
+    samtools view -bS -o $UNSORTED_BAM $DEFAULT_SAM
+
+    #sort
+    samtools sort -@ $SORT_THREADS -m $SORT_MEMORY $UNSORTED_BAM $SORTED_BAM #e.g the output is named aln/X.sort.bam
+
+    #create index on the raw, sorted bam:
+    samtools index $SORTED_BAM.bam #note the extra .bam, which samtools sort already added by default. the SORTED_BAM variable does not have the .bam on the end
+    samtools flagstat $SORTED_BAM.bam >$OUTDIR/flagstat.raw.sorted.BAM.out
+
+    # Create a de-duped BAM file 
+    if [ $DEDUP -eq $NUM1 ]; then
 	DEDUP_BAM=$SORTED_BAM.dedup # e.g. aln/X.sort.dedup (no .bam for ease in appending more file identifiers)
-	java -Xmx6g -jar $PICARD_DIR/MarkDuplicates.jar INPUT=$SORTED_BAM.bam OUTPUT=$DEDUP_BAM.bam ASSUME_SORTED=TRUE TMP_DIR=./picardTemp/ REMOVE_DUPLICATES=TRUE METRICS_FILE=$DEDUP_BAM.metrics.out VALIDATION_STRINGENCY=LENIENT
+	java -Xmx$DEDUP_HEAP'g' -jar $PICARD_DIR/MarkDuplicates.jar INPUT=$SORTED_BAM.bam OUTPUT=$DEDUP_BAM.bam ASSUME_SORTED=TRUE TMP_DIR=./picardTemp/ REMOVE_DUPLICATES=TRUE METRICS_FILE=$DEDUP_BAM.metrics.out VALIDATION_STRINGENCY=LENIENT
 	samtools flagstat $DEDUP_BAM.bam >$OUTDIR/flagstat.dedupBAM.out
 	CURRENT_BAM=$DEDUP_BAM
-else
+    else
 	CURRENT_BAM=$SORTED_BAM
-fi
+    fi
+
+    # make a new bam file with only primary alignments  (if BAM is paired end, you may still have singletons here..so no filtering for proper pairs)
+    FILTERED_FILE=$CURRENT_BAM.primary.bam
+    samtools view -b -F 0x0100 $CURRENT_BAM.bam > $FILTERED_FILE
 
-# make a new bam file with only primary alignments  (if BAM is paired end, you may still have singletons here..so no filtering for proper pairs)
-FILTERED_FILE=$CURRENT_BAM.primary.bam
-samtools view -b -F 0x0100 $CURRENT_BAM.bam > $FILTERED_FILE
+    #cleanup
+    #remove the original SAM produced by STAR, and the unsorted bam
+    rm $UNSORTED_BAM &
+    rm $DEFAULT_SAM &
+else
+    echo "Unknown post-processing mode: "$POSTPROCESS
+    exit 1
+fi
+#############################################################
 
 #rename, so that it will be properly referenced by other scripts:
 FINAL_BAM_PATH=$BASE$FINAL_BAM_FILE_SUFFIX
@@ -146,12 +203,6 @@ mv $FILTERED_FILE $FINAL_BAM_PATH
 
 samtools index $FINAL_BAM_PATH
 
-#cleanup
-#remove the sorted SAM (w/ read groups added), the original SAM produced by STAR, and the unsorted bam
-rm $UNSORTED_BAM &
-rm $DEFAULT_SAM &
-rm $UNSORTED_SAM &
-
 #remove the empty tmp directories that STAR did not cleanup
 rmdir $BASE'._tmp'
 rmdir $OUTDIR'/tmp'
@@ -0,0 +1,124 @@
+#!/bin/bash
+
+if ! which samtools ; then
+	echo "Could not find samtools in your PATH"
+	exit 1
+fi
+
+#############################################################
+#input variables (which will be "injected" from elsewhere)
+#all paths should be absolute-- no assumptions about where
+#alignments should be placed relative to the working directory
+
+#the sorted, primary-alignment BAM files of the shards of this sample (aligned separately; see shard_fastq.py), and the
+#directories of the shards (removed once the merged BAM is made):
+SHARD_BAMS="%SHARD_BAMS%"
+SHARD_DIRS="%SHARD_DIRS%"
+
+SAMPLE_NAME="%SAMPLE_NAME%"
+DEDUP=%DEDUP%
+NUM0=0
+NUM1=1
+OUTDIR=%OUTPUTDIRECTORY%
+FINAL_BAM_FILE_SUFFIX=%BAM_FILE_SUFFIX%
+PICARD_DIR=%PICARD_DIR%
+
+#threads and memory, chosen for this host and the number of alignments run at once (see align_resources.py).  They are
+#read from the resource file when the merge starts, so they are not part of this script:
+RESOURCE_FILE=%RESOURCE_FILE%
+#############################################################
+
+if [ ! -f "$RESOURCE_FILE" ]; then
+    echo "Could not find the resource file: "$RESOURCE_FILE".  Exiting"
+    exit 1
+fi
+source $RESOURCE_FILE
+DEDUP_HEAP=$DEDUP_HEAP_GB
+
+mkdir -p $OUTDIR
+
+if [ ! -d "$OUTDIR" ]; then
+    echo "Could not create the output directory (permissions?).  Exiting"
+    exit 1
+fi
+
+echo Merging the shards of sample $SAMPLE_NAME':'
+for BAM in $SHARD_BAMS; do
+    if [ ! -f "$BAM" ]; then
+        echo "Could not find the BAM file of a shard: "$BAM".  Exiting"
+        exit 1
+    fi
+    echo $BAM
+done
+echo 'Resources: '$RESOURCES
+date
+
+#for convenience:
+BASE=$OUTDIR'/'$SAMPLE_NAME
+SORTED_BAM=$BASE'.sort'
+
+#combines STAR's summaries (Log.final.out) of the shards into one for the sample: the counts (and mapping speeds, since the
+#shards run at once) are summed, and the percentages and averages are weighted by the input reads of each shard.  The
+#start times are those of the first shard and the finish time that of the last:
+merge_star_logs(){
+    awk -F'|' '
+        FNR == 1 { file++ }
+        { key = $1 }
+        file == 1 { lines[++n] = $0; names[n] = key; has_value[n] = (NF > 1) }
+        NF < 2 { next }
+        { value = $2; gsub(/^[ \t]+|[ \t]+$/, "", value) }
+        key ~ /Number of input reads/ { reads = value+0; total_reads += reads }
+        value ~ /%$/ || key ~ /[Aa]verage/ { sums[key] += reads*value; weighted[key] = 1; percent[key] = (value ~ /%$/); next }
+        value ~ /^[0-9.]+$/ { sums[key] += value; next }
+        !(key in text) || key ~ /Finished on/ { text[key] = value }
+        END {
+            for (i = 1; i <= n; i++) {
+                key = names[i]
+                if (!has_value[i]) {
+                    print lines[i]
+                } else if (key in weighted) {
+                    printf "%s|\t%.2f%s\n", key, (total_reads > 0 ? sums[key]/total_reads : 0), (percent[key] ? "%" : "")
+                } else if (key in sums) {
+                    printf "%s|\t%s\n", key, sums[key]
+                } else {
+                    printf "%s|\t%s\n", key, text[key]
+                }
+            }
+        }' "$@"
+}
+
+#the shards are each sorted, so merging them gives the sorted, primary-alignment BAM of the whole sample:
+samtools merge -f -@ $SORT_THREADS $SORTED_BAM.primary.bam $SHARD_BAMS || { echo "Merging the shards of "$SAMPLE_NAME" failed."; exit 1; }
+samtools flagstat $SORTED_BAM.primary.bam >$OUTDIR/flagstat.merged.primary.BAM.out
+
+# Create a de-duped BAM file (duplicates are marked across all the shards, since the reads of a duplicate may be in any of them)
+if [ $DEDUP -eq $NUM1 ]; then
+	DEDUP_BAM=$SORTED_BAM.dedup # e.g. aln/X.sort.dedup (no .bam for ease in appending more file identifiers)
+	java -Xmx$DEDUP_HEAP'g' -jar $PICARD_DIR/MarkDuplicates.jar INPUT=$SORTED_BAM.primary.bam OUTPUT=$DEDUP_BAM.primary.bam ASSUME_SORTED=TRUE TMP_DIR=./picardTemp/ REMOVE_DUPLICATES=TRUE METRICS_FILE=$DEDUP_BAM.metrics.out VALIDATION_STRINGENCY=LENIENT \
+		|| { echo "Marking the duplicates of "$SAMPLE_NAME" failed."; exit 1; }
+	samtools flagstat $DEDUP_BAM.primary.bam >$OUTDIR/flagstat.dedupBAM.out
+	rm $SORTED_BAM.primary.bam
+	FILTERED_FILE=$DEDUP_BAM.primary.bam
+else
+	FILTERED_FILE=$SORTED_BAM.primary.bam
+fi
+
+#rename, so that it will be properly referenced by other scripts:
+FINAL_BAM_PATH=$BASE$FINAL_BAM_FILE_SUFFIX
+mv $FILTERED_FILE $FINAL_BAM_PATH
+
+samtools index $FINAL_BAM_PATH
+
+#STAR's summary of the sample (read for the QC metrics), from those of the shards, before they are removed:
+SHARD_LOGS=""
+for BAM in $SHARD_BAMS; do
+    SHARD_LOGS=$SHARD_LOGS" "$(dirname $BAM)'/'$SAMPLE_NAME'.Log.final.out'
+done
+merge_star_logs $SHARD_LOGS > $BASE.Log.final.out || echo "(Warning) Could not combine STAR's summaries of the shards of "$SAMPLE_NAME
+
+#cleanup: the shard FASTQs and alignments are no longer needed
+rm -rf $SHARD_DIRS
+
+chmod 744 $OUTDIR
+
+date
@@ -0,0 +1,147 @@
+"""
+This script records the resources used by each unit of work of the pipeline (an alignment, the read counting, an RNA-SeQC
+report, a DESeq contrast, ...) in the run timeline: a file with one JSON record per line, appended to as units complete.
+   -- a unit is run as a child of this script, so its resource usage (and that of any processes it starts) is collected
+      when it exits:
+        - wall time, and user/system cpu time (from the rusage of the child)
+        - peak RSS (the largest resident set of any single process of the unit)
+        - bytes read from, and written to, storage (from /proc/self/io, which includes the I/O of the exited children)
+   -- the timeline is rendered as the 'Run Performance' tab of the report
+
+Usage: telemetry.py run <timeline file> <stage> <unit> <command> [<args>...]
+   (exits with the exit code of the command)
+"""
+
+import os
+import sys
+import errno
+import json
+import time
+import fcntl
+import socket
+import subprocess
+
+PROC_IO = "/proc/self/io"
+
+
+def read_io():
+    """
+    Returns (bytes read, bytes written) for this process and its exited children, or (None, None) if not available
+    """
+    try:
+        with open(PROC_IO, 'r') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+def exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def measure(stage, unit, command):
+    """
+    Runs the command (a shell command if it is a string, otherwise a list of arguments) and waits for it.
+    Returns (exit code, record)
+    """
+    read_start, write_start = read_io()
+    start = time.time()
+    shell = isinstance(command, basestring)
+    process = subprocess.Popen(command, shell=shell, executable='/bin/bash' if shell else None)
+    while True:
+        try:
+            pid, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    end = time.time()
+    process.returncode = exit_code(status)
+    read_end, write_end = read_io()
+
+    record = {
+        'stage': stage,
+        'unit': unit,
+        'host': socket.gethostname(),
+        'start': round(start, 3),
+        'end': round(end, 3),
+        'wall_seconds': round(end-start, 3),
+        'user_cpu_seconds': round(usage.ru_utime, 3),
+        'system_cpu_seconds': round(usage.ru_stime, 3),
+        'peak_rss_mb': round(usage.ru_maxrss/1024.0, 1), #ru_maxrss is in KB on Linux
+        'read_bytes': read_end-read_start if read_start is not None and read_end is not None else None,
+        'write_bytes': write_end-write_start if write_start is not None and write_end is not None else None,
+        'exit_code': process.returncode
+    }
+    return process.returncode, record
+
+
+def phase_record(stage, unit, start, end):
+    """
+    A record for a phase within a unit of work (e.g. the genome loading of an alignment, timed from the aligner's log),
+    for which only the times are known
+    """
+    return {
+        'stage': stage,
+        'unit': unit,
+        'host': socket.gethostname(),
+        'start': round(start, 3),
+        'end': round(end, 3),
+        'wall_seconds': round(end-start, 3),
+        'user_cpu_seconds': None,
+        'system_cpu_seconds': None,
+        'peak_rss_mb': None,
+        'read_bytes': None,
+        'write_bytes': None,
+        'exit_code': None
+    }
+
+
+def append_record(timeline_file, record):
+    """
+    Appends a record to the timeline.  Several units may complete at once, so the file is locked while writing
+    """
+    with open(timeline_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.write(json.dumps(record, sort_keys=True)+"\n")
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_timeline(timeline_file):
+    """
+    Returns the records of the timeline, in the order the units started.  Lines that cannot be read are skipped
+    """
+    records = []
+    try:
+        with open(timeline_file, 'r') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except IOError:
+        return []
+    return sorted(records, key=lambda r: r.get('start', 0))
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 6 or sys.argv[1] != 'run':
+        sys.exit("Usage: telemetry.py run <timeline file> <stage> <unit> <command> [<args>...]")
+
+    timeline_file, stage, unit, command = sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5:]
+    #a single argument may be a whole shell command (e.g. as run by the stage executor):
+    if len(command) == 1:
+        command = command[0]
+    returncode, record = measure(stage, unit, command)
+    try:
+        append_record(timeline_file, record)
+    except IOError:
+        print "(Warning) Could not write to the run timeline: "+str(timeline_file)
+    sys.exit(returncode if returncode >= 0 else 128-returncode)
@@ -0,0 +1,84 @@
+"""
+Checks the batched read counting of count_reads.py, with the stub featureCounts of the benchmarks: the count file of each
+sample must be what process_count_files.R (which the batching replaced) made from a single-sample featureCounts table --
+the gene and its count, tab-separated, without a header.
+Run from the pipeline directory:  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+PIPELINE_HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB_TOOLS = os.path.join(PIPELINE_HOME, "benchmarks", "stub_tools")
+sys.path.insert(0, PIPELINE_HOME)
+import count_reads
+
+
+def process_count_files(table, column):
+    """
+    The output of process_count_files.R for the BAM file in the given count column (from zero) of a featureCounts table:
+    R's read.table skips the comment line and takes the header, and the gene (column 1) and count (column 7) of the
+    single-sample table are written without quotes, row names or a header
+    """
+    lines = []
+    with open(table, 'r') as f:
+        rows = [line.rstrip('\n').split('\t') for line in f if not line.startswith('#')]
+    for fields in rows[1:]:
+        single_sample = fields[:count_reads.FEATURECOUNTS_COUNT_COL]+[fields[count_reads.FEATURECOUNTS_COUNT_COL+column]]
+        lines.append(single_sample[0]+"\t"+single_sample[6]+"\n")
+    return "".join(lines)
+
+
+class CountReadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.environ.get('PATH', '')
+        os.environ['PATH'] = STUB_TOOLS+os.pathsep+self.path
+        os.environ['STUB_GENES'] = "50"
+        self.samples = ["A", "B", "C"]
+        self.batch = [(s, os.path.join(self.tmp_dir, s+".bam"), os.path.join(self.tmp_dir, s+".counts")) for s in self.samples]
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        del os.environ['STUB_GENES']
+        shutil.rmtree(self.tmp_dir)
+
+    def reference_table(self):
+        #(the stub's counts depend only on its arguments, so this is the table the batch was counted from):
+        table = os.path.join(self.tmp_dir, "reference.txt")
+        subprocess.check_call(["featureCounts", "-T", "1", "-a", "x.gtf", "-o", table, "-t", "exon", "-g", "gene_name"]+
+                              [bam for sample, bam, count_file in self.batch])
+        return table
+
+    def test_batch_count_files_match_process_count_files(self):
+        table = self.reference_table()
+        count_reads.count_batch(0, self.batch, "x.gtf", 1, self.tmp_dir)
+        for column, (sample, bam, count_file) in enumerate(self.batch):
+            with open(count_file, 'r') as f:
+                self.assertEqual(f.read(), process_count_files(table, column))
+        #the batch table is removed once it is split:
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, count_reads.BATCH_TABLE % 0)))
+
+    def test_split_counts(self):
+        table = self.reference_table()
+        count_reads.split_counts(table, [count_file for sample, bam, count_file in self.batch])
+        for column, (sample, bam, count_file) in enumerate(self.batch):
+            with open(count_file, 'r') as f:
+                contents = f.read()
+            self.assertEqual(contents, process_count_files(table, column))
+            self.assertEqual(len(contents.splitlines()), 50)
+
+    def test_make_batches(self):
+        self.assertEqual(count_reads.make_batches([], 0), [])
+        self.assertEqual(count_reads.make_batches([], 2), [])
+        self.assertEqual(count_reads.make_batches([1, 2, 3], 0), [[1, 2, 3]])
+        self.assertEqual(count_reads.make_batches([1, 2, 3], 2), [[1, 2], [3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
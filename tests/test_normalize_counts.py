@@ -0,0 +1,44 @@
+"""
+Checks the size factors of normalize_counts.py against those of DESeq's estimateSizeFactors (the median, over the genes
+counted in every sample, of the log ratio of a sample's count to the gene's geometric mean, exponentiated).
+Run from the pipeline directory:  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from normalize_counts import size_factors, normalize
+
+#genes x samples.  The ratios to the geometric means are powers of two, so DESeq's result is exact: the zero count leaves
+#out gene4, and with four genes left the median of the logs is the mean of the middle two (sqrt(1*2) for sample3)
+COUNTS = np.array([[10, 20, 40],
+                   [100, 100, 100],
+                   [8, 64, 8],
+                   [0, 5, 7],
+                   [25, 100, 400]], dtype=float)
+
+DESEQ_SIZE_FACTORS = np.array([0.5, 1.0, np.sqrt(2)])
+
+
+class SizeFactorTest(unittest.TestCase):
+
+    def test_size_factors_match_deseq(self):
+        np.testing.assert_allclose(size_factors(COUNTS), DESEQ_SIZE_FACTORS, rtol=1e-12)
+
+    def test_normalized_counts(self):
+        normalized = normalize(COUNTS, size_factors(COUNTS))
+        np.testing.assert_allclose(normalized[0], [20, 20, 40/np.sqrt(2)], rtol=1e-12)
+        np.testing.assert_allclose(normalized[3], [0, 5, 7/np.sqrt(2)], rtol=1e-12)
+
+    def test_scaling_a_sample_scales_its_factor(self):
+        scaled = COUNTS.copy()
+        scaled[:, 1] *= 3
+        factors = size_factors(scaled)
+        np.testing.assert_allclose(factors/factors[0], DESEQ_SIZE_FACTORS/DESEQ_SIZE_FACTORS[0]*[1, 3, 1], rtol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
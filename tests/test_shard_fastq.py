@@ -0,0 +1,79 @@
+"""
+Checks that splitting a sample into shards (shard_fastq.py) keeps every read, and the mates of each pair together.
+Run from the pipeline directory:  python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import shard_fastq
+
+
+def write_fastq(path, names, mate):
+    with gzip.open(path, 'wb') as f:
+        for name in names:
+            f.write("@"+name+"/"+str(mate)+"\nACGTACGTAC\n+\nIIIIIIIIII\n")
+
+
+def read_names(path):
+    with gzip.open(path, 'rb') as f:
+        return [shard_fastq.read_name(line) for i, line in enumerate(f) if i % 4 == 0]
+
+
+class ShardFastqTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.block_records = shard_fastq.SHARD_BLOCK_RECORDS
+        #small blocks, so the reads of a small FASTQ are dealt to every shard:
+        shard_fastq.SHARD_BLOCK_RECORDS = 7
+        self.names = ["READ:%d" % i for i in range(100)]
+        self.lanes = []
+        for lane in (1, 2):
+            fastqs = [os.path.join(self.tmp_dir, "S_L00%d_R%d_001.fastq.gz" % (lane, mate)) for mate in (1, 2)]
+            for mate, fastq in zip((1, 2), fastqs):
+                write_fastq(fastq, [n+":L%d" % lane for n in self.names], mate)
+            self.lanes.append((lane, fastqs[0], fastqs[1]))
+
+    def tearDown(self):
+        shard_fastq.SHARD_BLOCK_RECORDS = self.block_records
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sharded_reads_match_unsharded(self):
+        shard_dir = os.path.join(self.tmp_dir, "shards")
+        sample_name, counts, error = shard_fastq.split_sample(("S", self.lanes, shard_dir, 3, "fastq.gz"))
+        self.assertIsNone(error)
+        self.assertEqual(len(counts), 3)
+        self.assertTrue(all(c > 0 for c in counts))
+
+        unsharded = sorted(n for lane, a, b in self.lanes for n in read_names(a))
+        sharded_a, sharded_b = [], []
+        for shard in range(3):
+            shard_count = 0
+            for lane_number in range(len(self.lanes)):
+                a, b = shard_fastq.shard_fastqs(shard_dir, "S", shard, lane_number, True, "fastq.gz")
+                names_a, names_b = read_names(a), read_names(b)
+                self.assertEqual(names_a, names_b)
+                shard_count += len(names_a)
+                sharded_a.extend(names_a)
+                sharded_b.extend(names_b)
+            self.assertEqual(shard_count, counts[shard])
+        self.assertEqual(sum(counts), len(unsharded))
+        self.assertEqual(sorted(sharded_a), unsharded)
+        self.assertEqual(sorted(sharded_b), unsharded)
+
+    def test_mismatched_mates_fail(self):
+        lane, fastq_a, fastq_b = self.lanes[0]
+        write_fastq(fastq_b, self.names[:-1], 2)
+        sample_name, counts, error = shard_fastq.split_sample(("S", [self.lanes[0]], os.path.join(self.tmp_dir, "shards"), 2, "fastq.gz"))
+        self.assertIsNone(counts)
+        self.assertIsNotNone(error)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,364 @@
+"""
+Watch mode (-watch): aligns the samples of a project as they land from the sequencer, rather than once the whole project is there
+   -- the project directory is watched for sample directories (<SAMPLE_DIR_PREFIX><sample>).  Changes are picked up at once
+      through inotify where the system has it, and the project is also re-scanned every WATCH_POLL_SECONDS, since inotify
+      does not see files written by other hosts to network storage (without inotify, the re-scans alone are used)
+   -- a sample is ready once its sample sheet is present, its FASTQs have not changed (in size or modification time) for
+      WATCH_STABLE_SECONDS, and they decompress in full (the checks of fastq_preflight.py, whose results the preparation
+      of the alignments then re-uses).  A sample that fails the checks is checked again if its files change
+   -- the samples found ready together form a batch: their alignment scripts are written (prepare_align_script.py, given
+      the batch's own samples file) and their alignments started (run_alignments.py) at once, without waiting for the
+      alignments of earlier batches.  The alignments of all the batches share the host-wide memory pool (see align_admission.py)
+   -- as the alignments of a batch finish, the samples with a BAM file are appended to VALID_SAMPLE_FILE
+   -- once WATCH_COMPLETION_MARKER appears in the project directory and every sample directory has been unchanged for
+      WATCH_STABLE_SECONDS, this script waits for the remaining alignments and exits, so the driver goes on to the
+      project-level stages (read counts, design matrix, differential expression and the report)
+Only the samples in SAMPLES_FILE are aligned, unless WATCH_INFER_SAMPLES is set (the driver inferred the samples file from
+the project directory), when each sample directory that appears is added to the samples file
+"""
+
+import os
+import sys
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import signal
+import fnmatch
+import subprocess
+
+from stage_executor import read_valid_samples
+from run_alignments import raise_exit
+from prepare_align_script import pair_lanes
+from fastq_preflight import preflight, resolve_workers
+
+#the condition given to the samples added to an inferred samples file (as the driver does):
+INFERRED_CONDITION = "X"
+
+#how often (in seconds) to check on the alignments of the batches:
+BATCH_POLL_INTERVAL = 5
+
+#inotify events (from sys/inotify.h) that mean a sample or one of its files has appeared or been written:
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+WATCH_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class ChangeWatcher:
+    """
+    Waits for a change in the watched directories (with inotify), or for the timeout.  Without inotify, it only waits
+    """
+    def __init__(self):
+        self.fd = None
+        self.watched = set()
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd >= 0:
+            self.fd = fd
+
+    def add(self, path):
+        if self.fd is None or path in self.watched:
+            return
+        if self.libc.inotify_add_watch(self.fd, path, WATCH_EVENTS) >= 0:
+            self.watched.add(path)
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        if select.select([self.fd], [], [], timeout)[0]:
+            #(the events only mean 'look again', so they are discarded):
+            while True:
+                try:
+                    if not os.read(self.fd, 65536):
+                        break
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class WatchedSample:
+
+    def __init__(self, name, condition, sample_dir):
+        self.name = name
+        self.condition = condition
+        self.sample_dir = sample_dir
+        self.snapshot = None
+        self.changed = time.time()
+        #the snapshot of the files that was last checked (and failed), and why:
+        self.checked = None
+        self.reason = None
+        self.queued = False
+
+    def settled(self, now, stable_seconds):
+        return now-self.changed >= stable_seconds
+
+
+class Batch:
+
+    def __init__(self, number, samples, samples_file, valid_sample_file, log_file, process):
+        self.number = number
+        self.samples = samples
+        self.samples_file = samples_file
+        self.valid_sample_file = valid_sample_file
+        self.log_file = log_file
+        self.process = process
+
+
+def sample_fastqs(sample, file_names, read_tag, fastq_suffix):
+    #(the pattern prepare_align_script.py searches for):
+    pattern = sample.name+"*"+str(read_tag)+"*"+str(fastq_suffix)
+    return [os.path.join(sample.sample_dir, f) for f in sorted(file_names) if fnmatch.fnmatch(f, pattern)]
+
+
+def snapshot(sample, env):
+    """
+    The names, sizes and modification times of the FASTQs and the sample sheet of a sample
+    """
+    try:
+        file_names = os.listdir(sample.sample_dir)
+    except OSError:
+        return None
+    files = set(sample_fastqs(sample, file_names, env['READ_1_FASTQ_TAG'], env['FASTQ_SUFFIX']) +
+                sample_fastqs(sample, file_names, env['READ_2_FASTQ_TAG'], env['FASTQ_SUFFIX']))
+    files.add(os.path.join(sample.sample_dir, env['SAMPLE_SHEET_NAME']))
+    result = []
+    for path in sorted(files):
+        try:
+            st = os.stat(path)
+            result.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            result.append((path, None, None))
+    return result
+
+
+def sample_lanes(sample, env):
+    """
+    The lanes of a sample, as (read 1 FASTQ, read 2 FASTQ or None), or the reason it is not complete
+    """
+    if not os.path.isfile(os.path.join(sample.sample_dir, env['SAMPLE_SHEET_NAME'])):
+        return None, "its sample sheet ("+env['SAMPLE_SHEET_NAME']+") is missing"
+    file_names = os.listdir(sample.sample_dir)
+    fastqs_a = sample_fastqs(sample, file_names, env['READ_1_FASTQ_TAG'], env['FASTQ_SUFFIX'])
+    if not fastqs_a:
+        return None, "it has no read 1 FASTQ files"
+    if int(env['PAIRED_READS']) != 1:
+        return [(f, None) for f in fastqs_a], None
+    fastqs_b = sample_fastqs(sample, file_names, env['READ_2_FASTQ_TAG'], env['FASTQ_SUFFIX'])
+    lanes = pair_lanes(sample.name, fastqs_a, fastqs_b, env['READ_1_FASTQ_TAG'], env['READ_2_FASTQ_TAG'])
+    if lanes is None:
+        return None, "its read 1 and read 2 FASTQ files do not pair up"
+    return [(a, b) for lane, a, b in lanes], None
+
+
+def ready_samples(candidates, env):
+    """
+    Checks the samples whose files have settled.  Returns those that are ready, and records why the others are not
+    """
+    lanes = {}
+    for sample in candidates:
+        sample.checked = sample.snapshot
+        sample_lanes_or_none, reason = sample_lanes(sample, env)
+        if reason:
+            sample.reason = reason
+            print "Sample "+str(sample.name)+" is not ready: "+reason+".  It will be checked again if its files change."
+        else:
+            lanes[sample.name] = sample_lanes_or_none
+    if not lanes:
+        return []
+    #a FASTQ that is still being written (or was cut short) does not decompress in full:
+    failed = preflight(lanes, env['FASTQ_STATS_FILE'], resolve_workers(int(env['FASTQ_PREFLIGHT_WORKERS'])))
+    ready = []
+    for sample in candidates:
+        if sample.name not in lanes:
+            continue
+        if sample.name in failed:
+            sample.reason = failed[sample.name]
+            print "Sample "+str(sample.name)+" is not ready: "+sample.reason+".  It will be checked again if its files change."
+        else:
+            sample.reason = None
+            ready.append(sample)
+    return ready
+
+
+def write_samples(path, samples):
+    with open(path, 'w') as f:
+        for sample in samples:
+            f.write(str(sample.name)+"\t"+str(sample.condition)+"\n")
+
+
+def start_batch(number, samples, env, watch_dir):
+    """
+    Writes the alignment scripts of a batch of samples and starts their alignments.  Returns the Batch, or None if the
+    scripts could not be written
+    """
+    prefix = os.path.join(watch_dir, "batch"+str(number))
+    batch_env = dict(env)
+    batch_env['SAMPLES_FILE'] = prefix+".samples.txt"
+    batch_env['VALID_SAMPLE_FILE'] = prefix+".valid_samples.txt"
+    #(the resource file is shared by the batches, so it is planned for the pool rather than for this batch's samples):
+    batch_env['ALIGN_PLAN_FOR_POOL'] = "1"
+    write_samples(batch_env['SAMPLES_FILE'], samples)
+    print "\nStarting batch "+str(number)+" ("+", ".join(s.name for s in samples)+") at: "+time.strftime("%c")
+    sys.stdout.flush()
+    if subprocess.call([sys.executable, env['PREPARE_ALIGN_SCRIPT']], env=batch_env) != 0:
+        print "(Warning) Could not prepare the alignments of batch "+str(number)+".  Its samples will not be aligned."
+        return None
+    log_file = prefix+".log"
+    with open(log_file, 'w') as log:
+        #the output of the alignments is echoed once the batch finishes, so that of concurrent batches does not interleave:
+        process = subprocess.Popen([sys.executable, env['RUN_ALIGNMENTS_SCRIPT']], env=batch_env, stdout=log, stderr=subprocess.STDOUT)
+    return Batch(number, samples, batch_env['SAMPLES_FILE'], batch_env['VALID_SAMPLE_FILE'], log_file, process)
+
+
+def finish_batch(batch, env):
+    """
+    Echoes the output of a batch whose alignments have finished, and appends its aligned samples to VALID_SAMPLE_FILE
+    """
+    print "\n---------- Output of the alignments of batch "+str(batch.number)+" ----------"
+    try:
+        with open(batch.log_file, 'r') as log:
+            sys.stdout.write(log.read())
+    except IOError:
+        pass
+    aligned = []
+    for sample, condition in read_valid_samples(batch.valid_sample_file):
+        bam_file = os.path.join(env['PROJECT_DIR'], env['SAMPLE_DIR_PREFIX']+sample, env['ALN_DIR_NAME'], sample+env['FINAL_BAM_SUFFIX'])
+        if os.path.isfile(bam_file):
+            aligned.append((sample, condition))
+        else:
+            print "(Warning) The alignment of sample "+str(sample)+" did not produce a BAM file."
+    with open(env['VALID_SAMPLE_FILE'], 'a') as vsf:
+        for sample, condition in aligned:
+            vsf.write(str(sample)+"\t"+str(condition)+"\n")
+    print "Batch "+str(batch.number)+" completed at: "+time.strftime("%c")+" (exit code "+str(batch.process.returncode)+"), "+\
+        str(len(aligned))+" of "+str(len(batch.samples))+" samples aligned\n"
+    sys.stdout.flush()
+
+
+def main(env):
+    project_dir = env['PROJECT_DIR']
+    prefix = env['SAMPLE_DIR_PREFIX']
+    infer_samples = int(env['WATCH_INFER_SAMPLES']) == 1
+    stable_seconds = float(env['WATCH_STABLE_SECONDS'])
+    poll_seconds = float(env['WATCH_POLL_SECONDS'])
+    marker = os.path.join(project_dir, env['WATCH_COMPLETION_MARKER'])
+    watch_dir = os.path.join(project_dir, env['WATCH_DIR'])
+    if not os.path.isdir(watch_dir):
+        os.makedirs(watch_dir)
+
+    conditions = dict(read_valid_samples(env['SAMPLES_FILE']))
+    watcher = ChangeWatcher()
+    watcher.add(project_dir)
+    print "Watching "+str(project_dir)+" for samples "+("(with inotify, " if watcher.fd is not None else "(")+\
+        "re-scanned every "+str(poll_seconds)+" seconds) until "+str(marker)+" appears."
+    sys.stdout.flush()
+
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, raise_exit)
+    samples = {}
+    ignored = set()
+    batches = []
+    batch_number = 0
+    marker_seen = False
+    try:
+        while True:
+            now = time.time()
+            if not marker_seen and os.path.exists(marker):
+                marker_seen = True
+                print "Found the completion marker "+str(marker)+" at: "+time.strftime("%c")
+                sys.stdout.flush()
+
+            #look for new sample directories:
+            for entry in sorted(os.listdir(project_dir)):
+                name = entry[len(prefix):]
+                if not entry.startswith(prefix) or not name or name in samples or name in ignored:
+                    continue
+                sample_dir = os.path.join(project_dir, entry)
+                if not os.path.isdir(sample_dir):
+                    continue
+                if name not in conditions:
+                    if not infer_samples:
+                        print "(Warning) Sample directory "+str(sample_dir)+" is not in the samples file "+str(env['SAMPLES_FILE'])+".  Ignoring."
+                        ignored.add(name)
+                        continue
+                    conditions[name] = INFERRED_CONDITION
+                    with open(env['SAMPLES_FILE'], 'a') as sf:
+                        sf.write(name+"\t"+INFERRED_CONDITION+"\n")
+                print "Found sample "+str(name)+" at: "+time.strftime("%c")
+                samples[name] = WatchedSample(name, conditions[name], sample_dir)
+                watcher.add(sample_dir)
+
+            #samples whose files have been unchanged for long enough (and were not already checked as they are) are checked:
+            candidates = []
+            for name in sorted(samples):
+                sample = samples[name]
+                if sample.queued:
+                    continue
+                current = snapshot(sample, env)
+                if current != sample.snapshot:
+                    sample.snapshot = current
+                    sample.changed = now
+                elif sample.settled(now, stable_seconds) and sample.checked != current:
+                    candidates.append(sample)
+            ready = ready_samples(candidates, env)
+            if ready:
+                batch_number += 1
+                for sample in ready:
+                    sample.queued = True
+                batch = start_batch(batch_number, ready, env, watch_dir)
+                if batch is not None:
+                    batches.append(batch)
+
+            for batch in list(batches):
+                if batch.process.poll() is not None:
+                    batches.remove(batch)
+                    finish_batch(batch, env)
+
+            settling = [s for s in samples.values() if not s.queued and (not s.settled(time.time(), stable_seconds) or s.checked != s.snapshot)]
+            if marker_seen and not settling:
+                if not batches:
+                    break
+                timeout = BATCH_POLL_INTERVAL
+            else:
+                timeout = poll_seconds
+                if settling:
+                    timeout = min(timeout, max(1, min(s.changed+stable_seconds for s in settling)-time.time()))
+                if batches:
+                    timeout = min(timeout, BATCH_POLL_INTERVAL)
+            sys.stdout.flush()
+            watcher.wait(timeout)
+    finally:
+        #stop the alignments of the batches still running (each releases its memory from the pool as it exits):
+        for batch in batches:
+            if batch.process.poll() is None:
+                batch.process.terminate()
+                batch.process.wait()
+        watcher.close()
+
+    for name in sorted(samples):
+        if not samples[name].queued:
+            print "(Warning) Sample "+str(name)+" was not aligned: "+str(samples[name].reason or "its files are incomplete")
+    for name in sorted(set(conditions)-set(samples)):
+        print "(Warning) No directory was found for sample "+str(name)+" before the project was complete."
+
+
+if __name__ == "__main__":
+
+    try:
+        main(os.environ)
+    except KeyError as e:
+        sys.exit("Could not watch the project.  Missing variable: "+str(e))